@@ -1,29 +1,33 @@
 from StockData import StockData
-import pandas as pd
-import csv
 from Valuation import valuation
-from StockTrader_1mil import StockTrader_1mil
+from Instrumentation import enable_profiling, disable_profiling
+from AppStages import large_sequence_runner
 
 # StockData class arguments
 stock_data_path = "/mnt/c/Users/user/working_dir/Stocks_Init"
+stock_cache_path = "/mnt/c/Users/user/working_dir/Stocks_Cache"
+checkpoint_path = "/mnt/c/Users/user/working_dir/int_tab/checkpoints" # checkpoints of the stages keyed by their parameters
+large_file = '/mnt/c/Users/user/working_dir/large.txt'
 n_seq_large = 1000000
+profile_file = None # e.g. "/mnt/c/Users/user/working_dir/profile_1mil.json" to record the time, rows and memory of each stage
+
+if profile_file is not None:
+    enable_profiling(profile_file)
 
 # Create the StockData class instance for 
-StockData_Inst = StockData(stock_data_path, n_seq_large, date_ranges=None, return_threshold=None, min_years=None)
+StockData_Inst = StockData(stock_data_path, n_seq_large, date_ranges=None, return_threshold=None, min_years=None,
+                           cache_path=stock_cache_path)
 
-# Create the large stocks dataframe to be used for the stock trading sequence with a length <= 1000000
-large_stock_df = StockData_Inst.concat_stock_dfs()
 
-# Create the large transactions sequence
-transactions, buy_df, sell_df, final_capital = StockTrader_1mil(large_stock_df)
+# Run the trader only if the stock data, the parameters or the .txt file have changed since the last run
+runner = large_sequence_runner(StockData_Inst, checkpoint_path, large_file, allocation='ranked', chunksize=1000000)
+n_transactions, final_capital, ledger = runner.run()['buy_sell_df']
 
 # plot the valuation plot
-valuation(buy_df, sell_df, n_seq=1000000)
+valuation(ledger=ledger, n_seq=1000000)
 
-# Store the results in a .txt file
-with open('/mnt/c/Users/user/working_dir/large.txt', 'w') as file:
-    file.write(f"{len(transactions)}\n")
-    for _, row in transactions.iterrows():
-        file.write(' '.join(str(value).strip() for value in row.values) + '\n')
+print(f"Transactions: {n_transactions}")
 print(f"Final Capital: {final_capital}")
 
+disable_profiling()
+
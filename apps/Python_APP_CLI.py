@@ -0,0 +1,269 @@
+"""
+Command line interface of the applications, with the paths and parameters read from a JSON config file:
+
+    python3 Python_APP_CLI.py --config config.json ingest
+    python3 Python_APP_CLI.py --config config.json analyze
+    python3 Python_APP_CLI.py --config config.json trade-small --set small.trans_fee=0.005
+    python3 Python_APP_CLI.py --config config.json trade-large
+    python3 Python_APP_CLI.py --config config.json valuate --sequence small.txt
+
+Only the standard library is imported up front, the modules of each subcommand (pandas, matplotlib, the traders) are
+imported when the subcommand runs, so `--help` and the parsing of the config start in a few milliseconds.
+"""
+import argparse
+import json
+import os
+import sys
+
+# The modules of src_code are importable when the CLI is run from the repository
+SRC_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'src_code')
+if os.path.isdir(SRC_PATH) and SRC_PATH not in sys.path:
+    sys.path.insert(0, SRC_PATH)
+
+# Parameters of Python_APP_1k.py and Python_APP_1mil.py, each section can be overridden by the config file
+DEFAULT_CONFIG = {
+    'paths': {
+        'stock_data_path': 'Stocks_Init',  # the 'Stocks_Init' dir contains the stocks prices+volume from the kaggle dataset
+        'stock_cache_path': 'Stocks_Cache',  # columnar cache of the 'Stocks_Init' dir
+        'panel_path': 'Stocks_Panel',  # price panel of the cache (see PricePanel)
+        'checkpoint_path': os.path.join('int_tab', 'checkpoints'),  # checkpoints of the stages keyed by their parameters
+        'stock_perf_path': os.path.join('int_tab', 'stock_perf_tab'),  # performance tables written by analyze
+        'profile_file': None  # e.g. "profile.json" to record the time, rows and memory of each stage
+    },
+    'small': {
+        'n_seq': 1000,
+        'date_ranges': [['1962-01-01', '1980-01-01'], ['1980-01-01', '2000-01-01'], ['2000-01-01', '2018-01-01']],
+        'min_years': [5, 10, 5],
+        'min_total_return': [2, 100, 50],
+        'prescan': True,
+        'st_cap': 1,
+        'trans_fee': 0.01,
+        'output_file': 'small.txt',
+        'valuation_file': None  # e.g. "valuation_small.png" to save the valuation plot
+    },
+    'large': {
+        'n_seq': 1000000,
+        'allocation': 'ranked',
+        'chunksize': 1000000,
+        'output_file': 'large.txt',
+        'valuation_file': None
+    },
+    'valuate': {
+        'sequence_file': 'small.txt',
+        'st_cap': 1,
+        'trans_fee': 0.01,
+        'valuation_file': 'valuation.png',
+        'max_points': 5000
+    }
+}
+
+# Parameters that are paths, the relative ones are resolved against the directory of the config file
+PATH_PARAMS = {
+    'paths': ['stock_data_path', 'stock_cache_path', 'panel_path', 'checkpoint_path', 'stock_perf_path', 'profile_file'],
+    'small': ['output_file', 'valuation_file'],
+    'large': ['output_file', 'valuation_file'],
+    'valuate': ['sequence_file', 'valuation_file']
+}
+
+
+def load_config(config_file=None, overrides=()):
+    """
+    Read the config file and merge it over the default parameters section by section. The relative paths of the
+    merged parameters (see PATH_PARAMS) are resolved against the directory of the config file, so the config works
+    from any working directory, while the paths of the overrides are kept as given.
+
+    Args:
+        config_file (str): Path of the JSON config file (if not specified the default parameters are used and the
+        paths are relative to the working directory)
+        overrides (list): List with 'section.key=value' overrides where the value is parsed as JSON (or kept as a string)
+
+    Returns:
+        config (dict): Dictionary with the parameters of each section
+    """
+    config = {section: dict(params) for section, params in DEFAULT_CONFIG.items()}
+    if config_file is not None:
+        with open(config_file) as file:
+            for section, params in json.load(file).items():
+                if section not in config:
+                    raise ValueError(f"Unknown config section '{section}'")
+                config[section].update(params)
+
+        config_dir = os.path.dirname(os.path.abspath(config_file))
+        for section, names in PATH_PARAMS.items():
+            for name in names:
+                if config[section][name] is not None:
+                    config[section][name] = os.path.normpath(os.path.join(config_dir, config[section][name]))
+
+    for override in overrides:
+        key, eq, value = override.partition('=')
+        section, dot, name = key.partition('.')
+        if not eq or not dot or section not in config or not name:
+            raise ValueError(f"Overrides must be given as section.key=value, not '{override}'")
+        try:
+            config[section][name] = json.loads(value)
+        except json.JSONDecodeError:
+            config[section][name] = value
+
+    return config
+
+
+def stock_data(config, n_seq, small=True):
+    from StockData import StockData
+
+    paths, params = config['paths'], config['small']
+    if not small:
+        return StockData(paths['stock_data_path'], n_seq, date_ranges=None, return_threshold=None, min_years=None,
+                         cache_path=paths['stock_cache_path'])
+
+    return StockData(paths['stock_data_path'], n_seq, tuple(map(tuple, params['date_ranges'])),
+                     tuple(params['min_total_return']), tuple(params['min_years']), cache_path=paths['stock_cache_path'],
+                     prescan=params['prescan'])
+
+
+def write_sequence(transaction_df, output_file):
+    # Write the number of transactions and a 'YYYY-MM-DD action STOCK VOLUME' line for each transaction
+    with open(output_file, 'w', newline='') as file:
+        file.write(f"{len(transaction_df)}\n")
+        transaction_df.to_csv(file, sep=' ', index=False, header=False)
+
+
+def ingest(config, args):
+    """Build (or update) the columnar cache of the price files and the price panel of the cache."""
+    from StockCache import StockCache
+    from PricePanel import PricePanel
+
+    paths = config['paths']
+    files = stock_data(config, 1000, small=False).stock_files()
+    stock_cache = StockCache(paths['stock_cache_path'])
+    if not stock_cache.is_valid(files):
+        stock_cache.build(files)
+    panel = PricePanel.from_cache(paths['panel_path'], paths['stock_cache_path'])
+    n_days, n_stocks = panel.shape
+    print(f"Files: {len(files)}, Trading days: {n_days}, Stocks: {n_stocks}")
+
+
+def analyze(config, args):
+    """Write the performance table of the stocks for each date range of the small sequence."""
+    StockData_Inst = stock_data(config, config['small']['n_seq'])
+    stocks_perfs, _ = StockData_Inst.read_analyze_stocks()
+
+    os.makedirs(config['paths']['stock_perf_path'], exist_ok=True)
+    for (_, end_date), stock_perf in zip(StockData_Inst.date_ranges, stocks_perfs):
+        perf_file = os.path.join(config['paths']['stock_perf_path'], f"Stocks_Performance_{end_date[:4]}.csv")
+        stock_perf.to_csv(perf_file, index=False)
+        print(f"{perf_file}: {len(stock_perf)} stocks")
+
+
+def trade_small(config, args):
+    """Create the small sequence through the checkpointed stages of Python_APP_1k.py."""
+    from AppStages import small_sequence_runner
+
+    params = config['small']
+    runner = small_sequence_runner(stock_data(config, params['n_seq']), config['paths']['checkpoint_path'],
+                                   params['st_cap'], params['trans_fee'])
+    small_txt, final_capital, ledger = runner.run()['buy_sell_df']
+
+    write_sequence(small_txt, params['output_file'])
+    if params['valuation_file'] is not None:
+        from Valuation import valuation
+        valuation(ledger=ledger, st_cap=params['st_cap'], output_file=params['valuation_file'])
+
+    print(f"Transactions: {len(small_txt)}")
+    print(f"Final Capital: {final_capital}")
+
+
+def trade_large(config, args):
+    """Create the large sequence through the checkpointed stage of Python_APP_1mil.py."""
+    from AppStages import large_sequence_runner
+
+    params = config['large']
+    runner = large_sequence_runner(stock_data(config, params['n_seq'], small=False), config['paths']['checkpoint_path'],
+                                   params['output_file'], allocation=params['allocation'], chunksize=params['chunksize'])
+    n_transactions, final_capital, ledger = runner.run()['buy_sell_df']
+
+    if params['valuation_file'] is not None:
+        from Valuation import valuation
+        valuation(ledger=ledger, n_seq=params['n_seq'], output_file=params['valuation_file'])
+
+    print(f"Transactions: {n_transactions}")
+    print(f"Final Capital: {final_capital}")
+
+
+def valuate(config, args):
+    """Plot the valuation of a sequence file with the prices of the price panel."""
+    import numpy as np
+    from PricePanel import PricePanel
+    from SequenceValidator import ACTION_FIELDS, load_sequence
+    from TradeLedger import TradeLedger, ACTION_CODES
+    from Valuation import valuation
+
+    params = config['valuate']
+    sequence_file = args.sequence or params['sequence_file']
+    _, sequence_df = load_sequence(sequence_file)
+    malformed = (~sequence_df['Transaction'].isin(list(ACTION_FIELDS)) | sequence_df['Date'].isna() |
+                 sequence_df['Volume'].isna()).to_numpy()
+    if malformed.any():
+        # The header is the first line of the file
+        line = int(np.argmax(malformed)) + 2
+        raise ValueError(f"{sequence_file} has a malformed transaction on line {line} "
+                         f"(action '{sequence_df['Transaction'].iloc[line - 2]}')")
+    panel = PricePanel.from_cache(config['paths']['panel_path'], config['paths']['stock_cache_path'])
+
+    # Price of each transaction including the fee and the close price of its stock
+    transactions = sequence_df['Transaction'].to_numpy()
+    values = panel.gather(sequence_df['Date'], sequence_df['Stock'], fields=list(dict.fromkeys(ACTION_FIELDS.values())))
+    if not values['Present'].all():
+        raise ValueError(f"{sequence_file} trades on dates or stocks that are not in the price panel")
+    is_buy = np.char.startswith(transactions.astype(str), 'buy')
+    fields = np.array([ACTION_FIELDS[action] for action in transactions], dtype=object)
+    prices = np.zeros(len(fields))
+    for field in np.unique(fields):
+        prices[fields == field] = values[field][fields == field]
+    volumes = sequence_df['Volume'].to_numpy(dtype=np.float64)
+
+    ledger = TradeLedger(log_idle=False)
+    ledger.extend(sequence_df['Date'].to_numpy(), ledger.symbol_codes(sequence_df['Stock']),
+                  np.array([ACTION_CODES[action] for action in transactions], dtype=np.int8), volumes,
+                  volumes * prices * np.where(is_buy, 1 + params['trans_fee'], 1 - params['trans_fee']), values['Close'])
+    valuation_df = valuation(ledger=ledger, st_cap=params['st_cap'], n_seq=len(sequence_df),
+                             output_file=params['valuation_file'], max_points=params['max_points'])
+
+    print(f"{params['valuation_file']}: {len(valuation_df)} points, final balance {valuation_df['Balance'].iloc[-1]}")
+
+
+COMMANDS = {'ingest': ingest, 'analyze': analyze, 'trade-small': trade_small, 'trade-large': trade_large,
+            'valuate': valuate}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time travel to the stock market: build the stock data cache, "
+                                                 "analyze the stocks and create and valuate the transactions sequences")
+    parser.add_argument('--config', default=None, help="Path of the JSON config file (see DEFAULT_CONFIG)")
+    parser.add_argument('--set', dest='overrides', action='append', default=[], metavar='SECTION.KEY=VALUE',
+                        help="Override a parameter of the config (the value is parsed as JSON), e.g. small.trans_fee=0.005")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    for name, command in COMMANDS.items():
+        subparser = subparsers.add_parser(name, help=command.__doc__)
+        if name == 'valuate':
+            subparser.add_argument('--sequence', default=None, help="Path of the sequence file (valuate.sequence_file)")
+    args = parser.parse_args(argv)
+
+    try:
+        config = load_config(args.config, args.overrides)
+    except ValueError as error:
+        parser.error(str(error))
+    profile_file = config['paths']['profile_file']
+    if profile_file is not None:
+        from Instrumentation import enable_profiling
+        enable_profiling(profile_file)
+
+    try:
+        COMMANDS[args.command](config, args)
+    finally:
+        if profile_file is not None:
+            from Instrumentation import disable_profiling
+            disable_profiling()
+
+
+if __name__ == '__main__':
+    main()
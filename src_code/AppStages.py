@@ -0,0 +1,136 @@
+import pandas as pd
+from Pipeline import PipelineRunner, source_signature
+from StockTrader_1k import stocks_weight, Stock_Trader_1000
+from StockTrader_1mil import StockTrader_1mil
+from TradeLedger import TradeLedger
+
+
+def stock_perf_tab(stock_data):
+    """
+    For the date ranges (e.g. 1962-1980, 1980-2000 and 2000-2018) create sorted tables with the total return of the stocks.
+    """
+    stocks_perfs, _ = stock_data.read_analyze_stocks()
+
+    return stocks_perfs
+
+
+def filt_stock(stock_data, stocks_perfs):
+    """
+    Create the filtered stocks dataframes to be used for the stock trading sequence with a length <= 1000 from the
+    performance tables (on a resume they come from the checkpoint, so only the kept stocks are loaded).
+
+    Args:
+        stock_data (StockData): StockData instance of the small sequence
+        stocks_perfs (list): Performance tables of the date ranges (see stock_perf_tab)
+
+    Returns:
+        filtered_stocks (list): Dataframe with the first and last row of the filtered stocks for each date range sorted by date
+        stocks_perf (list): Performance table of the filtered stocks for each date range with the weights of the stocks
+    """
+    # Create a list with the filtered stocks dataframes for the date ranges specified and sort them by date
+    filtered_stocks = [filtered_stock.sort_values(by=["Date"])
+                       for filtered_stock in stock_data.concat_stock_dfs(stock_performances=stocks_perfs)]
+
+    # Sort the stock performances of the date ranges by total return, filter the stocks that are not in the
+    # filtered stocks dataframes and calculate the stocks weights
+    stocks_perf = [stock_perf.sort_values(by=["Total_Return"], ascending=False) for stock_perf in stocks_perfs]
+    stocks_perf = [stock_perf[stock_perf["Stock"].isin(filtered_stock['Stock_Name'].values)] for stock_perf, filtered_stock in
+                   zip(stocks_perf, filtered_stocks)]
+    stocks_perf = [stocks_weight(stock_perf) for stock_perf in stocks_perf]
+
+    return filtered_stocks, stocks_perf
+
+
+def buy_sell_small(filtered_data, st_cap, trans_fee):
+    """
+    Create the stock trading sequence of each date range, where each date range starts with the capital at the end of
+    the previous one, and log the transactions of all the date ranges in a shared ledger.
+
+    Args:
+        filtered_data (tuple): Filtered stocks and their performance tables (see filt_stock)
+        st_cap (float): Starting capital
+        trans_fee (float): Transaction fee as a percentage of the price
+
+    Returns:
+        small_txt (pd.DataFrame): Dataframe with the transactions of all the date ranges
+        final_capital (float): Capital at the end of the last date range
+        ledger (TradeLedger): Ledger of the buying and selling transactions
+    """
+    ledger = TradeLedger(log_idle=False)
+    capital, sequences = st_cap, []
+    for filtered_stock, stock_perf in zip(*filtered_data):
+        transaction_df, capital, _ = Stock_Trader_1000(filtered_stock, stock_perf, st_cap=capital, trans_fee=trans_fee,
+                                                       ledger=ledger)
+        sequences.append(transaction_df)
+
+    return pd.concat(sequences), capital, ledger
+
+
+def buy_sell_large(stock_data, large_file, allocation='ranked', chunksize=1000000):
+    """
+    Create the large transactions sequence, stream it to the .txt file and log only the trades in the ledger.
+
+    Args:
+        stock_data (StockData): StockData instance of the large sequence
+        large_file (str): Path of the .txt file of the sequence
+        allocation (str): Allocation of the capital among the stocks of a day (see StockTrader_1mil)
+        chunksize (int): Number of rows of the chronological chunks the stocks are streamed in
+
+    Returns:
+        n_transactions (int): Number of transactions of the sequence
+        final_capital (float): Capital at the end of the sequence
+        ledger (TradeLedger): Ledger of the buying and selling transactions
+    """
+    # Stream the stocks in chronological chunks (k-way merge of the cached stocks), so that the large stocks dataframe
+    # is never built in memory
+    large_stock_df = stock_data.concat_stock_dfs(chunksize=chunksize)
+
+    # Spread the trades over all the trading days, so that each day trades its best stocks (ranked by the intra-day
+    # return) instead of the budget of transactions being spent before the last trading days (no limit without data)
+    n_days = stock_data.trading_days()
+    max_stocks_per_day = -(-stock_data.n_seq // 2 // n_days) if n_days else None
+
+    ledger = TradeLedger(log_idle=False)
+    n_transactions, _, _, final_capital = StockTrader_1mil(large_stock_df, ledger=ledger, n_seq=stock_data.n_seq,
+                                                           output_file=large_file, allocation=allocation,
+                                                           max_stocks_per_day=max_stocks_per_day)
+
+    return n_transactions, final_capital, ledger
+
+
+def small_sequence_runner(stock_data, checkpoint_path, st_cap, trans_fee):
+    """
+    Create the runner of the stages of the small sequence: a change of the trading parameters reuses the filtered
+    stocks and a change of the filtering parameters reuses the performance tables.
+
+    Returns:
+        runner (PipelineRunner): Runner whose 'buy_sell_df' stage outputs the sequence, the final capital and the ledger
+    """
+    runner = PipelineRunner(checkpoint_path)
+    runner.add_stage('stock_perf_tab', lambda _: stock_perf_tab(stock_data),
+                     {'source': source_signature(stock_data.stock_files()), 'date_ranges': stock_data.date_ranges,
+                      'prescan': stock_data.prescan, 'min_years': stock_data.min_years})
+    runner.add_stage('filt_stock', lambda stocks_perfs: filt_stock(stock_data, stocks_perfs),
+                     {'min_years': stock_data.min_years, 'min_total_return': stock_data.return_threshold})
+    runner.add_stage('buy_sell_df', lambda filtered_data: buy_sell_small(filtered_data, st_cap, trans_fee),
+                     {'st_cap': st_cap, 'trans_fee': trans_fee})
+
+    return runner
+
+
+def large_sequence_runner(stock_data, checkpoint_path, large_file, allocation='ranked', chunksize=1000000):
+    """
+    Create the runner of the stage of the large sequence, which runs the trader only if the stock data, the parameters
+    or the .txt file have changed since the last run.
+
+    Returns:
+        runner (PipelineRunner): Runner whose 'buy_sell_df' stage outputs the number of transactions, the final capital
+        and the ledger
+    """
+    runner = PipelineRunner(checkpoint_path)
+    runner.add_stage('buy_sell_df', lambda _: buy_sell_large(stock_data, large_file, allocation, chunksize),
+                     {'source': source_signature(stock_data.stock_files()), 'n_seq': stock_data.n_seq,
+                      'allocation': allocation, 'large_file': large_file},
+                     output_files=[large_file])
+
+    return runner
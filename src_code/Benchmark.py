@@ -0,0 +1,265 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import numpy as np
+import pandas as pd
+from StockData import StockData
+from StockTrader_1k import stocks_weight, Stock_Trader_1000
+from StockTrader_1mil import StockTrader_1mil
+from SyntheticData import generate_stock_files
+from Instrumentation import current_rss
+from TradeLedger import TradeLedger
+from Valuation import valuation
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+class RSSSampler:
+    """Context manager that samples the resident set size of the process from a background thread and keeps the peak
+    reached while it is active. If the RSS can't be sampled on the platform the peak RSS of the whole process so far
+    (getrusage) is reported instead.
+    """
+    def __init__(self, interval=0.005):
+        """
+        Args:
+                interval (float): Seconds between two samples
+        """
+        self.interval = interval
+        self.peak = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, current_rss())
+
+    def __enter__(self):
+        self.peak = current_rss()
+        if self.peak is not None:
+            self._thread = threading.Thread(target=self._sample, daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self.peak = max(self.peak, current_rss())
+        elif resource is not None:
+            # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+            max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            self.peak = max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+def measure_stage(stage, n_rows, func, *args, **kwargs):
+    """
+    Run a pipeline stage and measure its wall time, its peak RSS and its throughput.
+
+    Args:
+        stage (str): Name of the stage
+        n_rows (int): Number of rows processed by the stage (used for the rows/sec)
+        func (callable): Function of the stage, called with the rest of the positional and keyword arguments
+
+    Returns:
+        result: The result of the stage (None if the stage failed)
+        record (dict): Dictionary with the Stage, Wall_Time (sec), Peak_RSS_MB, Rows, Rows_Per_Sec and Error of the stage
+    """
+    result, error = None, None
+    with RSSSampler() as sampler:
+        start = time.perf_counter()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as exception:
+            error = str(exception) or type(exception).__name__
+        wall_time = time.perf_counter() - start
+
+    return result, {
+        'Stage': stage,
+        'Wall_Time': wall_time,
+        'Peak_RSS_MB': sampler.peak / 2**20 if sampler.peak is not None else None,
+        'Rows': int(n_rows),
+        'Rows_Per_Sec': n_rows / wall_time if wall_time > 0 else None,
+        'Error': error
+    }
+
+
+def split_date_ranges(stock_datalist, max_splits=3, min_range_years=7):
+    """
+    Split the span of the market in equal date ranges (the synthetic counterpart of 1962-1980, 1980-2000 and 2000-2018).
+    Stock_Trader_1000 splits the buying and selling dates of a date range at a gap of more than 6 years, so the number
+    of date ranges is reduced until each one is at least min_range_years long.
+    """
+    first = pd.to_datetime(min(stock_df['Date'].min() for stock_df in stock_datalist))
+    last = pd.to_datetime(max(stock_df['Date'].max() for stock_df in stock_datalist))
+    n_splits = int(np.clip((last - first).days / 365.25 // min_range_years, 1, max_splits))
+    bounds = pd.date_range(first, last, periods=n_splits + 1).strftime('%Y-%m-%d')
+
+    return tuple(zip(bounds[:-1], bounds[1:]))
+
+
+def run_small_sequence(stock_datalist, date_ranges, min_years, min_total_return, records, st_cap=1, trans_fee=0.01):
+    # Stages of Python_APP_1k.py, each one timed on the stock data already loaded by the read stage
+    n_rows = sum(len(stock_df) for stock_df in stock_datalist)
+
+    def stock_data():
+        return StockData(None, 1000, date_ranges, min_total_return, min_years, n_splits=len(date_ranges),
+                         stock_datalist=stock_datalist)
+
+    _, record = measure_stage('filter_stocks', n_rows, lambda: stock_data().filter_stocks())
+    records.append(record)
+
+    filtered_stocks, record = measure_stage('concat_stock_dfs_small', n_rows, lambda: stock_data().concat_stock_dfs())
+    records.append(record)
+    if filtered_stocks is None:
+        return
+
+    filtered_stocks = [filtered_stock.sort_values(by=["Date"]) for filtered_stock in filtered_stocks]
+    stocks_perf, _ = stock_data().read_analyze_stocks()
+    stocks_perf = [stocks_weight(stock_perf[stock_perf["Stock"].isin(filtered_stock['Stock_Name'].values)].copy())
+                   for stock_perf, filtered_stock in zip(stocks_perf, filtered_stocks)]
+
+    def chained_trader():
+        capital = st_cap
+        for filtered_stock, stock_perf in zip(filtered_stocks, stocks_perf):
+            _, capital, _ = Stock_Trader_1000(filtered_stock, stock_perf, st_cap=capital, trans_fee=trans_fee)
+        return capital
+
+    _, record = measure_stage('Stock_Trader_1000', sum(len(filtered_stock) for filtered_stock in filtered_stocks),
+                              chained_trader)
+    records.append(record)
+
+
+def run_benchmark(stock_path, cache_path=None, return_quantile=0.9, plot_file=None):
+    """
+    Benchmark every stage of the pipeline on the price files of a directory: read_analyze_stocks, filter_stocks,
+    concat_stock_dfs (small and large sequence), Stock_Trader_1000, StockTrader_1mil and valuation. The date ranges
+    of the small sequence split the span of the data in three and the total return threshold of each date range keeps
+    the stocks above the specified quantile, so the small sequence stages run on any data set with more than 7 years
+    (the minimum years of each date range keep the stocks present for 90% of it).
+
+    Args:
+        stock_path (str): Path to the stock data
+        cache_path (str): Path to the columnar cache of the stock data (see StockData)
+        return_quantile (float): Quantile of the total return of the stocks used as the threshold of each date range
+        plot_file (str): Path of the valuation plot (if not specified it is written to a temporary file)
+
+    Returns:
+        records (list): List of dictionaries with the measurements of each stage (see measure_stage)
+    """
+    records = []
+
+    # Read the price files (the rows of each stock are counted from the loaded data)
+    stock_datalist, record = measure_stage('read_analyze_stocks', 0,
+                                           lambda: StockData(stock_path, 1000, None, None, None,
+                                                             cache_path=cache_path).read_analyze_stocks())
+    n_rows = sum(len(stock_df) for stock_df in stock_datalist)
+    record.update({'Rows': n_rows, 'Rows_Per_Sec': n_rows / record['Wall_Time']})
+    records.append(record)
+
+    # Small sequence stages
+    date_ranges = split_date_ranges(stock_datalist)
+    StocksPerfs, _ = StockData(None, 1000, date_ranges, None, None, stock_datalist=stock_datalist).read_analyze_stocks()
+    min_years = tuple(0.9 * (pd.to_datetime(end) - pd.to_datetime(start)).days / 365.25 for start, end in date_ranges)
+    min_total_return = tuple(float(stock_perf['Total_Return'].quantile(return_quantile)) if len(stock_perf) else 0.0
+                             for stock_perf in StocksPerfs)
+    run_small_sequence(stock_datalist, date_ranges, min_years, min_total_return, records)
+
+    # Large sequence stages
+    large_stock_df, record = measure_stage('concat_stock_dfs_large', n_rows,
+                                           lambda: StockData(None, 1000000, None, None, None,
+                                                             stock_datalist=stock_datalist).concat_stock_dfs())
+    records.append(record)
+
+    ledger = TradeLedger(log_idle=False)
+    _, record = measure_stage('StockTrader_1mil', len(large_stock_df), StockTrader_1mil, large_stock_df, ledger=ledger)
+    records.append(record)
+
+    with tempfile.TemporaryDirectory() as tmp_path:
+        _, record = measure_stage('valuation', len(ledger), valuation, ledger=ledger, n_seq=1000000,
+                                  output_file=plot_file or os.path.join(tmp_path, 'valuation.png'))
+    records.append(record)
+
+    return records
+
+
+def git_commit():
+    """
+    Return the commit of the source tree so that the reports of different commits can be compared (None outside git).
+    """
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark_synthetic(sizes, data_path=None, seed=0, use_cache=False, report_file=None):
+    """
+    Generate a deterministic synthetic data set for each size and benchmark every stage of the pipeline on it.
+
+    Args:
+        sizes (list): List of (n_symbols, n_years) tuples (e.g. [(100, 10), (1000, 30), (10000, 60)])
+        data_path (str): Path to the directory of the data sets (if not specified a temporary directory is used), a data
+        set that already exists there is reused since the generator is deterministic
+        seed (int): Seed of the data sets
+        use_cache (bool): Whether the stock data is read through the columnar cache
+        report_file (str): Path of the JSON report (if not specified the report is only returned)
+
+    Returns:
+        report (dict): Dictionary with the environment of the run and the measurements of each size and stage
+    """
+    report = {
+        'commit': git_commit(),
+        'timestamp': pd.Timestamp.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'platform': platform.platform(),
+        'seed': seed,
+        'runs': []
+    }
+
+    with tempfile.TemporaryDirectory() as tmp_path:
+        for n_symbols, n_years in sizes:
+            stock_path = os.path.join(data_path or tmp_path, f"synthetic_{n_symbols}x{n_years}_{seed}")
+            if not os.path.isdir(stock_path) or len(os.listdir(stock_path)) != n_symbols:
+                generate_stock_files(stock_path, n_symbols=n_symbols, n_years=n_years, seed=seed)
+
+            cache_path = os.path.join(tmp_path, f"cache_{n_symbols}x{n_years}") if use_cache else None
+            records = run_benchmark(stock_path, cache_path=cache_path)
+            report['runs'].append({'n_symbols': n_symbols, 'n_years': n_years,
+                                   'n_rows': records[0]['Rows'], 'stages': records})
+
+    if report_file is not None:
+        with open(report_file, 'w') as file:
+            json.dump(report, file, indent=2)
+
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark every stage of the pipeline on synthetic Kaggle format data")
+    parser.add_argument('--sizes', nargs='+', default=['100x10', '1000x30'],
+                        help="Data set sizes as n_symbols x n_years (e.g. 100x10 10000x60)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--data-path', default=None, help="Directory where the synthetic data sets are kept")
+    parser.add_argument('--cache', action='store_true', help="Read the stock data through the columnar cache")
+    parser.add_argument('--output', default='benchmark.json', help="Path of the JSON report")
+    args = parser.parse_args()
+
+    sizes = [tuple(int(value) for value in size.lower().split('x')) for size in args.sizes]
+    report = benchmark_synthetic(sizes, data_path=args.data_path, seed=args.seed, use_cache=args.cache,
+                                 report_file=args.output)
+
+    for run in report['runs']:
+        print(f"{run['n_symbols']} symbols x {run['n_years']} years ({run['n_rows']} rows)")
+        print(pd.DataFrame(run['stages']).to_string(index=False))
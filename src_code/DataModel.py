@@ -0,0 +1,168 @@
+import numpy as np
+import pandas as pd
+
+# Columns of the stock dataframes stored with the configurable price and volume dtypes
+PRICE_COLUMNS = ['Open', 'High', 'Low', 'Close']
+VOLUME_COLUMNS = ['Volume']
+
+# Storage dtypes of the prices and volumes of the stock dataframes (see set_storage_dtypes)
+STORAGE_DTYPES = {'price': np.dtype(np.float64), 'volume': np.dtype(np.int64)}
+
+
+class SymbolTable:
+    """Class for a table of interned stock ids where each stock id is given a stable integer code (the codes are
+    never reused nor reordered as the table grows). The stock dataframes keep their 'Stock_Name' column as a
+    categorical of the table, so each row stores a small integer code instead of a reference to a string and the
+    joins between stocks are integer operations on the codes.
+    """
+    def __init__(self, symbols=()):
+        """
+        Args:
+                symbols (iterable): Stock ids added to the table in the order of their codes
+        """
+        self.symbols = []
+        self._codes = {}
+        self._dtype = None
+        for symbol in symbols:
+            self.code(symbol)
+
+    def __len__(self):
+        return len(self.symbols)
+
+    def code(self, symbol):
+        """
+        Return the integer code of a stock id, adding it to the table if it isn't there yet.
+        """
+        code = self._codes.get(symbol)
+        if code is None:
+            code = self._codes[symbol] = len(self.symbols)
+            self.symbols.append(symbol)
+            self._dtype = None
+
+        return code
+
+    def codes(self, names):
+        """
+        Return the integer codes of an array of stock ids. Only the distinct stock ids are looked up, and for a
+        categorical (e.g. the 'Stock_Name' column of a stock dataframe) only its categories.
+
+        Args:
+            names (array-like): Stock id of each row (a list, an array, a series or a categorical)
+
+        Returns:
+            codes (np.ndarray): Code of each row as int32
+        """
+        values = names.array if isinstance(names, pd.Series) else names
+        if isinstance(values, pd.Categorical):
+            category_codes = self.codes(np.asarray(values.categories, dtype=object))
+            return category_codes[values.codes]
+
+        inverse, uniques = pd.factorize(np.asarray(values, dtype=object))
+        unique_codes = np.array([self.code(symbol) for symbol in uniques], dtype=np.int32)
+
+        return unique_codes[inverse]
+
+    @property
+    def dtype(self):
+        """Categorical dtype with the stock ids of the table as its categories (shared until the table grows)."""
+        if self._dtype is None:
+            self._dtype = pd.CategoricalDtype(self.symbols)
+        return self._dtype
+
+    def categorical(self, codes):
+        """
+        Create a categorical of the table from an array of codes.
+        """
+        return pd.Categorical.from_codes(codes, dtype=self.dtype)
+
+
+# Symbol table shared by the stock data, the traders and the ledgers of the process
+SYMBOLS = SymbolTable()
+
+
+def set_storage_dtypes(price_dtype='float64', volume_dtype='int64'):
+    """
+    Set the dtypes of the prices and volumes of the stock dataframes created from now on. float32 prices and int32
+    volumes halve the memory of the stock data, but the prices are rounded to about 7 significant digits, so the
+    default float64/int64 is kept for the traders whose sequences are validated against the source prices (the
+    volumes that don't fit in int32 are always kept as int64).
+
+    Args:
+        price_dtype (str): 'float64' or 'float32'
+        volume_dtype (str): 'int64' or 'int32'
+    """
+    STORAGE_DTYPES['price'] = np.dtype(price_dtype)
+    STORAGE_DTYPES['volume'] = np.dtype(volume_dtype)
+
+
+def storage_array(values, kind):
+    """
+    Cast the prices (kind='price') or volumes (kind='volume') to their storage dtype (no copy if they already have it).
+    """
+    values = np.asarray(values)
+    dtype = STORAGE_DTYPES[kind]
+    if kind == 'volume' and len(values):
+        # Keep the volumes as int64 if they don't fit in the storage dtype
+        limits = np.iinfo(dtype)
+        if values.min() < limits.min or values.max() > limits.max:
+            dtype = np.dtype(np.int64)
+
+    return values.astype(dtype, copy=False)
+
+
+def intern_stock_datalist(stock_datalist, symbol_table=SYMBOLS):
+    """
+    Convert the 'Stock_Name' column of the stock dataframes to a categorical of the symbol table and the prices and
+    volumes to their storage dtypes, in place. All the dataframes share the same categorical dtype, so they can be
+    concatenated without falling back to strings.
+
+    Returns:
+        stock_datalist (list): The same list of dataframes
+    """
+    stock_dfs = [stock_df for stock_df in stock_datalist if len(stock_df)]
+    codes = symbol_table.codes([stock_df['Stock_Name'].iloc[0] for stock_df in stock_dfs])
+    dtype = symbol_table.dtype
+
+    for stock_df, code in zip(stock_dfs, codes):
+        # Dataframes that are already interned share the categories of the dtype
+        current = stock_df['Stock_Name'].dtype
+        if not isinstance(current, pd.CategoricalDtype) or current.categories is not dtype.categories:
+            stock_df['Stock_Name'] = pd.Categorical.from_codes(np.full(len(stock_df), code), dtype=dtype)
+        for column in PRICE_COLUMNS:
+            stock_df[column] = storage_array(stock_df[column].to_numpy(), 'price')
+        for column in VOLUME_COLUMNS:
+            stock_df[column] = storage_array(stock_df[column].to_numpy(), 'volume')
+
+    return stock_datalist
+
+
+def stock_code(stock_df, symbol_table=SYMBOLS):
+    """
+    Return the code of the stock of a single stock dataframe (-1 if the dataframe is empty).
+    """
+    if not len(stock_df):
+        return -1
+
+    return symbol_table.code(stock_df['Stock_Name'].iat[0])
+
+
+def sorted_symbol_codes(names):
+    """
+    Factorize an array of stock ids into codes that follow the alphabetical order of the stock ids (as
+    pd.factorize(names, sort=True)), using only the categories of a categorical.
+
+    Returns:
+        codes (np.ndarray): Code of each row
+        symbols (np.ndarray): Stock id of each code in alphabetical order
+    """
+    values = names.array if isinstance(names, pd.Series) else names
+    if isinstance(values, pd.Categorical):
+        categories = np.asarray(values.categories, dtype=object)
+        order = np.argsort(categories, kind='stable')
+        ranks = np.empty(len(order), dtype=np.int64)
+        ranks[order] = np.arange(len(order))
+        return ranks[values.codes], categories[order]
+
+    codes, symbols = pd.factorize(np.asarray(values, dtype=object), sort=True)
+
+    return codes, np.asarray(symbols, dtype=object)
@@ -0,0 +1,176 @@
+import functools
+import json
+import os
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# Profiler of the running process (None while profiling is disabled)
+_profiler = None
+
+
+def current_rss():
+    """
+    Return the resident set size of the process in bytes (None if it can't be read on this platform).
+    """
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    if os.path.exists('/proc/self/statm'):
+        with open('/proc/self/statm') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+    return None
+
+
+class Profiler:
+    """Class that records the wall time, the memory and the counters (rows, loop passes etc.) of the stages of a run.
+    Each finished stage is a record (Stage, Parent, Start, Wall_Time, RSS_MB, Peak_Alloc_MB, Error and the counters of
+    the stage) that is handed to the sink, which is either a callback called with each record or the path of a JSON file
+    where all the records are written when the profiler is closed.
+    """
+    def __init__(self, sink, trace_memory=False):
+        """
+        Args:
+                sink (str or callable): Path of the JSON file of the records or a function called with each record
+                trace_memory (bool): Whether the peak memory allocated by each stage is traced with tracemalloc
+                (slows down the run, otherwise only the RSS at the end of each stage is recorded)
+        """
+        self.sink = sink
+        self.trace_memory = trace_memory
+        self.records = []
+        self._stack = []
+        self._start = time.perf_counter()
+        self._started_tracing = trace_memory and not tracemalloc.is_tracing()
+        if self._started_tracing:
+            tracemalloc.start()
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Context manager that records a stage, stages opened inside it are recorded with it as their parent.
+
+        Yields:
+            record (dict): The record of the stage where counters can be added
+        """
+        record = {'Stage': name, 'Parent': self._stack[-1]['Stage'] if self._stack else None,
+                  'Start': time.perf_counter() - self._start}
+        if self.trace_memory:
+            # The peak traced so far belongs to the parent stage, the peak of this stage starts from the current memory
+            self._update_parent_peak()
+            tracemalloc.reset_peak()
+            record['Peak_Alloc_MB'] = 0.0
+
+        self._stack.append(record)
+        start = time.perf_counter()
+        try:
+            yield record
+        except BaseException as exception:
+            record['Error'] = str(exception) or type(exception).__name__
+            raise
+        finally:
+            record['Wall_Time'] = time.perf_counter() - start
+            rss = current_rss()
+            record['RSS_MB'] = rss / 2**20 if rss is not None else None
+            if self.trace_memory:
+                self._update_parent_peak()
+            self._stack.pop()
+            if self.trace_memory:
+                tracemalloc.reset_peak()
+                if self._stack:
+                    self._stack[-1]['Peak_Alloc_MB'] = max(self._stack[-1]['Peak_Alloc_MB'], record['Peak_Alloc_MB'])
+            self._emit(record)
+
+    def _update_parent_peak(self):
+        if self._stack:
+            peak = tracemalloc.get_traced_memory()[1] / 2**20
+            self._stack[-1]['Peak_Alloc_MB'] = max(self._stack[-1]['Peak_Alloc_MB'], peak)
+
+    def record(self, **counters):
+        """
+        Add counters (e.g. Rows=..., N_Passes=...) to the record of the innermost running stage.
+        """
+        if self._stack:
+            self._stack[-1].update(counters)
+
+    def _emit(self, record):
+        self.records.append(record)
+        if callable(self.sink):
+            self.sink(record)
+
+    def close(self):
+        """
+        Write the records to the JSON file of the sink and stop tracing the memory if it was started by the profiler.
+        """
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+        if isinstance(self.sink, (str, os.PathLike)):
+            with open(self.sink, 'w') as file:
+                json.dump({'stages': self.records}, file, indent=2, default=str)
+
+
+def enable_profiling(sink, trace_memory=False):
+    """
+    Start recording the instrumented stages of StockData, the traders and valuation (see Profiler).
+
+    Returns:
+        profiler (Profiler): The active profiler
+    """
+    global _profiler
+    disable_profiling()
+    _profiler = Profiler(sink, trace_memory)
+
+    return _profiler
+
+
+def disable_profiling():
+    """
+    Stop recording the instrumented stages and close the active profiler (writing the JSON file of its sink).
+    """
+    global _profiler
+    profiler, _profiler = _profiler, None
+    if profiler is not None:
+        profiler.close()
+
+
+@contextmanager
+def profiling(sink, trace_memory=False):
+    """
+    Context manager that records the instrumented stages run inside it, e.g. `with profiling('profile.json'): ...`.
+    """
+    profiler = enable_profiling(sink, trace_memory)
+    try:
+        yield profiler
+    finally:
+        if _profiler is profiler:
+            disable_profiling()
+
+
+def instrumented(stage):
+    """
+    Decorator that records each call of a function as a stage while profiling is enabled (otherwise the function is
+    called directly and the only overhead is a check of the active profiler).
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _profiler is None:
+                return func(*args, **kwargs)
+            with _profiler.stage(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def record(**counters):
+    """
+    Add counters to the running stage while profiling is enabled (no-op otherwise).
+    """
+    if _profiler is not None:
+        _profiler.record(**counters)
@@ -0,0 +1,139 @@
+import numpy as np
+import pandas as pd
+from Instrumentation import instrumented, record
+from WindowIndex import WindowIndex
+
+
+def rolling_windows(start_date, end_date, length_years=5, step_months=1):
+    """
+    Create the sliding date windows of a screening, e.g. every 5 year window starting on the first day of each month.
+
+    Args:
+        start_date (str): First date of the first window in the YYYY-MM-DD format
+        end_date (str): Last date the windows may reach in the YYYY-MM-DD format
+        length_years (int): Length of each window in years
+        step_months (int): Number of months between the starts of consecutive windows
+
+    Returns:
+        window_starts (np.ndarray): First date of each window (inclusive)
+        window_ends (np.ndarray): Last date of each window (inclusive)
+    """
+    starts = pd.date_range(pd.to_datetime(start_date), pd.to_datetime(end_date), freq=pd.DateOffset(months=step_months))
+    ends = starts + pd.DateOffset(years=length_years) - pd.Timedelta(days=1)
+    inside = ends <= pd.to_datetime(end_date)
+
+    return starts[inside].to_numpy().astype('datetime64[D]'), ends[inside].to_numpy().astype('datetime64[D]')
+
+
+def top_k_columns(scores, top_k):
+    """
+    Select the top_k largest scores of each row of a (windows x stocks) matrix, a bounded selection of k elements per
+    window done for all the windows at once with a partial sort (NaN scores are never selected).
+
+    Returns:
+        columns (np.ndarray): Column of each selected score in descending order of the scores (windows x top_k, -1
+        where a row has less than top_k scores)
+    """
+    scores = np.where(np.isnan(scores), -np.inf, scores)
+    top_k = min(top_k, scores.shape[1])
+    if top_k < scores.shape[1]:
+        columns = np.argpartition(-scores, top_k - 1, axis=1)[:, :top_k]
+    else:
+        columns = np.broadcast_to(np.arange(scores.shape[1]), scores.shape).copy()
+
+    # Sort the selected scores of each row
+    selected = np.take_along_axis(scores, columns, axis=1)
+    order = np.argsort(-selected, axis=1, kind='stable')
+    columns = np.take_along_axis(columns, order, axis=1)
+
+    return np.where(np.isfinite(np.take_along_axis(selected, order, axis=1)), columns, -1)
+
+
+@instrumented('screen_momentum')
+def screen_momentum(window_index, window_starts, window_ends, top_k=20, min_years=0, min_total_return=0,
+                    max_pairs=4_000_000):
+    """
+    Rank the stocks by their total return over every date window, as the performance tables of read_analyze_stocks
+    and filter_stocks would for each window, without filtering the stock data. The first and last row of every
+    (stock, window) pair are found with a binary search over the sorted (stock, day) key of the index, so the
+    Total_Return and Total_Years of all the pairs are array operations, and only the top_k stocks of each window are kept.
+    The windows are screened in chunks of at most max_pairs (stock, window) pairs to bound the memory.
+
+    Args:
+        window_index (WindowIndex): Index of the stock data (e.g. WindowIndex.from_cache or WindowIndex.from_dataframes)
+        window_starts (array-like): First date of each window (inclusive), e.g. as created by rolling_windows
+        window_ends (array-like): Last date of each window (inclusive)
+        top_k (int): Number of stocks ranked in each window
+        min_years (float): Minimum number of years the stocks have to be present in a window
+        min_total_return (float): Minimum total return of the stocks (only positive and finite returns are ranked)
+        max_pairs (int): Max number of (stock, window) pairs computed at once
+
+    Returns:
+        ranking_df (pd.DataFrame): Dataframe with the Window_Start, Window_End, Rank, Stock, Total_Return, Total_Years,
+        Start_Date and End_Date of the top_k stocks of each window
+    """
+    start_days = np.atleast_1d(pd.to_datetime(window_starts).to_numpy().astype('datetime64[D]').astype(np.int64))
+    end_days = np.atleast_1d(pd.to_datetime(window_ends).to_numpy().astype('datetime64[D]').astype(np.int64))
+    start_offsets = np.clip(start_days - window_index.first_day, 0, window_index.span - 1)
+    end_offsets = np.clip(end_days - window_index.first_day, -1, window_index.span - 2)
+
+    n_stocks = len(window_index.symbols)
+    stock_keys = np.arange(n_stocks, dtype=np.int64)[:, None] * window_index.span
+    days = window_index.dates.astype(np.int64)
+    chunk_size = max(1, max_pairs // max(n_stocks, 1))
+
+    window_rows, window_ranks, stock_columns, first_rows, last_rows = [], [], [], [], []
+    for start in range(0, len(start_days), chunk_size):
+        chunk = slice(start, start + chunk_size)
+
+        # First and last row of each (stock, window) pair, the keys are queried in sorted order (stock by stock)
+        first = np.searchsorted(window_index.keys, stock_keys + start_offsets[None, chunk], side='left')
+        last = np.searchsorted(window_index.keys, stock_keys + end_offsets[None, chunk], side='right') - 1
+        valid = last - first >= 1
+        first, last = np.where(valid, first, 0), np.where(valid, last, 0)
+
+        # Total return: (End High - Start Low) / Start Low over all the pairs (windows x stocks)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            total_return = ((window_index.highs[last] - window_index.lows[first]) / window_index.lows[first]).T
+        total_years = ((days[last] - days[first]) / 365.25).T
+        kept = (valid.T & np.isfinite(total_return) & (total_return > 0) & (total_return >= min_total_return) &
+                (total_years >= min_years))
+
+        columns = top_k_columns(np.where(kept, total_return, np.nan), top_k)
+        rows, ranks = np.nonzero(columns >= 0)
+        stocks = columns[rows, ranks]
+        window_rows.append(rows + start)
+        window_ranks.append(ranks)
+        stock_columns.append(stocks)
+        first_rows.append(first[stocks, rows])
+        last_rows.append(last[stocks, rows])
+
+    window_rows, ranks, stocks, first, last = (np.concatenate(values) if values else np.empty(0, dtype=np.int64)
+                                               for values in (window_rows, window_ranks, stock_columns, first_rows, last_rows))
+    record(Windows=len(start_days), Stocks=n_stocks, Ranked_Stocks=len(window_rows))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        total_return = (window_index.highs[last] - window_index.lows[first]) / window_index.lows[first]
+
+    return pd.DataFrame({
+        'Window_Start': start_days[window_rows].astype('datetime64[D]').astype('datetime64[ns]'),
+        'Window_End': end_days[window_rows].astype('datetime64[D]').astype('datetime64[ns]'),
+        'Rank': ranks + 1,
+        'Stock': np.asarray(window_index.symbols, dtype=object)[stocks],
+        'Total_Return': total_return,
+        'Total_Years': (days[last] - days[first]) / 365.25,
+        'Start_Date': window_index.dates[first].astype('datetime64[ns]'),
+        'End_Date': window_index.dates[last].astype('datetime64[ns]')
+    })
+
+
+def screen_rolling_momentum(cache_path, start_date, end_date, length_years=5, step_months=1, top_k=20, min_years=0,
+                            min_total_return=0, files=None):
+    """
+    Screen every sliding window of length_years starting every step_months months between start_date and end_date
+    over the cached stock data (see rolling_windows and screen_momentum).
+    """
+    window_index = WindowIndex.from_cache(cache_path, files)
+    window_starts, window_ends = rolling_windows(start_date, end_date, length_years, step_months)
+
+    return screen_momentum(window_index, window_starts, window_ends, top_k, min_years, min_total_return)
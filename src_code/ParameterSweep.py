@@ -0,0 +1,113 @@
+from concurrent.futures import ProcessPoolExecutor
+from itertools import product
+import pandas as pd
+from StockData import StockData
+from StockTrader_1k import stocks_weight, Stock_Trader_1000
+
+# Stock data loaded once by each worker process of the sweep
+_worker_stock_datalist = None
+
+
+def parameter_grid(date_ranges, min_years, min_total_return):
+    """
+    Create the parameter sets of a sweep from every combination of the candidate values.
+
+    Args:
+        date_ranges (list): List with candidate date ranges (each one a tuple of (start, end) tuples)
+        min_years (list): List with candidate minimum years tuples
+        min_total_return (list): List with candidate minimum total return tuples
+
+    Returns:
+        param_sets (list): List of dictionaries with the date_ranges, min_years and min_total_return of each parameter set
+    """
+    return [{'date_ranges': dates, 'min_years': years, 'min_total_return': total_return}
+            for dates, years, total_return in product(date_ranges, min_years, min_total_return)]
+
+
+def run_small_sequence(stock_datalist, date_ranges, min_years, min_total_return, st_cap=1, trans_fee=0.01):
+    """
+    Run the small sequence strategy of Python_APP_1k.py (filter_stocks -> stocks_weight -> chained Stock_Trader_1000)
+    for a single parameter set on already loaded stock data.
+
+    Args:
+        stock_datalist (list): List of dataframes with the stock data for each stock
+        date_ranges (tuple): Tuple with the start and end date of each time period
+        min_years (tuple): Minimum number of years the stocks have to be present in the market for each time period
+        min_total_return (tuple): Minimum total return of the stocks for each time period
+        st_cap (float): Starting capital
+        trans_fee (float): Transaction fee
+
+    Returns:
+        result (dict): Dictionary with the final capital, the number of transactions and the error (if the strategy failed)
+    """
+    try:
+        StockData_Inst = StockData(None, 1000, date_ranges, min_total_return, min_years, n_splits=len(date_ranges),
+                                   stock_datalist=stock_datalist)
+        stocks_perf, _ = StockData_Inst.read_analyze_stocks()
+        filtered_stocks = [filtered_stock.sort_values(by=["Date"]) for filtered_stock in StockData_Inst.concat_stock_dfs()]
+
+        # Keep the performances of the filtered stocks and calculate the stocks weights
+        stocks_perf = [stocks_weight(stock_perf[stock_perf["Stock"].isin(filtered_stock['Stock_Name'].values)].copy())
+                       for stock_perf, filtered_stock in zip(stocks_perf, filtered_stocks)]
+
+        # Chain the time periods through the capital at the end of each one
+        capital, n_transactions = st_cap, 0
+        for filtered_stock, stock_perf in zip(filtered_stocks, stocks_perf):
+            transaction_df, capital, _ = Stock_Trader_1000(filtered_stock, stock_perf, st_cap=capital, trans_fee=trans_fee)
+            n_transactions += len(transaction_df)
+
+        if n_transactions > 1000:
+            raise Exception(f"The sequence has {n_transactions} transactions")
+
+        return {'Final_Capital': capital, 'Transactions': n_transactions, 'Error': None}
+
+    except Exception as error:
+        return {'Final_Capital': float('nan'), 'Transactions': 0, 'Error': str(error) or type(error).__name__}
+
+
+def _init_worker(stock_datalist):
+    global _worker_stock_datalist
+    _worker_stock_datalist = stock_datalist
+
+
+def _run_param_set(param_set, st_cap, trans_fee):
+    return run_small_sequence(_worker_stock_datalist, st_cap=st_cap, trans_fee=trans_fee, **param_set)
+
+
+def sweep_small_sequence(stock_path, param_sets, n_workers=None, cache_path=None, st_cap=1, trans_fee=0.01, chunksize=1):
+    """
+    Run the small sequence strategy for many parameter sets across a process pool. The price data is loaded only once
+    and handed to each worker process when it starts, so every parameter set skips the ingestion of the stock files.
+
+    Args:
+        stock_path (str): Path to the stock data
+        param_sets (list): List of dictionaries with the date_ranges, min_years and min_total_return of each parameter set
+        (e.g. as created by parameter_grid)
+        n_workers (int): Number of worker processes (if not specified the parameter sets are run serially)
+        cache_path (str): Path to the columnar cache of the stock data (see StockData)
+        st_cap (float): Starting capital
+        trans_fee (float): Transaction fee
+        chunksize (int): Number of parameter sets sent to a worker at once
+
+    Returns:
+        sweep_df (pd.DataFrame): Dataframe with the parameters, the final capital, the number of transactions and the
+        error of each parameter set ranked by the final capital
+    """
+    # Load the price data once and convert the dates so that the workers don't repeat it
+    stock_datalist = StockData(stock_path, 1000, None, None, None, cache_path=cache_path).read_analyze_stocks()
+    for stock_df in stock_datalist:
+        stock_df['Date'] = pd.to_datetime(stock_df['Date'])
+
+    if n_workers is not None and n_workers > 1:
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker, initargs=(stock_datalist,)) as pool:
+            results = list(pool.map(_run_param_set, param_sets, [st_cap] * len(param_sets),
+                                    [trans_fee] * len(param_sets), chunksize=chunksize))
+    else:
+        results = [run_small_sequence(stock_datalist, st_cap=st_cap, trans_fee=trans_fee, **param_set)
+                   for param_set in param_sets]
+
+    # Rank the parameter sets by the final capital (failed parameter sets last)
+    sweep_df = pd.DataFrame([{**param_set, **result} for param_set, result in zip(param_sets, results)])
+    sweep_df = sweep_df.sort_values(by=['Final_Capital', 'Transactions'], ascending=[False, True], na_position='last')
+
+    return sweep_df.reset_index(drop=True)
@@ -0,0 +1,122 @@
+import hashlib
+import json
+import os
+import pickle
+from Instrumentation import instrumented, record
+from StockCache import file_signature
+
+
+def checkpoint_key(params, previous_key=None):
+    """
+    Return the key of a stage from its parameters and the key of the previous stage, so that a change of the
+    parameters of a stage invalidates the checkpoints of the stage and of all the stages after it.
+
+    Args:
+        params (dict): Parameters of the stage (JSON serializable, tuples and lists are equivalent)
+        previous_key (str): Key of the previous stage (None for the first stage)
+
+    Returns:
+        key (str): Hexadecimal digest of the parameters
+    """
+    payload = json.dumps({'params': params, 'previous': previous_key}, sort_keys=True, default=str)
+
+    return hashlib.sha1(payload.encode()).hexdigest()[:16]
+
+
+def source_signature(files):
+    """
+    Return the name, size and modification time of each source file, to be used as a parameter of the first stage
+    so that its checkpoints are invalidated whenever a source file is added, removed or changed.
+    """
+    return [[os.path.basename(file), file_signature(file)] for file in sorted(files)]
+
+
+class PipelineRunner:
+    """Class that runs the stages of an application in order and checkpoints the output of each stage in a pickle file
+    (the fastest binary format for the dataframes, ledgers and tuples handed between stages) keyed by the parameters
+    of the stage and of the stages before it. A run resumes from the latest stage whose checkpoint is valid, so e.g.
+    a change of the trading parameters skips the ingestion and the filtering of the stocks. The checkpoints are local
+    files written by the runner itself, they must not be loaded from untrusted sources.
+    """
+    def __init__(self, checkpoint_path):
+        """
+        Args:
+                checkpoint_path (str): Path to the directory of the checkpoints (created if it doesn't exist)
+        """
+        self.checkpoint_path = checkpoint_path
+        self.stages = []
+        self.loaded_stage = None
+        self.run_stages = []
+
+    def add_stage(self, name, func, params=None, output_files=()):
+        """
+        Add a stage after the current ones.
+
+        Args:
+            name (str): Name of the stage (e.g. 'stock_perf_tab', 'filt_stock', 'buy_sell_df' as the interim tables)
+            func (callable): Function called with the output of the previous stage (None for the first stage) that
+            returns the output of the stage
+            params (dict): Parameters the output of the stage depends on (besides the output of the previous stage)
+            output_files (list): Files written by the stage, its checkpoint is valid only while they all exist
+
+        Returns:
+            runner (PipelineRunner): The runner so that the stages can be chained
+        """
+        previous_key = self.stages[-1]['key'] if self.stages else None
+        self.stages.append({'name': name, 'func': func, 'params': params or {}, 'output_files': list(output_files),
+                            'key': checkpoint_key(params or {}, previous_key)})
+
+        return self
+
+    def checkpoint_file(self, stage):
+        return os.path.join(self.checkpoint_path, f"{stage['name']}_{stage['key']}.pkl")
+
+    def _load(self, stage):
+        # A checkpoint is valid if it exists, can be read and the files written by its stage still exist
+        file = self.checkpoint_file(stage)
+        if not os.path.exists(file) or not all(os.path.exists(output) for output in stage['output_files']):
+            return False, None
+        try:
+            with open(file, 'rb') as checkpoint:
+                return True, pickle.load(checkpoint)
+        except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+            return False, None
+
+    def _save(self, stage, output):
+        # Write to a temporary file first so that an interrupted write is never mistaken for a valid checkpoint
+        file = self.checkpoint_file(stage)
+        with open(file + '.tmp', 'wb') as checkpoint:
+            pickle.dump(output, checkpoint, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(file + '.tmp', file)
+
+    @instrumented('pipeline')
+    def run(self):
+        """
+        Run the stages from the latest valid checkpoint and checkpoint the output of each stage that is run.
+
+        Returns:
+            outputs (dict): Dictionary with the output of each stage by name (only the loaded and the run stages)
+        """
+        os.makedirs(self.checkpoint_path, exist_ok=True)
+
+        # Find the latest stage with a valid checkpoint
+        outputs, start = {}, 0
+        self.loaded_stage, self.run_stages = None, []
+        for i in range(len(self.stages) - 1, -1, -1):
+            found, output = self._load(self.stages[i])
+            if found:
+                outputs[self.stages[i]['name']] = output
+                self.loaded_stage, start = self.stages[i]['name'], i + 1
+                break
+
+        # Run the rest of the stages from the output of the loaded one
+        output = outputs.get(self.loaded_stage)
+        for stage in self.stages[start:]:
+            output = stage['func'](output)
+            self._save(stage, output)
+            outputs[stage['name']] = output
+            self.run_stages.append(stage['name'])
+
+        record(Loaded_Stage=self.loaded_stage, Run_Stages=self.run_stages)
+
+        return outputs
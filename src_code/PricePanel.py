@@ -0,0 +1,182 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+from StockCache import StockCache
+
+# Fields of the panel and the value of the missing (date, stock) cells of each one
+PANEL_FIELDS = {'Open': np.nan, 'High': np.nan, 'Low': np.nan, 'Close': np.nan, 'Volume': 0}
+PANEL_VERSION = 1
+
+
+class PricePanel:
+    """Class for a dense panel of the stock data with one (trading day x stock) matrix per field (Open, High, Low, Close,
+    Volume) and a presence mask of the cells that have a row in the source data. The matrices are .npy files which are
+    memory-mapped read-only, so the panel is shared by all the processes that open it through the page cache of the
+    OS (a panel handed to a worker process is pickled as its path and memory-mapped again, the data is never copied).
+    A (date, stock) lookup is two O(1) index lookups (a day number -> trading day table and a hash of the stock ids)
+    and a gather of many (date, stock) pairs is a single fancy indexing of each matrix. The rows are days so that the
+    cross-section of the stocks on a day is contiguous.
+    """
+    def __init__(self, panel_path, mmap_mode='r'):
+        """
+        Open a panel written by PricePanel.build.
+
+        Args:
+                panel_path (str): Path to the directory of the panel
+                mmap_mode (str): Memory-map mode passed to np.load (None reads the matrices in memory)
+        """
+        manifest_path = os.path.join(panel_path, 'panel_manifest.json')
+        if not os.path.exists(manifest_path):
+            raise FileNotFoundError(f"No price panel was found in {panel_path}")
+        with open(manifest_path) as file:
+            self.manifest = json.load(file)
+
+        self.panel_path = panel_path
+        self.mmap_mode = mmap_mode
+        self.symbols = pd.Index(self.manifest['symbols'])
+        self.fields = {field: np.load(self._field_path(panel_path, field), mmap_mode=mmap_mode) for field in PANEL_FIELDS}
+        self.present = np.load(self._field_path(panel_path, 'Present'), mmap_mode=mmap_mode)
+        self.calendar = np.load(self._field_path(panel_path, 'Calendar'))
+
+        # Trading day of each day number from the first to the last trading day (-1 for the days without trading)
+        days = self.calendar.astype(np.int64)
+        self.first_day = days[0] if len(days) else 0
+        self.day_lookup = np.full(days[-1] - self.first_day + 1 if len(days) else 0, -1, dtype=np.int64)
+        self.day_lookup[days - self.first_day] = np.arange(len(days))
+
+    def __getstate__(self):
+        # Worker processes memory-map the panel again instead of receiving a copy of the matrices
+        return {'panel_path': self.panel_path, 'mmap_mode': self.mmap_mode}
+
+    def __setstate__(self, state):
+        self.__init__(state['panel_path'], state['mmap_mode'])
+
+    @staticmethod
+    def _field_path(panel_path, field):
+        return os.path.join(panel_path, f"{field.lower()}.npy")
+
+    @classmethod
+    def build(cls, panel_path, cache_path, files=None):
+        """
+        Write the panel of the stock data of a StockCache.
+
+        Args:
+            panel_path (str): Path to the directory of the panel (created if it doesn't exist)
+            cache_path (str): Path to the columnar cache of the stock data
+            files (list): List with the paths of the source price files (if not specified the cache is used as is)
+
+        Returns:
+            panel (PricePanel): The panel opened read-only
+        """
+        os.makedirs(panel_path, exist_ok=True)
+        stock_cache = StockCache(cache_path)
+        columns, symbols, offsets = stock_cache.load(files)
+
+        # Remove the manifest first so that an interrupted build is never mistaken for a valid panel
+        manifest_path = os.path.join(panel_path, 'panel_manifest.json')
+        if os.path.exists(manifest_path):
+            os.remove(manifest_path)
+
+        # Trading day and stock of each row of the cache
+        calendar, day_index = np.unique(columns['Date'], return_inverse=True)
+        stock_index = np.repeat(np.arange(len(symbols), dtype=np.int64), np.diff(offsets))
+        shape = (len(calendar), len(symbols))
+        np.save(cls._field_path(panel_path, 'Calendar'), calendar)
+
+        for field, missing in PANEL_FIELDS.items():
+            values = np.asarray(columns[field])
+            matrix = np.lib.format.open_memmap(cls._field_path(panel_path, field), mode='w+', dtype=values.dtype, shape=shape)
+            matrix[:] = missing
+            matrix[day_index, stock_index] = values
+            matrix.flush()
+            del matrix
+
+        present = np.lib.format.open_memmap(cls._field_path(panel_path, 'Present'), mode='w+', dtype=bool, shape=shape)
+        present[day_index, stock_index] = True
+        present.flush()
+        del present
+
+        # Write the manifest last, it marks the panel as complete
+        manifest = {'version': PANEL_VERSION, 'symbols': list(symbols), 'source': stock_cache.read_manifest()['files']}
+        with open(manifest_path, 'w') as file:
+            json.dump(manifest, file)
+
+        return cls(panel_path)
+
+    @classmethod
+    def from_cache(cls, panel_path, cache_path, files=None):
+        """
+        Open the panel of a StockCache, building it first if it doesn't exist or the cache has changed since it was built.
+        """
+        manifest_path = os.path.join(panel_path, 'panel_manifest.json')
+        if files is not None and not StockCache(cache_path).is_valid(files):
+            StockCache(cache_path).build(files)
+        cache_manifest = StockCache(cache_path).read_manifest()
+
+        if os.path.exists(manifest_path) and cache_manifest is not None:
+            with open(manifest_path) as file:
+                manifest = json.load(file)
+            if manifest.get('version') == PANEL_VERSION and manifest['source'] == cache_manifest['files']:
+                return cls(panel_path)
+
+        return cls.build(panel_path, cache_path, files)
+
+    @property
+    def shape(self):
+        """Number of trading days and number of stocks of the panel."""
+        return self.present.shape
+
+    def day_index(self, dates):
+        """
+        Return the trading day index of each date (-1 for the dates without trading or outside the calendar).
+        """
+        days = pd.to_datetime(np.atleast_1d(dates)).to_numpy().astype('datetime64[D]').astype(np.int64) - self.first_day
+        inside = (days >= 0) & (days < len(self.day_lookup))
+        index = np.full(len(days), -1, dtype=np.int64)
+        index[inside] = self.day_lookup[days[inside]]
+
+        return index
+
+    def stock_index(self, stocks):
+        """
+        Return the column of each stock id (-1 for unknown stock ids).
+        """
+        return self.symbols.get_indexer(np.atleast_1d(np.asarray(stocks, dtype=object)))
+
+    def gather(self, dates, stocks, fields=None):
+        """
+        Gather the fields of many (date, stock) pairs at once.
+
+        Args:
+            dates (array-like): Date of each pair
+            stocks (array-like): Stock id of each pair (or a single stock id for all the pairs)
+            fields (list): Fields gathered (if not specified all the fields)
+
+        Returns:
+            values (dict): Dictionary with the array of each field and the 'Present' mask of the pairs that have a row
+            (the fields of the missing pairs are NaN, 0 for the Volume)
+        """
+        days = self.day_index(dates)
+        stocks = self.stock_index(stocks)
+        days, stocks = np.broadcast_arrays(days, stocks)
+        valid = (days >= 0) & (stocks >= 0)
+        rows, cols = np.where(valid, days, 0), np.where(valid, stocks, 0)
+
+        present = valid & self.present[rows, cols]
+        values = {'Present': present}
+        for field in fields or PANEL_FIELDS:
+            matrix = self.fields[field]
+            values[field] = np.where(present, matrix[rows, cols], PANEL_FIELDS[field]).astype(matrix.dtype, copy=False)
+
+        return values
+
+    def lookup(self, date, stock):
+        """
+        Return the Open, High, Low, Close and Volume of a stock on a date (None if the stock has no row on the date).
+        """
+        values = self.gather([date], [stock])
+        if not values['Present'][0]:
+            return None
+
+        return {field: values[field][0].item() for field in PANEL_FIELDS}
@@ -0,0 +1,271 @@
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from Instrumentation import instrumented, record
+from PricePanel import PricePanel
+from SequenceValidator import ACTION_FIELDS
+
+# Price panel and transactions sequence loaded once by each worker process of the runner
+_worker_panel = None
+_worker_sequence = None
+
+# Quantiles of the distributions of the final capital and the drawdown
+SUMMARY_QUANTILES = (0.05, 0.25, 0.5, 0.75, 0.95)
+
+
+def sample_perturbations(n_scenarios, seed=0, max_shift_days=5, trans_fee=(0.0, 0.02),
+                         max_volume_percentage=(0.05, 0.1), max_slippage=0.25):
+    """
+    Draw random perturbations of the trading conditions of a sequence. Each scenario has:
+    1) Shift_Days: number of trading days every transaction is moved by (uniform in [-max_shift_days, max_shift_days])
+    2) Trans_Fee: transaction fee as a percentage of the price (uniform in the trans_fee range)
+    3) Max_Volume_Percentage: max percentage of the daily volume of a transaction (uniform in its range)
+    4) Slippage: fraction of the distance from the chosen price to the worst price of the day (the High for the
+    purchases and the Low for the sellings) that is paid on every transaction (uniform in [0, max_slippage])
+
+    Args:
+        n_scenarios (int): Number of scenarios
+        seed (int): Seed of the random generator
+        max_shift_days (int): Max number of trading days the transactions are shifted by
+        trans_fee (tuple): Lowest and highest transaction fee
+        max_volume_percentage (tuple): Lowest and highest max percentage of the daily volume of a transaction
+        max_slippage (float): Highest slippage
+
+    Returns:
+        scenarios_df (pd.DataFrame): Dataframe with the Shift_Days, Trans_Fee, Max_Volume_Percentage and Slippage of
+        each scenario
+    """
+    rng = np.random.default_rng(seed)
+
+    return pd.DataFrame({
+        'Shift_Days': rng.integers(-max_shift_days, max_shift_days + 1, n_scenarios),
+        'Trans_Fee': rng.uniform(*trans_fee, n_scenarios),
+        'Max_Volume_Percentage': rng.uniform(*max_volume_percentage, n_scenarios),
+        'Slippage': rng.uniform(0, max_slippage, n_scenarios)
+    })
+
+
+def encode_sequence(sequence_df, panel):
+    """
+    Convert a transactions sequence (e.g. the transaction_df of Stock_Trader_1000 or StockTrader_1mil, or a sequence
+    file read by load_sequence) to the arrays replayed by the runner.
+
+    Args:
+        sequence_df (pd.DataFrame): Dataframe with the Date, Transaction, Stock and Volume of each transaction
+        panel (PricePanel): Price panel of the stock data
+
+    Returns:
+        sequence (dict): Dictionary with the trading day, the panel column, the position among the stocks of the
+        sequence, the price field, whether it's a purchase and the volume of each transaction (and the panel column of
+        each stock of the sequence)
+    """
+    transactions = sequence_df['Transaction'].astype(str).to_numpy()
+    unknown = ~np.isin(transactions, list(ACTION_FIELDS))
+    if unknown.any():
+        raise ValueError(f"Unknown transaction type '{transactions[unknown][0]}'")
+
+    days = panel.day_index(sequence_df['Date'])
+    stocks = panel.stock_index(sequence_df['Stock'])
+    if np.any(days < 0) or np.any(stocks < 0):
+        raise ValueError("The sequence trades on dates or stocks that are not in the price panel")
+
+    field_codes, fields = pd.factorize(np.array([ACTION_FIELDS[action] for action in transactions], dtype=object))
+    local_stocks, sequence_stocks = pd.factorize(stocks)
+
+    return {
+        'day': days,
+        'stock': stocks,
+        'local_stock': local_stocks,
+        'n_stocks': local_stocks.max() + 1 if len(local_stocks) else 0,
+        'stocks': np.asarray(sequence_stocks, dtype=np.int64),
+        'field': field_codes,
+        'fields': list(fields),
+        'is_buy': np.char.startswith(transactions.astype(str), 'buy'),
+        'volume': np.nan_to_num(sequence_df['Volume'].to_numpy(dtype=np.float64))
+    }
+
+
+def replay_scenarios(panel, sequence, scenarios_df, st_cap=1, block_size=65536):
+    """
+    Replay a transactions sequence under a batch of scenarios at once. The transactions are replayed in order, each one
+    as array operations over the scenarios, with the volume of each transaction cut to what the scenario allows: the
+    volume limit of the shifted day, the capital for the purchases and the held stocks for the sellings (transactions
+    on a shifted day where the stock has no prices are skipped). The prices of a block of transactions are gathered
+    from the panel for all the scenarios at once. The volume of each transaction depends on the capital left by the
+    previous ones, so the transactions are looped over and the time grows with the length of the sequence.
+    The equity after each transaction is the capital plus the market value of the held stocks at the Close of the
+    shifted day (the last Close of a held stock is kept on the days it has no prices), so the drawdown is the largest
+    drop of the equity from its previous peak.
+
+    Args:
+        panel (PricePanel): Price panel of the stock data
+        sequence (dict): Transactions sequence (see encode_sequence)
+        scenarios_df (pd.DataFrame): Dataframe with the perturbations of each scenario (see sample_perturbations)
+        st_cap (float): Starting capital
+        block_size (int): Number of transactions whose prices are gathered at once
+
+    Returns:
+        results (dict): Dictionary with the Final_Capital, Max_Drawdown, Transactions (executed), Held_Cost and
+        Held_Value (cost and market value of the stocks that are still held at the end) of each scenario
+    """
+    n_scenarios = len(scenarios_df)
+    shifts = scenarios_df['Shift_Days'].to_numpy(dtype=np.int64)[:, None]
+    fees = scenarios_df['Trans_Fee'].to_numpy(dtype=np.float64)
+    volume_percentages = scenarios_df['Max_Volume_Percentage'].to_numpy(dtype=np.float64)
+    slippages = scenarios_df['Slippage'].to_numpy(dtype=np.float64)
+
+    capital = np.full(n_scenarios, float(st_cap))
+    holdings = np.zeros((n_scenarios, sequence['n_stocks']))
+    costs = np.zeros((n_scenarios, sequence['n_stocks']))
+    held_cost = np.zeros(n_scenarios)
+    marks = np.zeros((n_scenarios, sequence['n_stocks']))
+    held_stocks, held, held_columns = set(), None, None
+    held_value = np.zeros(n_scenarios)
+    closes_matrix = panel.fields['Close']
+    peak = capital.copy()
+    max_drawdown = np.zeros(n_scenarios)
+    executed = np.zeros(n_scenarios, dtype=np.int64)
+    n_days = panel.shape[0]
+
+    for start in range(0, len(sequence['day']), block_size):
+        block = slice(start, start + block_size)
+        stocks = sequence['stock'][block][None, :]
+        days = sequence['day'][block][None, :] + shifts
+        inside = (days >= 0) & (days < n_days)
+        days = np.where(inside, days, 0)
+
+        # Prices and volume limits of the block for all the scenarios (scenarios x transactions)
+        present = inside & panel.present[days, stocks]
+        highs, lows = panel.fields['High'][days, stocks], panel.fields['Low'][days, stocks]
+        chosen = np.choose(sequence['field'][block][None, :],
+                           [panel.fields[field][days, stocks] for field in sequence['fields']])
+        is_buy = sequence['is_buy'][block]
+        with np.errstate(invalid='ignore'):
+            prices = np.where(is_buy, chosen + slippages[:, None] * (highs - chosen),
+                              chosen - slippages[:, None] * (chosen - lows))
+            prices *= np.where(is_buy, 1 + fees[:, None], 1 - fees[:, None])
+        limits = np.floor(volume_percentages[:, None] * panel.fields['Volume'][days, stocks])
+        present &= np.isfinite(prices) & (prices > 0)
+        limits = np.where(present, np.minimum(limits, sequence['volume'][block]), 0)
+        prices = np.where(present, prices, 1)
+
+        for i, (stock, buy) in enumerate(zip(sequence['local_stock'][block], is_buy)):
+            price = prices[:, i]
+            if buy:
+                volume = np.minimum(limits[:, i], np.floor(capital / price))
+                volume -= volume * price > capital
+                amount = volume * price
+                capital -= amount
+                holdings[:, stock] += volume
+                costs[:, stock] += amount
+                held_cost += amount
+                marks[:, stock] = np.where(volume > 0, price, marks[:, stock])
+                if stock not in held_stocks and volume.any():
+                    held_stocks.add(stock)
+                    held = None
+            else:
+                volume = np.minimum(limits[:, i], holdings[:, stock])
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    sold_cost = np.where(volume > 0, costs[:, stock] * volume / holdings[:, stock], 0)
+                capital += volume * price
+                holdings[:, stock] -= volume
+                costs[:, stock] -= sold_cost
+                held_cost -= sold_cost
+                if stock in held_stocks and not holdings[:, stock].any():
+                    held_stocks.discard(stock)
+                    held = None
+            executed += volume > 0
+
+            # Market value of the held stocks at the Close of the shifted day of the transaction
+            if held_stocks:
+                if held is None:
+                    held = np.fromiter(held_stocks, dtype=np.int64, count=len(held_stocks))
+                    held_columns = sequence['stocks'][held][None, :]
+                closes = closes_matrix[days[:, i, None], held_columns]
+                held_marks = marks[:, held]
+                np.copyto(held_marks, closes, where=inside[:, i, None] & np.isfinite(closes))
+                marks[:, held] = held_marks
+                held_value = (holdings[:, held] * held_marks).sum(axis=1)
+            else:
+                held_value = np.zeros(n_scenarios)
+
+            # Drawdown of the equity from its previous peak
+            equity = capital + held_value
+            np.maximum(peak, equity, out=peak)
+            np.maximum(max_drawdown, 1 - equity / peak, out=max_drawdown)
+
+    return {'Final_Capital': capital, 'Max_Drawdown': max_drawdown, 'Transactions': executed, 'Held_Cost': held_cost,
+            'Held_Value': held_value}
+
+
+def _init_worker(panel, sequence):
+    global _worker_panel, _worker_sequence
+    _worker_panel = panel
+    _worker_sequence = sequence
+
+
+def _replay_batch(scenarios_df, st_cap):
+    return pd.DataFrame(replay_scenarios(_worker_panel, _worker_sequence, scenarios_df, st_cap))
+
+
+@instrumented('robustness')
+def run_robustness(sequence_df, panel, scenarios_df=None, n_scenarios=1000, st_cap=1, n_workers=None, batch_size=64,
+                   seed=0, **perturbations):
+    """
+    Re-simulate a transactions sequence under many random perturbations of the trading conditions (see
+    sample_perturbations) across a process pool. The workers share the memory-mapped price panel (it's pickled as its
+    path) and receive the encoded sequence once when they start, then each one replays batches of scenarios, so the
+    throughput grows with the number of cores.
+
+    Args:
+        sequence_df (pd.DataFrame): Dataframe with the Date, Transaction, Stock and Volume of each transaction
+        panel (PricePanel or str): Price panel of the stock data or the path to it
+        scenarios_df (pd.DataFrame): Dataframe with the perturbations of each scenario (if not specified they are drawn
+        by sample_perturbations)
+        n_scenarios (int): Number of scenarios drawn
+        st_cap (float): Starting capital
+        n_workers (int): Number of worker processes (if not specified the batches are run serially)
+        batch_size (int): Number of scenarios replayed at once by a worker
+        seed (int): Seed of the random generator
+        **perturbations: Ranges of the perturbations passed to sample_perturbations
+
+    Returns:
+        results_df (pd.DataFrame): Dataframe with the perturbations, the Final_Capital, Max_Drawdown, Transactions,
+        Held_Cost and Held_Value of each scenario (see summarize_robustness for their distributions)
+    """
+    if isinstance(panel, str):
+        panel = PricePanel(panel)
+    if scenarios_df is None:
+        scenarios_df = sample_perturbations(n_scenarios, seed, **perturbations)
+    scenarios_df = scenarios_df.reset_index(drop=True)
+
+    sequence = encode_sequence(sequence_df, panel)
+    batches = [scenarios_df.iloc[start:start + batch_size] for start in range(0, len(scenarios_df), batch_size)]
+    record(Scenarios=len(scenarios_df), Transactions=len(sequence_df), Batches=len(batches))
+
+    if n_workers is not None and n_workers > 1:
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker, initargs=(panel, sequence)) as pool:
+            results = list(pool.map(_replay_batch, batches, [st_cap] * len(batches)))
+    else:
+        results = [pd.DataFrame(replay_scenarios(panel, sequence, batch, st_cap)) for batch in batches]
+
+    results_df = pd.concat(results, ignore_index=True) if results else pd.DataFrame(
+        columns=['Final_Capital', 'Max_Drawdown', 'Transactions', 'Held_Cost', 'Held_Value'])
+
+    return pd.concat([scenarios_df, results_df], axis=1)
+
+
+def summarize_robustness(results_df, quantiles=SUMMARY_QUANTILES):
+    """
+    Summarize the distributions of the final capital and the drawdown of the scenarios.
+
+    Returns:
+        summary_df (pd.DataFrame): Dataframe with the mean, the quantiles, the min and the max of the Final_Capital
+        and the Max_Drawdown
+    """
+    columns = ['Final_Capital', 'Max_Drawdown']
+    summary_df = results_df[columns].quantile(list(quantiles))
+    summary_df.index = [f"q{round(q * 100):02d}" for q in quantiles]
+
+    return pd.concat([results_df[columns].mean().to_frame('mean').T, summary_df,
+                      results_df[columns].min().to_frame('min').T, results_df[columns].max().to_frame('max').T])
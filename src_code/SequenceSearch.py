@@ -0,0 +1,210 @@
+import numpy as np
+from Instrumentation import instrumented, record
+from StockCache import StockCache
+from TradeLedger import TradeLedger, ACTION_CODES
+from WindowIndex import WindowIndex
+
+
+def window_candidates(window_index):
+    """
+    Create the candidate trades (buy at the Low of a row, sell at the High of a later or the same row of the same stock)
+    from the range extrema of dyadic windows. The rows of each stock are split in aligned windows of 2, 4, 8, ... rows
+    and each window gives the trade buying at the lowest Low of its left half and selling at the highest High of its
+    right half. Every pair of rows of a stock is split by exactly one such window, so the candidates include the trade
+    with the best return of any pair of rows, while their number stays about twice the number of rows (one per
+    window and one intra-day trade per row).
+
+    Args:
+        window_index (WindowIndex): Index of the Low and High prices of the stocks
+
+    Returns:
+        buy_rows (np.ndarray): Row of the purchase of each candidate
+        sell_rows (np.ndarray): Row of the selling of each candidate
+    """
+    offsets = window_index.offsets
+    lengths = np.diff(offsets)
+    n_rows = offsets[-1]
+
+    # Intra-day trades buying at the Low and selling at the High of each row
+    buy_rows, sell_rows = [np.arange(n_rows)], [np.arange(n_rows)]
+
+    level = 1
+    while len(lengths) and (1 << (level - 1)) < lengths.max():
+        size, half = 1 << level, 1 << (level - 1)
+
+        # Windows of each stock with a non empty right half
+        n_windows = np.where(lengths > half, -(-(lengths - half) // size), 0)
+        stocks = np.repeat(np.arange(len(lengths)), n_windows)
+        ranks = np.arange(n_windows.sum()) - np.repeat(np.cumsum(n_windows) - n_windows, n_windows)
+        starts = offsets[stocks] + ranks * size
+        ends = np.minimum(starts + size, offsets[stocks + 1]) - 1
+
+        buy_rows.append(window_index.min_low.query(starts, starts + half - 1))
+        sell_rows.append(window_index.max_high.query(starts + half, ends))
+        level += 1
+
+    return np.concatenate(buy_rows), np.concatenate(sell_rows)
+
+
+def prune_candidates(buy_prices, sell_prices, max_stocks, max_candidates):
+    """
+    Keep the profitable candidates with the best return (which matter while the capital is small) and the ones with the
+    largest profit at the volume limit (which matter once the volume limits the number of stocks bought).
+
+    Args:
+        buy_prices (np.ndarray): Buying price of each candidate including the fee
+        sell_prices (np.ndarray): Selling price of each candidate including the fee
+        max_stocks (np.ndarray): Maximum number of stocks allowed by the volume of each candidate
+        max_candidates (int): Number of candidates kept by each criterion
+
+    Returns:
+        kept (np.ndarray): Indices of the kept candidates
+    """
+    valid = np.flatnonzero((buy_prices > 0) & (sell_prices > buy_prices) & (max_stocks >= 1))
+    kept = []
+    for score in (sell_prices[valid] / buy_prices[valid], max_stocks[valid] * (sell_prices[valid] - buy_prices[valid])):
+        if len(valid) > max_candidates:
+            kept.append(valid[np.argpartition(-score, max_candidates - 1)[:max_candidates]])
+        else:
+            kept.append(valid)
+
+    return np.unique(np.concatenate(kept))
+
+
+def chain_trades(buy_days, sell_days, buy_prices, sell_prices, max_stocks, n_days, st_cap, max_trades):
+    """
+    Dynamic programming over the number of trades and the trading days that finds the chain of non overlapping
+    candidate trades (each one buys after the previous one sells) with the largest final capital. The result is the
+    optimum over the given candidates (e.g. the dyadic windows of window_candidates), not over every possible trade.
+    The capital after a trade only grows with the capital before it, so best[k][d] (the largest capital after day d
+    with k candidate trades) is exact over the candidates:
+    best[k][d] = max(best[k - 1][d], best[k][d - 1], the capital after the best trade selling on day d that is bought
+    with best[k - 1][buy day - 1]). Each round evaluates all the candidates at once.
+
+    Args:
+        buy_days (np.ndarray): Trading day of the purchase of each candidate
+        sell_days (np.ndarray): Trading day of the selling of each candidate
+        buy_prices (np.ndarray): Buying price of each candidate including the fee
+        sell_prices (np.ndarray): Selling price of each candidate including the fee
+        max_stocks (np.ndarray): Maximum number of stocks allowed by the volume of each candidate
+        n_days (int): Number of trading days
+        st_cap (float): Starting capital
+        max_trades (int): Maximum number of trades
+
+    Returns:
+        trades (list): Indices of the candidates of the best chain in chronological order
+        volumes (list): Number of stocks of each trade of the chain
+        capital (float): Final capital
+    """
+    # Group the candidates by the selling day (the candidates are sorted once so that each round reads them in order)
+    order = np.argsort(sell_days, kind='stable')
+    buy_days, sell_days, buy_prices, sell_prices, max_stocks = (values[order] for values in
+                                                                (buy_days, sell_days, buy_prices, sell_prices, max_stocks))
+    profits = sell_prices - buy_prices
+    group_days, group_starts = np.unique(sell_days, return_index=True)
+    group_of = np.repeat(np.arange(len(group_days)), np.diff(np.append(group_starts, len(order))))
+
+    # best[d] is the capital after day d - 1 (best[0] is the starting capital)
+    best = np.full(n_days + 1, float(st_cap))
+    sources = []
+    for _ in range(max_trades):
+        # Capital after each candidate bought with the best capital before its buying day
+        capital = best[buy_days]
+        volumes = np.minimum(np.floor(capital / buy_prices), max_stocks)
+        volumes -= volumes * buy_prices > capital
+        after = capital + volumes * profits
+
+        # Best candidate selling on each day and the best one selling up to each day
+        day_best = np.full(n_days + 1, -np.inf)
+        day_source = np.full(n_days + 1, -1, dtype=np.int64)
+        day_best[group_days + 1] = np.maximum.reduceat(after, group_starts)
+        is_best = after == day_best[group_days + 1][group_of]
+        day_source[group_days[group_of[is_best]] + 1] = np.flatnonzero(is_best)
+        running_best = np.maximum.accumulate(day_best)
+        running_day = np.maximum.accumulate(np.where(day_best == running_best, np.arange(n_days + 1), 0))
+
+        improved = running_best > best
+        if not improved.any():
+            break
+        sources.append(np.where(improved, day_source[running_day], -1))
+        best = np.where(improved, running_best, best)
+
+    # Follow the trades back from the last day
+    trades, day = [], n_days
+    for k in range(len(sources) - 1, -1, -1):
+        trade = sources[k][day]
+        if trade >= 0:
+            trades.append(trade)
+            day = buy_days[trade]
+    trades.reverse()
+
+    # Replay the chain to get the number of stocks of each trade
+    capital, volumes = float(st_cap), []
+    for trade in trades:
+        volume = min(np.floor(capital / buy_prices[trade]), max_stocks[trade])
+        volume -= volume * buy_prices[trade] > capital
+        capital += volume * (sell_prices[trade] - buy_prices[trade])
+        volumes.append(volume)
+
+    return order[trades].tolist(), volumes, capital
+
+
+@instrumented('search_small_sequence')
+def search_small_sequence(cache_path, files=None, st_cap=1, trans_fee=0.01, max_transactions=1000,
+                          max_volume_percentage=0.1, max_candidates=200_000, ledger=None):
+    """
+    Search the small sequence with the largest final capital among chains of trades which buy a stock at the Low of a
+    day and sell it at the High of the same or a later day, with every transaction within the volume limit and the
+    transactions budget. The candidate trades come from the range extrema of the stocks (see window_candidates) and
+    the best chain is found by dynamic programming (see chain_trades), so no date ranges or filters have to be tuned.
+
+    Args:
+        cache_path (str): Path to the columnar cache of the stock data (see StockCache)
+        files (list): List with the paths of the source price files (if not specified the cache is used as is)
+        st_cap (float): Starting capital
+        trans_fee (float): Transaction fee as a percentage of the price
+        max_transactions (int): Maximum number of transactions (each trade is a buy and a sell transaction)
+        max_volume_percentage (float): Max percentage of the daily volume of a transaction
+        max_candidates (int): Number of candidate trades kept by each pruning criterion (see prune_candidates)
+        ledger (TradeLedger): Ledger where the transactions are logged (if not specified a new one is used)
+
+    Returns:
+        transaction_df (pd.DataFrame): Dataframe with the Date, Transaction, Stock and Volume of each transaction
+        capital (float): Final capital
+    """
+    columns, symbols, offsets = StockCache(cache_path).load(files)
+    window_index = WindowIndex(columns['Date'], columns['Low'], columns['High'], offsets, symbols)
+    volumes = np.asarray(columns['Volume'], dtype=np.float64)
+
+    # Candidate trades and their prices including the fee
+    buy_rows, sell_rows = window_candidates(window_index)
+    buy_prices = window_index.lows[buy_rows] * (1 + trans_fee)
+    sell_prices = window_index.highs[sell_rows] * (1 - trans_fee)
+    max_stocks = np.floor(max_volume_percentage * np.minimum(volumes[buy_rows], volumes[sell_rows]))
+    kept = prune_candidates(buy_prices, sell_prices, max_stocks, max_candidates)
+    record(Rows=len(volumes), Candidates=len(buy_rows), Kept_Candidates=len(kept))
+    buy_rows, sell_rows = buy_rows[kept], sell_rows[kept]
+    buy_prices, sell_prices, max_stocks = buy_prices[kept], sell_prices[kept], max_stocks[kept]
+
+    # Index the trading days of all the stocks
+    days, day_index = np.unique(window_index.dates.astype(np.int64), return_inverse=True)
+    trades, trade_volumes, capital = chain_trades(day_index[buy_rows], day_index[sell_rows], buy_prices, sell_prices,
+                                                  max_stocks, len(days), st_cap, max_transactions // 2)
+
+    # Log a purchase and a selling for each trade of the chain
+    transaction_log = ledger if ledger is not None else TradeLedger(log_idle=False)
+    log_start = len(transaction_log)
+    rows = np.column_stack([buy_rows[trades], sell_rows[trades]]).ravel().astype(np.int64)
+    trade_volumes = np.repeat(np.asarray(trade_volumes, dtype=np.int64), 2)
+    symbol_codes = transaction_log.symbol_codes(symbols)
+    stock_codes = np.repeat(np.arange(len(symbols)), np.diff(offsets))
+    transaction_log.extend(window_index.dates[rows], symbol_codes[stock_codes[rows]],
+                           np.tile([ACTION_CODES['buy-low'], ACTION_CODES['sell-high']], len(trades)), trade_volumes,
+                           trade_volumes * np.column_stack([buy_prices[trades], sell_prices[trades]]).ravel(),
+                           np.asarray(columns['Close'])[rows])
+    record(Trades=len(trades))
+
+    # The volumes are written as floats in the small sequence as in Stock_Trader_1000
+    transaction_df = transaction_log.transactions(log_start).astype({'Volume': float})
+
+    return transaction_df, capital
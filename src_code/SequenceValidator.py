@@ -0,0 +1,135 @@
+import numpy as np
+import pandas as pd
+from StockCache import StockCache
+
+# Price field of each transaction type
+PRICE_FIELDS = ('Open', 'High', 'Low', 'Close')
+ACTION_FIELDS = {f"{side}-{field.lower()}": field for side in ('buy', 'sell') for field in PRICE_FIELDS}
+
+
+def load_sequence(sequence_file):
+    """
+    Read a transactions sequence file (e.g. small.txt or large.txt) where the first line is the number of transactions
+    and each following line is a 'YYYY-MM-DD action STOCK VOLUME' transaction.
+
+    Args:
+        sequence_file (str): Path of the sequence file
+
+    Returns:
+        n_declared (int): Number of transactions declared in the first line
+        sequence_df (pd.DataFrame): Dataframe with the Date, Transaction, Stock and Volume of each transaction
+    """
+    with open(sequence_file) as file:
+        n_declared = int(file.readline())
+        sequence_df = pd.read_csv(file, sep=' ', header=None, names=['Date', 'Transaction', 'Stock', 'Volume'],
+                                  dtype=str, keep_default_na=False)
+
+    # Unparsable dates and volumes become NaT/NaN and are reported as malformed transactions
+    sequence_df['Date'] = pd.to_datetime(sequence_df['Date'], format='%Y-%m-%d', errors='coerce')
+    sequence_df['Volume'] = pd.to_numeric(sequence_df['Volume'], errors='coerce')
+
+    return n_declared, sequence_df
+
+
+def validate_sequence(sequence_file, cache_path, st_cap=1, trans_fee=0.0, max_volume_percentage=0.1, tolerance=1e-9):
+    """
+    Replay a transactions sequence against the cached price data and check that it is legal:
+    1) the transactions are well formed, in chronological order and trade on a date where the stock has prices
+    2) the volume bought (and sold) of a stock on a date is at most 10% of its daily volume
+    3) no stocks are sold that aren't held
+    4) the balance never goes negative
+    All the checks are computed with array operations over the whole sequence.
+
+    Args:
+        sequence_file (str): Path of the sequence file
+        cache_path (str): Path of the columnar cache of the stock data (see StockCache)
+        st_cap (float): Starting capital
+        trans_fee (float): Transaction fee as a percentage of the price
+        max_volume_percentage (float): Max percentage of the daily volume of a transaction
+        tolerance (float): Relative tolerance of the balance check for floating point rounding
+
+    Returns:
+        report (dict): Dictionary with whether the sequence is valid, the number of transactions, the final capital and
+        the first violation (its line in the file, the transaction and the reason, None if the sequence is valid)
+    """
+    n_declared, sequence_df = load_sequence(sequence_file)
+    n_transactions = len(sequence_df)
+    violations = []
+
+    # Locate the price row of each transaction through a sorted (symbol, day) key of the cached data
+    columns, symbols, _ = StockCache(cache_path).load()
+    if len(columns['Date']) == 0:
+        raise ValueError(f"The stock cache in {cache_path} is empty")
+    days = columns['Date'].astype(np.int64)
+    first_day = days.min()
+    span = days.max() - first_day + 1
+    keys = columns['Symbol'].astype(np.int64) * span + (days - first_day)
+    order = np.argsort(keys, kind='stable') if np.any(keys[1:] < keys[:-1]) else None
+    sorted_keys = keys[order] if order is not None else keys
+
+    codes = pd.Index(symbols).get_indexer(sequence_df['Stock'])
+    transaction_days = sequence_df['Date'].to_numpy().astype('datetime64[D]').astype(np.int64)
+    has_date = sequence_df['Date'].notna().to_numpy()
+    in_span = has_date & (transaction_days >= first_day) & (transaction_days < first_day + span)
+    transaction_keys = codes.astype(np.int64) * span + (transaction_days - first_day)
+    positions = np.minimum(np.searchsorted(sorted_keys, transaction_keys), len(sorted_keys) - 1)
+    found = (codes >= 0) & in_span & (sorted_keys[positions] == transaction_keys)
+    rows = order[positions] if order is not None else positions
+
+    fields = sequence_df['Transaction'].map(ACTION_FIELDS)
+    known_action = fields.notna().to_numpy()
+    is_buy = sequence_df['Transaction'].str.startswith('buy').to_numpy(dtype=bool)
+    volumes = sequence_df['Volume'].to_numpy()
+    well_formed = has_date & known_action & np.isfinite(volumes) & (volumes > 0) & (volumes == np.floor(volumes))
+
+    # 1) Malformed transactions, dates going back in time and stocks without prices on the transaction date
+    violations.append((~well_formed, "malformed transaction"))
+    dates = sequence_df['Date'].to_numpy()
+    violations.append((np.r_[False, dates[1:] < dates[:-1]], "date earlier than the previous transaction"))
+    violations.append((well_formed & ~found, "no price data for the stock on the transaction date"))
+
+    valid = well_formed & found
+    field_index = fields.map({field: i for i, field in enumerate(PRICE_FIELDS)}).fillna(0).to_numpy(dtype=np.int64)
+    rows = np.where(valid, rows, 0)
+    price_table = np.stack([columns[field][rows] for field in PRICE_FIELDS])
+    prices = np.where(valid, price_table[field_index, np.arange(n_transactions)], 0.0)
+    daily_volumes = np.where(valid, columns['Volume'][rows], 0)
+    volumes = np.where(valid, volumes, 0.0)
+
+    # 2) Volume of the purchases (and of the sellings) of a stock on a date at most 10% of the daily volume: running
+    # total of the volumes of each (date, stock, side) in sequence order
+    day_volumes = pd.Series(volumes).groupby([dates, sequence_df['Stock'].to_numpy(), is_buy], dropna=False).cumsum()
+    violations.append((valid & (day_volumes.to_numpy() > np.floor(max_volume_percentage * daily_volumes)),
+                       f"volume exceeds {max_volume_percentage:.0%} of the daily volume"))
+
+    # 3) Holdings of each stock never negative: cumulative signed volume within each stock in sequence order
+    signed_volumes = pd.Series(np.where(is_buy, volumes, -volumes))
+    holdings = signed_volumes.groupby(sequence_df['Stock'].to_numpy()).cumsum().to_numpy()
+    violations.append((holdings < 0, "selling stocks that aren't held"))
+
+    # 4) Balance never negative
+    amounts = np.where(is_buy, -volumes * prices * (1 + trans_fee), volumes * prices * (1 - trans_fee))
+    balances = st_cap + np.cumsum(amounts)
+    turnover = np.maximum(1, np.cumsum(np.abs(amounts)))
+    violations.append((balances < -tolerance * turnover, "negative balance"))
+
+    # Report the first violation in sequence order (the header is the first line of the file)
+    first_violation = None
+    if n_declared != n_transactions:
+        first_violation = {'line': 1, 'transaction': str(n_declared),
+                           'reason': f"header declares {n_declared} transactions but the file has {n_transactions}"}
+    first_index = min((np.argmax(mask) for mask, _ in violations if mask.any()), default=None)
+    if first_violation is None and first_index is not None:
+        reason = next(reason for mask, reason in violations if mask[first_index])
+        transaction = sequence_df.iloc[first_index]
+        first_violation = {'line': int(first_index) + 2,
+                           'transaction': f"{transaction['Date'].date() if pd.notna(transaction['Date']) else 'NaT'} "
+                                          f"{transaction['Transaction']} {transaction['Stock']} {transaction['Volume']}",
+                           'reason': reason}
+
+    return {
+        'valid': first_violation is None,
+        'n_transactions': n_transactions,
+        'final_capital': float(balances[-1]) if n_transactions else float(st_cap),
+        'first_violation': first_violation
+    }
@@ -0,0 +1,353 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+
+# Columns stored in the cache and the dtype of each one
+CACHE_COLUMNS = {'Date': 'datetime64[D]', 'Open': 'float64', 'High': 'float64', 'Low': 'float64',
+                 'Close': 'float64', 'Volume': 'int64'}
+CACHE_VERSION = 1
+
+
+def stock_id(file):
+    """
+    Return the stock id (e.g. 'AAPL') for a Kaggle price file (e.g. '.../aapl.us.txt').
+    """
+    return os.path.basename(file).split('.')[0].upper()
+
+
+def file_signature(file):
+    """
+    Return the size and modification time of a file which are used to detect changes in the source files.
+    """
+    stat = os.stat(file)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def scan_file_span(file, tail_size=4096):
+    """
+    Pre-scan a Kaggle price file (rows sorted by date) reading only its header, its first data line and its last data
+    line (by seeking to the end of the file), so that the files outside the dates of interest can be skipped without
+    being parsed.
+
+    Args:
+        file (str): Path of the price file
+        tail_size (int): Number of bytes read from the end of the file to find the last line (doubled if a line is longer)
+
+    Returns:
+        first_date (str): Date of the first row in the YYYY-MM-DD format (None if the file has no rows)
+        last_date (str): Date of the last row (None if the file has no rows)
+        n_rows (int): Number of rows estimated from the size of the file and the length of the first and last lines
+    """
+    with open(file, 'rb') as stock_file:
+        header = stock_file.readline()
+        first_line = stock_file.readline().strip()
+        if not first_line:
+            return None, None, 0
+
+        # Read blocks from the end of the file until they hold a complete last line
+        size = stock_file.seek(0, os.SEEK_END)
+        data_start = len(header)
+        while True:
+            start = max(data_start, size - tail_size)
+            stock_file.seek(start)
+            lines = stock_file.read(size - start).strip().split(b'\n')
+            if len(lines) > 1 or start == data_start:
+                break
+            tail_size *= 2
+        last_line = lines[-1].strip()
+
+    # Each line ends with a newline (the last one possibly without it)
+    mean_length = (len(first_line) + len(last_line)) / 2 + 1
+    n_rows = max(1, round((size - data_start) / mean_length))
+
+    return first_line.split(b',')[0].decode(), last_line.split(b',')[0].decode(), n_rows
+
+
+class StockCache:
+    """Class for a persistent columnar on-disk cache of the Kaggle price files. All the stocks are stored
+    back to back in one .npy file per column (Date, Open, High, Low, Close, Volume and the symbol id of each row)
+    which can be memory-mapped, while a manifest keeps the symbol names, the row offsets of each stock and
+    the size/modification time of every source file so that the cache is rebuilt whenever a source file changes.
+    """
+    def __init__(self, cache_path):
+        """
+        Args:
+                cache_path (str): Path to the directory where the cache is stored (created if it doesn't exist)
+        """
+        self.cache_path = cache_path
+        self.manifest_path = os.path.join(cache_path, 'manifest.json')
+
+    def _column_path(self, column):
+        return os.path.join(self.cache_path, f"{column.lower()}.npy")
+
+    def read_manifest(self):
+        """
+        Read the manifest of the cache.
+
+        Returns:
+            manifest (dict): The manifest of the cache or None if the cache hasn't been built
+        """
+        if not os.path.exists(self.manifest_path):
+            return None
+
+        with open(self.manifest_path) as file:
+            manifest = json.load(file)
+
+        return manifest if manifest.get('version') == CACHE_VERSION else None
+
+    def is_valid(self, files):
+        """
+        Check whether the cache is up to date with the specified source files.
+
+        Args:
+            files (list): List with the paths of the source price files
+
+        Returns:
+            bool: True if the cache holds exactly the specified files (in the same order) and none of them has changed
+            since it was built
+        """
+        manifest = self.read_manifest()
+        if manifest is None:
+            return False
+
+        cached = [[entry['file'], entry['signature']] for entry in manifest['files']]
+        current = [[os.path.basename(file), file_signature(file)] for file in files]
+
+        return cached == current
+
+    def build(self, files):
+        """
+        Write the specified source files to the cache. The files that are already cached and haven't changed since
+        are copied from the current cache, so only the new or changed files are parsed.
+
+        Args:
+            files (list): List with the paths of the source price files
+
+        Returns:
+            parsed_files (list): List with the paths of the files that were parsed
+        """
+        os.makedirs(self.cache_path, exist_ok=True)
+
+        # Row range of each cached file keyed by its name and signature
+        manifest = self.read_manifest()
+        cached_rows, cached_columns = {}, {}
+        if manifest is not None:
+            cached_columns = {column: np.load(self._column_path(column), mmap_mode='r') for column in CACHE_COLUMNS}
+            cached_rows = {(entry['file'], tuple(entry['signature'])): (manifest['offsets'][i], manifest['offsets'][i + 1])
+                           for i, entry in enumerate(manifest['files'])}
+
+        # Remove the manifest first so that an interrupted build is never mistaken for a valid cache
+        if os.path.exists(self.manifest_path):
+            os.remove(self.manifest_path)
+
+        # Slice the unchanged files from the cache and read the rest keeping only the columns stored in the cache
+        signatures = [file_signature(file) for file in files]
+        stock_columns, parsed_files = [], []
+        for file, signature in zip(files, signatures):
+            rows = cached_rows.get((os.path.basename(file), tuple(signature)))
+            if rows is not None:
+                stock_columns.append({column: values[rows[0]:rows[1]] for column, values in cached_columns.items()})
+            else:
+                stock_df = pd.read_csv(file, usecols=list(CACHE_COLUMNS))
+                stock_columns.append({column: stock_df[column].to_numpy(dtype=dtype) for column, dtype in CACHE_COLUMNS.items()})
+                parsed_files.append(file)
+        lengths = np.array([len(columns['Date']) for columns in stock_columns], dtype=np.int64)
+        offsets = np.concatenate([[0], np.cumsum(lengths)])
+
+        # Write each column as a single contiguous array for all the stocks (to a temporary file first since
+        # the current column may still be memory-mapped)
+        columns = {column: (np.concatenate([columns[column] for columns in stock_columns]).astype(dtype, copy=False)
+                            if stock_columns else np.empty(0, dtype=dtype))
+                   for column, dtype in CACHE_COLUMNS.items()}
+        columns['Symbol'] = np.repeat(np.arange(len(files), dtype=np.int32), lengths)
+        del stock_columns, cached_columns
+        for column, values in columns.items():
+            with open(self._column_path(column) + '.tmp', 'wb') as file:
+                np.save(file, values)
+            os.replace(self._column_path(column) + '.tmp', self._column_path(column))
+
+        # Write the manifest last, it marks the cache as complete
+        manifest = {
+            'version': CACHE_VERSION,
+            'offsets': offsets.tolist(),
+            'files': [{'file': os.path.basename(file), 'symbol': stock_id(file), 'signature': signature}
+                      for file, signature in zip(files, signatures)]
+        }
+        with open(self.manifest_path, 'w') as file:
+            json.dump(manifest, file)
+
+        return parsed_files
+
+    def load(self, files=None, mmap_mode='r'):
+        """
+        Load the cached columns, rebuilding the cache first if it is out of date with the specified source files.
+
+        Args:
+            files (list): List with the paths of the source price files (if not specified the cache is used as is)
+            mmap_mode (str): Memory-map mode passed to np.load (None reads the arrays in memory)
+
+        Returns:
+            columns (dict): Dictionary with the Date, Open, High, Low, Close, Volume and Symbol arrays
+            symbols (list): List with the stock id of each symbol code
+            offsets (np.ndarray): Row offsets of each stock in the column arrays
+        """
+        if files is not None and not self.is_valid(files):
+            self.build(files)
+
+        manifest = self.read_manifest()
+        if manifest is None:
+            raise FileNotFoundError(f"No stock cache was found in {self.cache_path}")
+
+        columns = {column: np.load(self._column_path(column), mmap_mode=mmap_mode)
+                   for column in list(CACHE_COLUMNS) + ['Symbol']}
+        symbols = [entry['symbol'] for entry in manifest['files']]
+        offsets = np.array(manifest['offsets'], dtype=np.int64)
+
+        return columns, symbols, offsets
+
+    def to_dataframes(self, files=None, stocks=None):
+        """
+        Load the cache as a list of per stock dataframes with the same layout as the one produced by StockData.
+
+        Args:
+            files (list): List with the paths of the source price files (if not specified the cache is used as is)
+            stocks (list): Indices of the stocks (in the order of the files) loaded as dataframes (if not specified all)
+
+        Returns:
+            stock_datalist (list): List of dataframes with the stock data for each stock
+            st_names (list): List with the stock id of each dataframe
+        """
+        columns, symbols, offsets = self.load(files)
+        stocks = range(len(symbols)) if stocks is None else stocks
+
+        # Convert the dates once for all the stocks and then slice the contiguous columns for each stock
+        dates = pd.to_datetime(columns['Date'])
+        stock_datalist = []
+        for i in stocks:
+            symbol = symbols[i]
+            start, end = offsets[i], offsets[i + 1]
+            stock_df = pd.DataFrame({column: (dates[start:end] if column == 'Date' else columns[column][start:end])
+                                     for column in CACHE_COLUMNS})
+            stock_df['Stock_Name'] = symbol
+            stock_datalist.append(stock_df)
+
+        return stock_datalist, [symbols[i] for i in stocks]
+
+
+class PerformanceStore:
+    """Class for the performance tables of the date ranges stored on disk (one .csv per date range with the performance
+    of every stock, before the filtering and sorting of StockData) along with a manifest of the size/modification time
+    of the source files they were computed from. On a refresh only the new or changed files have to be analyzed and
+    their rows replace the rows of the same stocks in the stored tables.
+    """
+    def __init__(self, perf_path):
+        """
+        Args:
+                perf_path (str): Path to the directory where the performance tables are stored (created if it doesn't exist)
+        """
+        self.perf_path = perf_path
+        self.manifest_path = os.path.join(perf_path, 'perf_manifest.json')
+
+    def table_path(self, date_range):
+        start_date, end_date = date_range
+        return os.path.join(self.perf_path, f"Stocks_Performance_{start_date or 'start'}_{end_date or 'end'}.csv")
+
+    def read_table(self, date_range):
+        """
+        Read the stored performance table of a date range.
+        """
+        return pd.read_csv(self.table_path(date_range), parse_dates=['Start_Date', 'End_Date'], keep_default_na=False,
+                           na_values=[''], float_precision='round_trip')
+
+    def read_manifest(self, date_ranges):
+        """
+        Read the manifest of the stored tables.
+
+        Returns:
+            manifest (dict): The manifest or None if no tables are stored for the specified date ranges
+        """
+        if not os.path.exists(self.manifest_path):
+            return None
+
+        with open(self.manifest_path) as file:
+            manifest = json.load(file)
+
+        if manifest.get('version') != CACHE_VERSION or manifest['date_ranges'] != [list(date_range) for date_range in date_ranges]:
+            return None
+
+        return manifest
+
+    def changed_files(self, files, date_ranges):
+        """
+        Find the source files that have to be analyzed (new or changed since the tables were stored).
+
+        Args:
+            files (list): List with the paths of the source price files
+            date_ranges (tuple): Tuple with the start and end date of each date range
+
+        Returns:
+            changed_files (list): List with the paths of the new or changed files (all the files if no tables are stored)
+        """
+        manifest = self.read_manifest(date_ranges)
+        stored = {} if manifest is None else {entry['file']: entry['signature'] for entry in manifest['files']}
+
+        return [file for file in files if stored.get(os.path.basename(file)) != file_signature(file)]
+
+    def update(self, files, date_ranges, changed_files, changed_performances):
+        """
+        Merge the performances of the changed files into the stored tables and write them along with the manifest.
+
+        Args:
+            files (list): List with the paths of all the current source price files
+            date_ranges (tuple): Tuple with the start and end date of each date range
+            changed_files (list): List with the paths of the analyzed files (see changed_files)
+            changed_performances (list): List with a dataframe with the performances of the changed files for each date range
+
+        Returns:
+            performances (list): List with a dataframe with the performances of all the stocks for each date range
+            (the rows in the order of the files as if all the files were analyzed at once)
+        """
+        os.makedirs(self.perf_path, exist_ok=True)
+        manifest = self.read_manifest(date_ranges)
+
+        # The stored tables are returned as they are if no file was changed, added or removed
+        stored_files = None if manifest is None else [entry['file'] for entry in manifest['files']]
+        if not changed_files and stored_files == [os.path.basename(file) for file in files]:
+            return [self.read_table(date_range) for date_range in date_ranges]
+
+        # Keep the stored rows of the unchanged files and drop the stocks that were changed or removed
+        changed = {os.path.basename(file) for file in changed_files}
+        kept_symbols = [stock_id(file) for file in files if os.path.basename(file) not in changed]
+        file_order = {symbol: i for i, symbol in enumerate(stock_id(file) for file in files)}
+
+        performances = []
+        for i, date_range in enumerate(date_ranges):
+            if manifest is not None and kept_symbols:
+                stored_df = self.read_table(date_range)
+                stored_df = stored_df[stored_df['Stock'].isin(kept_symbols)]
+                performance_df = pd.concat([stored_df, changed_performances[i]], ignore_index=True)
+            else:
+                performance_df = changed_performances[i].reset_index(drop=True)
+
+            # Order the rows as the files so that the filtered and sorted tables don't depend on what was refreshed
+            order = np.argsort(performance_df['Stock'].map(file_order).to_numpy(), kind='stable')
+            performances.append(performance_df.iloc[order].reset_index(drop=True))
+
+        # Remove the manifest first so that an interrupted update is never mistaken for valid tables
+        if os.path.exists(self.manifest_path):
+            os.remove(self.manifest_path)
+
+        for date_range, performance_df in zip(date_ranges, performances):
+            performance_df.to_csv(self.table_path(date_range), index=False)
+
+        manifest = {
+            'version': CACHE_VERSION,
+            'date_ranges': [list(date_range) for date_range in date_ranges],
+            'files': [{'file': os.path.basename(file), 'symbol': stock_id(file), 'signature': file_signature(file)}
+                      for file in files]
+        }
+        with open(self.manifest_path, 'w') as file:
+            json.dump(manifest, file)
+
+        return performances
@@ -1,12 +1,231 @@
 import glob
 import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import numpy as np
 import pandas as pd
+from DataModel import SYMBOLS, intern_stock_datalist, stock_code, storage_array
+from Instrumentation import instrumented, record
+from StockCache import PerformanceStore, StockCache, scan_file_span, stock_id
+
+
+def read_stock_file(file):
+    """
+    Read a Kaggle price file as a dataframe where the 'OpenInt' column is replaced by the 'Stock_Name' column with the stock id.
+    """
+    stock_df = pd.read_csv(file)
+    stock_df = stock_df.rename(columns={'OpenInt': 'Stock_Name'})
+    stock_df['Stock_Name'] = stock_id(file)
+
+    return stock_df
+
+
+def convert_dates(stock_datalist):
+    """
+    Convert the 'Date' column of all the stocks to datetime at once and write it back to each dataframe
+    (skipped if the dates have already been converted e.g. by a previous call).
+
+    Returns:
+        dates (np.ndarray): The dates of all the stocks back to back
+    """
+    if all(pd.api.types.is_datetime64_dtype(stock_df['Date']) for stock_df in stock_datalist):
+        return np.concatenate([stock_df['Date'].to_numpy() for stock_df in stock_datalist])
+
+    offsets = np.concatenate([[0], np.cumsum([len(stock_df) for stock_df in stock_datalist])])
+    dates = pd.to_datetime(pd.concat([stock_df['Date'] for stock_df in stock_datalist], ignore_index=True)).to_numpy()
+    for i, stock_df in enumerate(stock_datalist):
+        stock_df['Date'] = dates[offsets[i]:offsets[i + 1]]
+
+    return dates
+
+
+def merge_stock_chunks(stock_columns, symbols, chunksize=1_000_000):
+    """
+    Streaming k-way merge of the stocks (the rows of each stock are sorted by date) into chronological chunks, so that
+    the full dataframe of all the stocks is never built nor sorted. The dates are split in consecutive windows of about
+    chunksize rows from a per day row count, and each chunk gathers the next slice of every stock within its window
+    (found by binary search) and sorts only these rows by date and stock id.
+
+    Args:
+        stock_columns (list): List of dictionaries with the Date, Open, High, Low, Close and Volume arrays of each stock
+        (e.g. memory-mapped slices of the StockCache columns, only the rows of the current chunk are read)
+        symbols (list): List with the stock id of each stock
+        chunksize (int): Approximate number of rows of each chunk (the rows of a date are never split in two chunks
+        so a chunk can be larger)
+
+    Yields:
+        chunk (pd.DataFrame): Dataframe with the Date, Open, High, Low, Close, Volume and Stock_Name of the rows of
+        consecutive dates sorted by date and stock id (the prices and volumes in their storage dtypes and the stock ids
+        as a categorical of the symbol table, see DataModel)
+    """
+    columns = ['Date', 'Open', 'High', 'Low', 'Close', 'Volume']
+    stocks = [i for i, stock in enumerate(stock_columns) if len(stock['Date'])]
+    if not stocks:
+        return
+
+    # Count the rows of each day one stock at a time
+    first_day = min(stock_columns[i]['Date'][0].astype('datetime64[D]').astype(np.int64) for i in stocks)
+    last_day = max(stock_columns[i]['Date'][-1].astype('datetime64[D]').astype(np.int64) for i in stocks)
+    day_counts = np.zeros(last_day - first_day + 1, dtype=np.int64)
+    for i in stocks:
+        day_counts += np.bincount(stock_columns[i]['Date'].astype('datetime64[D]').astype(np.int64) - first_day,
+                                  minlength=len(day_counts))
+
+    # Split the days in windows of about chunksize rows
+    cumulative_counts = np.cumsum(day_counts)
+    edges = np.searchsorted(cumulative_counts, np.arange(chunksize, cumulative_counts[-1], chunksize), side='left') + 1
+    edges = np.unique(np.concatenate([edges, [len(day_counts)]]))
+
+    # The chunks are sorted by the rank of the stock ids within each date
+    symbols = np.asarray(symbols, dtype=object)
+    symbol_ranks = np.empty(len(symbols), dtype=np.int64)
+    symbol_ranks[np.argsort(symbols, kind='stable')] = np.arange(len(symbols))
+    symbol_codes = SYMBOLS.codes(symbols)
+
+    positions = np.zeros(len(stock_columns), dtype=np.int64)
+    for edge in edges:
+        end_date = np.datetime64(int(first_day + edge), 'D')
+
+        # Next slice of every stock within the window (the stocks that have rows in it)
+        active, starts, ends = [], [], []
+        for i in stocks:
+            end = np.searchsorted(stock_columns[i]['Date'], end_date, side='left')
+            if end > positions[i]:
+                active.append(i)
+                starts.append(positions[i])
+                ends.append(end)
+                positions[i] = end
+        if not active:
+            continue
+
+        lengths = np.array(ends) - np.array(starts)
+        chunk = {column: np.concatenate([stock_columns[i][column][start:end] for i, start, end in zip(active, starts, ends)])
+                 for column in columns}
+        codes = np.repeat(np.array(active), lengths)
+        chunk['Date'] = chunk['Date'].astype('datetime64[ns]')
+        order = np.lexsort((symbol_ranks[codes], chunk['Date']))
+
+        chunk_df = pd.DataFrame({column: (values[order] if column == 'Date' else
+                                          storage_array(values[order], 'volume' if column == 'Volume' else 'price'))
+                                 for column, values in chunk.items()})
+        chunk_df['Stock_Name'] = SYMBOLS.categorical(symbol_codes[codes[order]])
+
+        yield chunk_df
+
+
+def stock_performance(stock_datalist, date_ranges):
+    """
+    Compute the total return and the total years of every stock for every date range in a single batched pass.
+    The dates of all the stocks are converted once and laid out back to back (the rows of each stock are sorted
+    by date as in the Kaggle files, otherwise they are sorted first), so the first and last row of each
+    (stock, date range) pair are found with one binary search over a (stock, date) key instead of masking
+    each dataframe for each date range.
+
+    Args:
+        stock_datalist (list): List of dataframes with the stock data (the 'Date' column is converted to datetime in place)
+        date_ranges (tuple): Tuple with the start and end date of each date range in the YYYY-MM-DD format
+
+    Returns:
+        performances (list): List with a dataframe with the performance of the stocks for each date range, stocks with
+        less than 2 rows in a date range are left out
+    """
+    columns = ['Stock', 'Total_Return', 'Total_Years', 'Start_Date', 'End_Date']
+    if not stock_datalist:
+        return [pd.DataFrame(columns=columns) for _ in date_ranges]
+
+    lengths = np.array([len(stock_df) for stock_df in stock_datalist], dtype=np.int64)
+    st_names = np.array([stock_df['Stock_Name'].iloc[0] if len(stock_df) else '' for stock_df in stock_datalist], dtype=object)
+
+    # Convert 'Date' column of all the stocks to datetime at once and write it back to each dataframe
+    dates = convert_dates(stock_datalist)
+
+    lows = np.concatenate([stock_df['Low'].to_numpy(dtype=np.float64) for stock_df in stock_datalist])
+    highs = np.concatenate([stock_df['High'].to_numpy(dtype=np.float64) for stock_df in stock_datalist])
+
+    # Build a sorted (stock, day) key where each stock owns a block of `span` consecutive days,
+    # the last day of each block is never used by a row so that empty ranges resolve to empty slices
+    days = dates.astype('datetime64[D]').astype(np.int64)
+    first_day = days.min() if len(days) else 0
+    span = (days.max() - first_day + 2) if len(days) else 2
+    codes = np.repeat(np.arange(len(stock_datalist), dtype=np.int64), lengths)
+    keys = codes * span + (days - first_day)
+    if np.any(np.diff(keys) < 0):
+        order = np.argsort(keys, kind='stable')
+        keys, days, dates, lows, highs = keys[order], days[order], dates[order], lows[order], highs[order]
+
+    # Relative start and end day of each date range (an unspecified bound covers all the dates)
+    range_starts = np.array([(np.datetime64(pd.to_datetime(start_date), 'D').astype(np.int64) - first_day) if start_date else 0
+                             for start_date, _ in date_ranges], dtype=np.int64)
+    range_ends = np.array([(np.datetime64(pd.to_datetime(end_date), 'D').astype(np.int64) - first_day) if end_date else span - 1
+                           for _, end_date in date_ranges], dtype=np.int64)
+    range_starts = np.clip(range_starts, 0, span - 1)
+    range_ends = np.clip(range_ends, -1, span - 1)
+
+    # Binary search the boundaries of every (stock, date range) pair
+    stock_keys = np.arange(len(stock_datalist), dtype=np.int64)[:, None] * span
+    lo = np.searchsorted(keys, stock_keys + range_starts[None, :], side='left')
+    hi = np.searchsorted(keys, stock_keys + range_ends[None, :], side='right')
+
+    performances = []
+    for i in range(len(date_ranges)):
+        # Skip if there's insufficient data after filtering
+        valid = (hi[:, i] - lo[:, i]) >= 2
+        first, last = lo[valid, i], hi[valid, i] - 1
+
+        # Total return: (End High - Start Low) / Start Low
+        with np.errstate(divide='ignore', invalid='ignore'):
+            total_return = (highs[last] - lows[first]) / lows[first]
+        total_years = (days[last] - days[first]) / 365.25
+
+        performances.append(pd.DataFrame({
+            "Stock": st_names[valid],
+            "Total_Return": total_return,
+            "Total_Years": total_years,
+            "Start_Date": dates[first],
+            "End_Date": dates[last]
+        }))
+
+    return performances
+
+
+def rank_performances(stocks_performances):
+    """
+    Keep the stocks with a positive and finite total return and sort them by the total return for each date range.
+    """
+    stocks_performances = [stock_performance[(stock_performance['Total_Return'] > 0) & (stock_performance['Total_Return'] != float('inf'))]
+                           for stock_performance in stocks_performances]
+
+    return [stock_performance.sort_values(by='Total_Return', ascending=False) for stock_performance in stocks_performances]
+
+
+def analyze_stocks_chunk(stock_sources, date_ranges):
+    """
+    Read a chunk of stocks and compute their performance for the specified date ranges (used both serially
+    and as the task of each worker process of StockData.read_analyze_stocks).
+
+    Args:
+        stock_sources (list): List with the paths of the price files or with already loaded stock dataframes
+        date_ranges (tuple): Tuple with the start and end date of each date range (None to skip the performance computation)
+
+    Returns:
+        stock_datalist (list): List of dataframes with the stock data for each stock of the chunk
+        performances_data (list): List with a dataframe with the performances of the stocks of the chunk for each date range
+    """
+    stock_datalist = [read_stock_file(source) if isinstance(source, str) else source for source in stock_sources]
+
+    performances_data = []
+    if date_ranges != None:
+        performances_data = stock_performance(stock_datalist, date_ranges)
+
+    return stock_datalist, performances_data
+
 
 class StockData:
     """Class to read stock data from the specified path, analyze according to the total return and filter out the stocks
     so that only stocks with certain characteristics are kept. 
     """
-    def __init__(self, stock_path, n_seq, date_ranges, return_threshold, min_years, n_splits=3):
+    def __init__(self, stock_path, n_seq, date_ranges, return_threshold, min_years, n_splits=3, cache_path=None,
+                 n_workers=None, chunksize=None, stock_datalist=None, perf_path=None, prescan=False):
         """
         Args:
                 stock_path (str): Path to the stock data without the .txt extension
@@ -16,6 +235,18 @@ class StockData:
                 n_splits (int): Number of splits to be used for the evaluation of the stock performance and subsequent data filtering
                 return_threshold (tuple): Threshold for the total return of the stock to be kept for each split
                 min_years (tuple): Minimum number of years the stock has to be present in the market to be kept for each split
+                cache_path (str): Path to a directory for the columnar cache of the stock data (if not specified the .txt files are
+                parsed on every run, otherwise the cache is built on the first run and reused until a source file changes)
+                n_workers (int): Number of worker processes used to read and analyze the stocks (if not specified the stocks
+                are processed serially, on Windows the calling script needs an `if __name__ == '__main__':` guard)
+                chunksize (int): Number of stocks processed by each worker task (if not specified about 4 chunks per worker are used)
+                stock_datalist (list): List of already loaded stock dataframes (e.g. shared by a parameter sweep), if specified the
+                files aren't read, otherwise the dataframes are kept after the first read and reused by the subsequent calls
+                perf_path (str): Path to a directory where the performance tables of the date ranges are stored along with a manifest
+                of the source files, so that refresh_performances analyzes only the new or changed files
+                prescan (bool): Whether the date span of each file is pre-scanned (see scan_file_span) so that the files that can't
+                be present for min_years in any of the date ranges are skipped before being parsed (their stocks are left out of
+                the performance tables since filter_stocks would drop them anyway)
         """
         self.stock_path = stock_path
         self.n_seq = n_seq
@@ -23,144 +254,305 @@ class StockData:
         self.date_ranges = date_ranges
         self.return_threshold = return_threshold
         self.min_years = min_years
+        self.cache_path = cache_path
+        self.n_workers = n_workers
+        self.chunksize = chunksize
+        self.stock_datalist = stock_datalist
+        self.perf_path = perf_path
+        self.prescan = prescan
+
+    def stock_files(self):
+        """
+        List the paths of the non empty price files of the stock path.
+        """
+        # List all files in the directory using their path
+        files = glob.glob(os.path.join(self.stock_path, "*.txt"))
+
+        # Filter out empty files
+        return [file for file in files if os.path.getsize(file) > 0]
 
-    def read_analyze_stocks(self):
+    def prescan_files(self, files):
+        """
+        Find the files whose date span overlaps a date range for at least the minimum years of the date range, reading
+        only the first and last line of each file. The total years of a stock in a date range can't exceed the overlap
+        of its date span with the date range, so no stock that passes the min_years criterion is skipped.
+
+        Args:
+            files (list): List with the paths of the price files
+
+        Returns:
+            stocks (list): Indices of the kept files
+        """
+        spans = [scan_file_span(file) for file in files]
+        first_days = np.array([np.datetime64(first_date, 'D').astype(np.int64) if first_date else np.iinfo(np.int64).max
+                               for first_date, _, _ in spans], dtype=np.int64)
+        last_days = np.array([np.datetime64(last_date, 'D').astype(np.int64) if last_date else np.iinfo(np.int64).min
+                              for _, last_date, _ in spans], dtype=np.int64)
+
+        kept = np.zeros(len(files), dtype=bool)
+        for (start_date, end_date), min_years in zip(self.date_ranges, self.min_years):
+            # Days of each file within the date range (an unspecified bound covers all the dates)
+            start_day = np.datetime64(pd.to_datetime(start_date), 'D').astype(np.int64) if start_date else np.iinfo(np.int64).min
+            end_day = np.datetime64(pd.to_datetime(end_date), 'D').astype(np.int64) if end_date else np.iinfo(np.int64).max
+            overlap_days = np.minimum(last_days, end_day) - np.maximum(first_days, start_day)
+            kept |= (overlap_days > 0) & (overlap_days / 365.25 >= min_years)
+
+        record(Files=len(files), Skipped_Files=int((~kept).sum()),
+               Skipped_Rows=int(sum(n_rows for (_, _, n_rows), keep in zip(spans, kept) if not keep)))
+
+        return np.flatnonzero(kept).tolist()
+
+    @instrumented('read_analyze_stocks')
+    def read_analyze_stocks(self, rank=True):
         """
         Read all stock data from the specified paths, compute the total return for the specified date ranges
-        for each stock and store it in a dataframe.
+        for each stock and store it in a dataframe. If n_workers is specified the files are parsed and the
+        performance of each stock is computed in chunks across a process pool.
+
+        Args:
+            rank (bool): Whether the performances are filtered and sorted (see rank_performances) or returned for every
+            stock with at least 2 rows in a date range
 
         Returns:
             stock_performance (pd.DataFrame): Dataframe with the total return for each stock for the number of years specified
             stock_datalist (list): List of dataframes with the stock data for each stock
         """
 
-        # List all files in the directory using their path
-        files = glob.glob(os.path.join(self.stock_path, "*.txt"))
-
-        # Filter out empty files
-        files = [file for file in files if os.path.getsize(file) > 0]
-
-        # Create a list with the initial individal stock data read as dataframes
-        stock_datalist = [pd.read_csv(file) for file in files]
+        if self.stock_datalist is not None:
+            # Reuse the stock data which is already loaded
+            stock_sources = self.stock_datalist
+        else:
+            files = self.stock_files()
+
+            # Skip the files that can't be kept by filter_stocks from their date span
+            stocks = None
+            if self.prescan and self.date_ranges is not None and self.min_years is not None:
+                stocks = self.prescan_files(files)
+
+            if self.cache_path is not None:
+                # Read the stock data from the columnar cache (rebuilt only if a source file has changed)
+                stock_sources, _ = StockCache(self.cache_path).to_dataframes(files, stocks)
+            else:
+                # The files are parsed along with the performance computation
+                stock_sources = files if stocks is None else [files[i] for i in stocks]
+
+        if self.n_workers is not None and self.n_workers > 1:
+            # Split the stocks in chunks and read/analyze each chunk in a separate process, pool.map
+            # keeps the order of the chunks so the results are the same as the serial ones
+            chunksize = self.chunksize or max(1, -(-len(stock_sources) // (4 * self.n_workers)))
+            chunks = [stock_sources[i:i + chunksize] for i in range(0, len(stock_sources), chunksize)]
+            with ProcessPoolExecutor(max_workers=self.n_workers) as pool:
+                results = list(pool.map(analyze_stocks_chunk, chunks, repeat(self.date_ranges)))
+        else:
+            results = [analyze_stocks_chunk(stock_sources, self.date_ranges)]
 
-        # Create a list with the stock names, rename the 'OpenInt' column to 'Stock_Name'
-        # and append to the column the stock id
-        st_names = [file.split('\\')[-1].split('.')[0].upper() for file in files]
-        stock_datalist = [stock_df.rename(columns={'OpenInt': 'Stock_Name'}) for stock_df in stock_datalist]
-        for i, stock_df in enumerate(stock_datalist):
-            stock_df['Stock_Name'] = st_names[i] 
+        # Intern the stock ids in the symbol table of the process (the worker processes have their own) and store the
+        # prices and volumes in their storage dtypes
+        stock_datalist = [stock_df for chunk_datalist, _ in results for stock_df in chunk_datalist]
+        intern_stock_datalist(stock_datalist)
+        self.stock_datalist = stock_datalist
+        record(Rows=sum(len(stock_df) for stock_df in stock_datalist), Stocks=len(stock_datalist), Chunks=len(results))
 
-        # Initialize a list to store stock performance
-        performances_data = []
-        
         if self.date_ranges != None:
-            for i, date_range in enumerate(self.date_ranges):
-                performances_data.append([])
-                start_date, end_date = date_range
-
-                for j, stock_df in enumerate(stock_datalist):
-                    stock_name = st_names[j]
-
-                    # Convert 'Date' column to datetime for filtering
-                    stock_df['Date'] = pd.to_datetime(stock_df['Date'])
-
-                    # Apply date range filter
-                    filtered_df = stock_df
-                    if start_date:
-                        filtered_df = filtered_df[filtered_df['Date'] >= pd.to_datetime(start_date)]
-                    if end_date:
-                        filtered_df = filtered_df[filtered_df['Date'] <= pd.to_datetime(end_date)]
-
-                    # Skip if there's insufficient data after filtering
-                    if filtered_df.empty or len(filtered_df) < 2:
-                        continue
-
-                    # Calculate metrics
-                    start_date_filt = filtered_df['Date'].iloc[0]
-                    end_date_filt = filtered_df['Date'].iloc[-1]
-
-                    start_low = filtered_df['Low'].iloc[0]
-                    end_high = filtered_df['High'].iloc[-1]
-
-                    # Total return: (End High - Start Low) / Start Low
-                    total_return = (end_high - start_low) / start_low
-                    total_years = (end_date_filt - start_date_filt).days / 365.25
-
-                    # Append results
-                    performances_data[i].append({
-                        "Stock": stock_name,
-                        "Total_Return": total_return,
-                        "Total_Years": total_years,
-                        "Start_Date": start_date_filt,
-                        "End_Date": end_date_filt
-                    })
-
-            # Create dataframe from performance data for each date range
-            stocks_performances = [pd.DataFrame(performance_data) for performance_data in performances_data]
+            # Gather the performance data of all the chunks in a dataframe for each date range
+            stocks_performances = [pd.concat([chunk_performances[i] for _, chunk_performances in results], ignore_index=True)
+                                   for i in range(len(self.date_ranges))]
 
             # Filter and sort performance data
-            stocks_performances = [stock_performance[(stock_performance['Total_Return'] > 0) & (stock_performance['Total_Return'] != float('inf'))]
-                                   for stock_performance in stocks_performances]
-            stocks_performances = [stock_performance.sort_values(by='Total_Return', ascending=False)
-                                   for stock_performance in stocks_performances]
-
+            if rank:
+                stocks_performances = rank_performances(stocks_performances)
             return stocks_performances, stock_datalist
         else:
             return stock_datalist
 
-    def filter_stocks(self):
+    @instrumented('refresh_performances')
+    def refresh_performances(self):
+        """
+        Bring the stored performance tables of the date ranges (see perf_path) up to date with the files of the stock path.
+        Only the new or changed files are read and analyzed and their performances replace the ones of the same stocks,
+        while the stocks of removed files are dropped, so a refresh costs time in proportion to what changed.
+
+        Returns:
+            stock_performance (list): List with a dataframe with the total return of the stocks for each date range
+            (filtered and sorted as in read_analyze_stocks)
+        """
+        store = PerformanceStore(self.perf_path)
+        files = self.stock_files()
+        changed_files = store.changed_files(files, self.date_ranges)
+        record(Files=len(files), Changed_Files=len(changed_files))
+
+        # Read and analyze only the changed files (the paths are passed as the stock data sources), the stored tables
+        # keep the performances of every stock before the filtering and sorting
+        if changed_files:
+            changed_performances, _ = StockData(None, self.n_seq, self.date_ranges, None, None, n_workers=self.n_workers,
+                                                chunksize=self.chunksize,
+                                                stock_datalist=changed_files).read_analyze_stocks(rank=False)
+        else:
+            changed_performances = stock_performance([], self.date_ranges)
+
+        return rank_performances(store.update(files, self.date_ranges, changed_files, changed_performances))
+
+    def load_stocks(self, stock_ids):
+        """
+        Load the stock data of the specified stocks only, from the columnar cache if specified, otherwise by parsing
+        their price files.
+
+        Args:
+            stock_ids (set): Stock ids of the stocks to be loaded
+
+        Returns:
+            stock_datalist (list): List of dataframes with the stock data for each of the stocks (in the order of the files)
+        """
+        files = self.stock_files()
+        stocks = [i for i, file in enumerate(files) if stock_id(file) in stock_ids]
+
+        if self.cache_path is not None:
+            stock_datalist, _ = StockCache(self.cache_path).to_dataframes(files, stocks)
+        else:
+            stock_datalist = [read_stock_file(files[i]) for i in stocks]
+            convert_dates(stock_datalist)
+        intern_stock_datalist(stock_datalist)
+        record(Stocks=len(stock_datalist))
+
+        return stock_datalist
+
+    @instrumented('filter_stocks')
+    def filter_stocks(self, stock_performances=None):
         """
         Filter out the list with the stocks dataframes based on the following criteria if the length of the sequence is below 1000:
         1) For the first period (e.g. 1962-1980) period the stock has a total return above 2 dollars and is at least 5 years in the stock market
         2) For the second period (e.g. 1980-2000) period the stock has a total return above 100 dollars and is at least 5 years in the stock market
         3) For the third period (e.g. 2000-2018) period the stock has a total return above 50 dollars and is at least 10 years in the stock market
 
+        Args:
+            stock_performances (list): Performance tables of the date ranges as returned by read_analyze_stocks, e.g. loaded
+            from a checkpoint (if specified the stocks aren't analyzed again and, unless the stock data is already loaded,
+            only the data of the kept stocks is loaded)
+
         Returns:
             filt_stock_datalist (list): List of dataframes with the stock data for the filtered stocks if the sequence length is below 1000
         """
         
-        # Read the stock data and analyze it
-        stock_performances, stock_datalists = self.read_analyze_stocks()
+        if stock_performances is None:
+            # Read the stock data and analyze it
+            stock_performances, stock_datalists = self.read_analyze_stocks()
+        else:
+            stock_datalists = self.stock_datalist
 
         # Filter out the stocks based on the criteria and find the Id's of the stocks in question based on the length of the input sequence
         if self.n_seq <= 1000:
             filtered_stocks = [stock_performance[(stock_performance['Total_Years'] >= self.min_years[i]) & 
                                                  (stock_performance['Total_Return'] >= self.return_threshold[i])] 
                                                  for i, stock_performance in zip(range(self.n_splits), stock_performances)]
+
+            if stock_datalists is None:
+                stock_datalists = self.load_stocks(set().union(*(filtered_stock['Stock'] for filtered_stock in filtered_stocks)))
             
-            # find the ID for the stocks that will be kept according to the specified criteria and
-            # flatten the list of filtered stock ID's
-            filt_stocks_ids = [filtered_stock['Stock'].values for filtered_stock in filtered_stocks]
+            # find the codes of the stocks that will be kept according to the specified criteria in the symbol table
+            # so that each stock is matched by an integer lookup
+            stock_codes = [stock_code(stock_df) for stock_df in stock_datalists]
+            filt_stocks_ids = []
+            for filtered_stock in filtered_stocks:
+                kept_codes = SYMBOLS.codes(filtered_stock['Stock'])
+                is_kept = np.zeros(len(SYMBOLS), dtype=bool)
+                is_kept[kept_codes] = True
+                filt_stocks_ids.append(is_kept)
 
             # Use the filtered stocks ID's to filter out the stock dataframes
             filt_stock_datalists = []
             for i, filt_stocks_id in enumerate(filt_stocks_ids):
                 start_date, end_date = self.date_ranges[i]
                 filtered_dfs = []
-                for stock_df in stock_datalists:
-                    if stock_df['Stock_Name'].iloc[0] in filt_stocks_id:
+                for code, stock_df in zip(stock_codes, stock_datalists):
+                    if code >= 0 and filt_stocks_id[code]:
                         filtered_df = stock_df[(stock_df['Date'] >= pd.to_datetime(start_date)) & 
                                                (stock_df['Date'] <= pd.to_datetime(end_date))]
                         filtered_dfs.append(filtered_df)
                 filt_stock_datalists.append(filtered_dfs)
+
+            record(Rows=sum(len(filtered_df) for filtered_dfs in filt_stock_datalists for filtered_df in filtered_dfs),
+                   Stocks=[len(filtered_dfs) for filtered_dfs in filt_stock_datalists])
             
             return filt_stock_datalists
 
-    def concat_stock_dfs(self):
+    def stock_columns(self):
+        """
+        Column arrays of each stock for the k-way merge of the large sequence. If the stock data isn't loaded and a cache
+        is specified the arrays are memory-mapped slices of the cache, so the stocks are never loaded in memory.
+
+        Returns:
+            stock_columns (list): List of dictionaries with the Date, Open, High, Low, Close and Volume arrays of each stock
+            symbols (list): List with the stock id of each stock
+        """
+        if self.stock_datalist is None and self.cache_path is not None:
+            columns, symbols, offsets = StockCache(self.cache_path).load(self.stock_files())
+            stock_columns = [{column: values[offsets[i]:offsets[i + 1]] for column, values in columns.items()}
+                             for i in range(len(symbols))]
+            return stock_columns, symbols
+
+        if self.stock_datalist is None:
+            self.read_analyze_stocks()
+        convert_dates(self.stock_datalist)
+        stock_columns = [{column: stock_df[column].to_numpy() for column in ['Date', 'Open', 'High', 'Low', 'Close', 'Volume']}
+                         for stock_df in self.stock_datalist]
+        symbols = [stock_df['Stock_Name'].iloc[0] if len(stock_df) else '' for stock_df in self.stock_datalist]
+
+        return stock_columns, symbols
+
+    def trading_days(self, chunksize=1_000_000):
+        """
+        Count the distinct trading days of the stocks in one pass over their dates, marking the days in a bitmap of the
+        span of the dates instead of concatenating and sorting the dates of all the rows. If the stock data isn't loaded
+        and a cache is specified the memory-mapped Date column of the cache is read in chunks of chunksize rows.
+
+        Returns:
+            n_days (int): Number of distinct trading days
+        """
+        # The dates of each stock are sorted, so the span of the dates comes from the first and last row of each stock
+        if self.stock_datalist is None and self.cache_path is not None:
+            columns, _, offsets = StockCache(self.cache_path).load(self.stock_files())
+            dates = columns['Date']
+            lengths = np.diff(offsets)
+            bounds = [dates[offsets[:-1][lengths > 0]], dates[offsets[1:][lengths > 0] - 1]]
+            date_chunks = (dates[start:start + chunksize] for start in range(0, len(dates), chunksize))
+        else:
+            stock_columns, _ = self.stock_columns()
+            bounds = [columns['Date'][[0, -1]] for columns in stock_columns if len(columns['Date'])]
+            date_chunks = (columns['Date'] for columns in stock_columns)
+
+        bounds = np.concatenate([np.asarray(values).astype('datetime64[D]').astype(np.int64) for values in bounds] or [[]])
+        if not len(bounds):
+            return 0
+        first_day = bounds.min()
+        is_day = np.zeros(bounds.max() - first_day + 1, dtype=bool)
+        for date_chunk in date_chunks:
+            is_day[np.asarray(date_chunk).astype('datetime64[D]').astype(np.int64) - first_day] = True
+
+        return int(is_day.sum())
+
+    @instrumented('concat_stock_dfs')
+    def concat_stock_dfs(self, chunksize=None, stock_performances=None):
         """Concatenate all the stock dataframes into a single one with chronological order where only the stocks between the
            specified date ranges are kept.
 
+            Args:
+                chunksize (int): For the large sequence (n_seq > 1000), if specified the stocks are merged in chronological
+                chunks of about chunksize rows which are streamed instead of building the whole dataframe (see merge_stock_chunks)
+                stock_performances (list): For the small sequence, performance tables which are filtered instead of analyzing
+                the stocks again (see filter_stocks)
+
             Returns:
-                large_df (pd.DataFrame): Dataframe with the stock data for all the stocks"""
+                large_df (pd.DataFrame): Dataframe with the stock data for all the stocks (an iterator of dataframe chunks
+                for the large sequence if chunksize is specified)"""
 
         if self.n_seq <= 1000:
-            stock_datalists = self.filter_stocks()
+            stock_datalists = self.filter_stocks(stock_performances)
 
             # retain only the stocks for the start and end dates
             for i in range(len(stock_datalists)):
                 for j, stock_df in enumerate(stock_datalists[i]):
-                    stock_df['Date'] = pd.to_datetime(stock_df['Date'])
-                    stock_datalists[i][j] = stock_df.iloc[[0, -1]]
+                    stock_df = stock_df.iloc[[0, -1]]
+                    stock_datalists[i][j] = stock_df.assign(Date=pd.to_datetime(stock_df['Date']))
 
             large_dfs = [pd.concat(stock_datalist, ignore_index=True) 
                          for stock_datalist in stock_datalists]
@@ -169,14 +561,22 @@ class StockData:
                 large_df['Date'] = pd.to_datetime(large_df['Date'])
                 large_df = large_df.sort_values(by='Date')
 
+            record(Rows=sum(len(large_df) for large_df in large_dfs))
+
             return large_dfs
 
+        elif chunksize is not None:
+            # Stream the chunks of a k-way merge of the stocks which are already sorted by date
+            return merge_stock_chunks(*self.stock_columns(), chunksize=chunksize)
+
         else:
             stock_datalists = self.read_analyze_stocks()
             large_df = pd.concat(stock_datalists, ignore_index=True)
             large_df['Date'] = pd.to_datetime(large_df['Date'])
             large_df = large_df.sort_values(by='Date')
 
+            record(Rows=len(large_df))
+
             return large_df
 
 
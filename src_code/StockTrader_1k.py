@@ -1,6 +1,9 @@
 import pandas as pd
 from datetime import timedelta
 import numpy as np
+from DataModel import SYMBOLS
+from Instrumentation import instrumented, record
+from TradeLedger import TradeLedger, ACTION_CODES
 
 def stocks_weight(StockPerf_df):
   """
@@ -25,17 +28,174 @@ def stocks_weight(StockPerf_df):
   return StockPerf_df
 
 
-def Stock_Trader_1000(transactions, performances, st_cap=1, trans_fee=0.01):
+def market_prices(df, trans_fee, side):
   """
-  Function that generates a stock trading sequence for a given period and computes the capital at the end of the time period.
+  Function that selects the market price of each row for buying (the lowest of close, low and open) or
+  selling (the highest of close, high and open) stocks and applies the transaction fee.
+
+  Args:
+    df: a dataframe with the Open, Close and Low (buying) or High (selling) columns
+    trans_fee: the transaction fee as a percentage of the price
+    side: 'buy' or 'sell'
+
+  Returns:
+    prices: an array with the price of each row including the fee (NaN if no price type can be selected)
+    price_types: an array with the selected price type of each row ('close', 'low'/'high' or 'open', '' if none)
+  """
+  extreme = 'Low' if side == 'buy' else 'High'
+  close, ext, open_ = (df[column].to_numpy(dtype=np.float64) for column in ('Close', extreme, 'Open'))
+
+  # Same precedence as the close, low/high and open conditions of the buying and selling loops
+  if side == 'buy':
+    conditions = [(close <= ext) & (close <= open_), (ext <= close) & (ext <= open_), (open_ <= close) & (open_ <= ext)]
+    fee_factor = 1 + trans_fee
+  else:
+    conditions = [(close >= ext) & (close >= open_), (ext >= close) & (ext >= open_), (open_ >= close) & (open_ >= ext)]
+    fee_factor = 1 - trans_fee
+
+  prices = np.select(conditions, [close, ext, open_], default=np.nan) * fee_factor
+  price_types = np.select(conditions, ['close', extreme.lower(), 'open'], default='')
+
+  return prices, price_types
+
+
+def allocate_capital(prices, weights, max_allowed_stocks, st_cap, min_capital):
+  """
+  Function that computes in closed form the number of stocks bought from each stock when the capital is repeatedly
+  invested according to the investment weights until the remaining capital falls below the minimum capital.
+
+  Each pass invests a fraction W (the sum of the weights of the stocks that can be bought) of the remaining capital,
+  so after k passes the remaining capital is C * (1 - W)^k and the total capital invested in each stock is the
+  sum of a geometric series. Stocks that reach 10% of their volume are bought up to that limit and the capital
+  left is allocated again among the rest, so at most one round per stock is needed and no pass can spin
+  without buying anything.
+
+  Args:
+    prices: an array with the buying price of each stock including the fee
+    weights: an array with the investment weight of each stock
+    max_allowed_stocks: an array with the maximum number of stocks allowed by the volume of each stock
+    st_cap: the starting capital
+    min_capital: the minimum capital below which no more stocks are bought
+
+  Returns:
+    stocks_bought: an array with the number of stocks bought from each stock
+    n_passes: the number of investment passes of the last round
+  """
+  weights = np.nan_to_num(np.asarray(weights, dtype=np.float64), nan=0.0)
+  free = np.isfinite(prices) & (prices > 0) & (weights > 0) & (max_allowed_stocks >= 1)
+  stocks_bought = np.zeros(len(prices))
+  capital, n_passes = st_cap, 0
+
+  while free.any():
+    invested_fraction = weights[free].sum()
+
+    # Number of passes for which the remaining capital is at least the minimum capital
+    remaining_fraction = max(1 - invested_fraction, 0)
+    if capital <= 0:
+      n_passes = 0
+    elif remaining_fraction == 0:
+      n_passes = 1
+    elif min_capital <= 0:
+      n_passes = np.inf
+    else:
+      n_passes = max(int(np.floor(np.log(min_capital / capital) / np.log(remaining_fraction))) + 1, 0)
+
+    # Total capital invested in each stock over all the passes (geometric series)
+    invested_capital = weights[free] * capital * (1 - remaining_fraction ** n_passes) / invested_fraction
+    stocks_bought[free] = np.floor(invested_capital / prices[free])
+
+    # Stocks exceeding 10% of the volume are bought up to the limit and left out of the next round
+    capped = free & (stocks_bought >= max_allowed_stocks)
+    if not capped.any():
+      break
+    stocks_bought[capped] = max_allowed_stocks[capped]
+    capital -= (stocks_bought[capped] * prices[capped]).sum()
+    free &= ~capped
+
+  return stocks_bought, n_passes
+
+
+def allocate_capital_batch(prices, weights, max_allowed_stocks, st_caps, min_capitals):
+  """
+  Function that computes the allocation of allocate_capital for many scenarios at once, with one row of the arrays
+  per scenario. Every round of the allocation is a set of 2-D array operations over all the scenarios that still have
+  stocks capped by the volume.
+
+  Args:
+    prices: a (scenarios x stocks) array with the buying price of each stock including the fee of each scenario
+    weights: an array with the investment weight of each stock
+    max_allowed_stocks: an array with the maximum number of stocks allowed by the volume of each stock
+    st_caps: an array with the starting capital of each scenario
+    min_capitals: an array with the minimum capital of each scenario
+
+  Returns:
+    stocks_bought: a (scenarios x stocks) array with the number of stocks bought from each stock
+  """
+  weights = np.nan_to_num(np.asarray(weights, dtype=np.float64), nan=0.0)[None, :]
+  max_allowed_stocks = np.broadcast_to(max_allowed_stocks, prices.shape)
+  free = np.isfinite(prices) & (prices > 0) & (weights > 0) & (max_allowed_stocks >= 1)
+  stocks_bought = np.zeros(prices.shape)
+  capital = np.asarray(st_caps, dtype=np.float64).copy()
+  min_capitals = np.asarray(min_capitals, dtype=np.float64)
+  active = free.any(axis=1)
+
+  while active.any():
+    invested_fraction = np.where(free, weights, 0).sum(axis=1)
+
+    # Number of passes for which the remaining capital is at least the minimum capital
+    remaining_fraction = np.maximum(1 - invested_fraction, 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+      n_passes = np.maximum(np.floor(np.log(min_capitals / capital) / np.log(remaining_fraction)) + 1, 0)
+    n_passes = np.select([capital <= 0, remaining_fraction == 0, min_capitals <= 0], [0, 1, np.inf], default=n_passes)
+
+    # Total capital invested in each stock over all the passes (geometric series)
+    with np.errstate(divide='ignore', invalid='ignore'):
+      scale = capital * (1 - remaining_fraction ** n_passes) / invested_fraction
+      bought = np.floor(weights * scale[:, None] / prices)
+    stocks_bought = np.where(free & active[:, None], bought, stocks_bought)
+
+    # Stocks exceeding 10% of the volume are bought up to the limit and left out of the next round
+    capped = free & active[:, None] & (stocks_bought >= max_allowed_stocks)
+    stocks_bought = np.where(capped, max_allowed_stocks, stocks_bought)
+    capital -= np.where(capped, stocks_bought * prices, 0).sum(axis=1)
+    free &= ~capped
+    active &= capped.any(axis=1) & free.any(axis=1)
+
+  return stocks_bought
+
+
+def log_transactions(ledger, df, volumes, amounts, price_types, side):
+  """
+  Function that logs the buying or selling transactions of the rows of a dataframe in a TradeLedger.
+
+  Args:
+    ledger: the TradeLedger where the transactions are logged
+    df: a dataframe with the Date, Stock_Name and Close of each row
+    volumes: an array with the number of stocks bought/sold in each row
+    amounts: an array with the cost/profit of each row
+    price_types: an array with the price type of each row ('' if the row can't be traded)
+    side: 'buy' or 'sell'
+  """
+  rows = np.flatnonzero(((volumes > 0) | ledger.log_idle) & (price_types != ''))
+  symbols = ledger.symbol_codes(df['Stock_Name'])[rows]
+  actions = np.array([ACTION_CODES[f"{side}-{price_type}"] for price_type in price_types[rows]], dtype=np.int8)
+
+  ledger.extend(df['Date'].to_numpy()[rows], symbols, actions, np.asarray(volumes)[rows],
+                np.asarray(amounts)[rows], df['Close'].to_numpy()[rows])
+
+
+def buy_sell_frames(transactions, performances):
+  """
+  Function that splits the filtered stock transactions of a period in the buying and the selling dataframe and joins
+  the investment weights of the stocks to the buying dataframe.
 
   Args:
     transactions: a dataframe with the filtered stock transactions
     performances: a dataframe with the stock performances
-    st_cap: the initial budget for the stock trading sequence at 1/1/1960 equal to 1 dollar
+
   Returns:
-    transaction_df: a dataframe with the stock transactions
-    remaining_capital: the capital at the end of the time period
+    buy_df: a dataframe with the buying rows and the investment weight of each stock
+    sell_df: a dataframe with the selling row of each stock aligned with the buying rows
   """
   transactions.reset_index(drop=True, inplace=True)  # Reset the index of the transactions dataframe
   transactions['Date'] = pd.to_datetime(transactions['Date'])  # Convert 'Date' column to datetime objects
@@ -52,21 +212,45 @@ def Stock_Trader_1000(transactions, performances, st_cap=1, trans_fee=0.01):
   buy_df = split_dataframes[0].reset_index(drop=True)
   sell_df = split_dataframes[1].reset_index(drop=True)
 
-  # Merge the performances dataframe with the buying dataframe and then align with the selling dataframe
-  buy_df = pd.merge(buy_df, performances[['Stock', 'Inv_Weight']],
-                    left_on='Stock_Name', right_on='Stock', how='left')
-  sell_df = sell_df.set_index('Stock_Name').reindex(buy_df['Stock_Name']).reset_index()
+  # Join the investment weights of the performances dataframe to the buying dataframe and align the selling dataframe
+  # with it through the codes of the symbol table (integer lookups instead of joins on the stock ids)
+  buy_codes = SYMBOLS.codes(buy_df['Stock_Name'])
+  perf_codes = SYMBOLS.codes(performances['Stock'])
+  sell_codes = SYMBOLS.codes(sell_df['Stock_Name'])
+  if len(np.unique(sell_codes)) < len(sell_codes):
+    raise ValueError("The selling dataframe must have a single row per stock")
+  weights = np.full(len(SYMBOLS), np.nan)
+  weights[perf_codes] = performances['Inv_Weight'].to_numpy(dtype=np.float64)
+  sell_rows = np.full(len(SYMBOLS), -1, dtype=np.int64)
+  sell_rows[sell_codes] = np.arange(len(sell_codes))
+
+  buy_df['Inv_Weight'] = weights[buy_codes]
+  sell_df = sell_df.drop(columns=['Stock_Name']).reindex(sell_rows[buy_codes]).reset_index(drop=True)
+  sell_df.insert(0, 'Stock_Name', buy_df['Stock_Name'].to_numpy())
 
   # Drop unnecessary columns
-  buy_df.drop(columns=['Stock', 'High'], inplace=True)
+  buy_df.drop(columns=['High'], inplace=True)
   sell_df.drop(columns=['Low'], inplace=True)
 
-  # Initialize the columns for buying and selling stocks dataframes
-  buy_df['Stocks_Bought'] = 0
-  buy_df['Stocks_Cost'] = 0
+  return buy_df, sell_df
 
-  sell_df['Stocks_Sold'] = 0
-  sell_df['Stocks_Profit'] = 0
+
+@instrumented('Stock_Trader_1000')
+def Stock_Trader_1000(transactions, performances, st_cap=1, trans_fee=0.01, ledger=None):
+  """
+  Function that generates a stock trading sequence for a given period and computes the capital at the end of the time period.
+
+  Args:
+    transactions: a dataframe with the filtered stock transactions
+    performances: a dataframe with the stock performances
+    st_cap: the initial budget for the stock trading sequence at 1/1/1960 equal to 1 dollar
+    ledger: a TradeLedger where the transactions are logged (e.g. one ledger shared by the chained periods), if not
+    specified a new one is used for the period
+  Returns:
+    transaction_df: a dataframe with the stock transactions
+    remaining_capital: the capital at the end of the time period
+  """
+  buy_df, sell_df = buy_sell_frames(transactions, performances)
 
   # Starting capital
   remaining_capital = st_cap
@@ -74,99 +258,44 @@ def Stock_Trader_1000(transactions, performances, st_cap=1, trans_fee=0.01):
   # Minimum capital (10% of the starting capital) to be maintained in the account
   min_capital = st_cap * 0.1
 
-  # Initialize a dataframe to record transactions
-  transaction_log = []
+  # Initialize a ledger to record transactions (the entries of this period start at log_start)
+  transaction_log = ledger if ledger is not None else TradeLedger(log_idle=False)
+  log_start = len(transaction_log)
 
-  # Buy stocks while the remaining capital is greater or equal to the minimum capital
-  while remaining_capital >= min_capital:
-    for index, row in buy_df.iterrows():
-
-      # Calculate the market price based on the buying condition at the 
-      # lowest available price for a given date
-      if row['Close'] <= row['Low'] and row['Close'] <= row['Open']:
-          stock_price = row['Close'] + trans_fee * row['Close']
-          price_type = 'close'
-      elif row['Low'] <= row['Close'] and row['Low'] <= row['Open']:
-          stock_price = row['Low'] + trans_fee * row['Low']
-          price_type = 'low'
-      elif row['Open'] <= row['Close'] and row['Open'] <= row['Low']:
-          stock_price = row['Open'] + trans_fee * row['Open']
-          price_type = 'open'
-      else:
-          continue
-      
-      # Calculate the maximum number of stocks that can be bought based 
-      # on 10% of the total volume
-      max_allowed_stocks = np.floor(0.1 * row['Volume'])
-
-      # Calculate the maximum number of stocks based on the investable capital
-      investable_capital = row['Inv_Weight'] * remaining_capital
-      max_stocks = np.floor(investable_capital / stock_price)
-
-      # Calculate the cost of buying the maximum number of stocks
-      cost = max_stocks * stock_price
-
-      # If the cost is zero or the maximum number of stocks exceeds the allowed number, 
-      # continue to the next row
-      if cost == 0:
-          continue
-      elif max_stocks > max_allowed_stocks:
-          continue
-
-      # Update the buying dataframe columns
-      buy_df.at[index, 'Stocks_Bought'] += max_stocks
-      buy_df.at[index, 'Stocks_Cost'] += cost
-
-      # Reduce the remaining capital
-      remaining_capital -= cost
-
-      # Log the transaction
-      transaction_log.append({
-          "Date": row['Date'],
-          "Transaction": f"buy-{price_type}",
-          "Stock": row['Stock_Name'],
-          "Volume": max_stocks
-      })
-
-      # Break the loop if the remaining capital is less than the minimum capital
-      if remaining_capital < min_capital:
-          break
-
-  # Loop for selling the stock
-  for (ib, rowb), (ise, rowse) in zip(buy_df.iterrows(), sell_df.iterrows()):
-
-    # Calculate the market price based on the selling condition at the highest possible price 
-    # for a given date
-    if rowse['Close'] >= rowse['High'] and rowse['Close'] >= rowse['Open']:
-        stock_price = rowse['Close'] - trans_fee * rowse['Close']
-        price_type = 'close'
-    elif rowse['High'] >= rowse['Close'] and rowse['High'] >= rowse['Open']:
-        stock_price = rowse['High'] - trans_fee * rowse['High']
-        price_type = 'high'
-    elif rowse['Open'] >= rowse['Close'] and rowse['Open'] >= rowse['High']:
-        stock_price = rowse['Open'] - trans_fee * rowse['Open']
-        price_type = 'open'
-    else:
-        continue
+  # Calculate the market price based on the buying condition at the lowest available price for a given date
+  buy_prices, buy_types = market_prices(buy_df, trans_fee, 'buy')
 
-    # Update the selling dataframe columns (sell all the stocks we bought)
-    sell_df.at[ise, 'Stocks_Sold'] = buy_df.at[ib, 'Stocks_Bought']
-    sell_df.at[ise, 'Stocks_Profit'] = sell_df.at[ise, 'Stocks_Sold'] * stock_price
+  # Calculate the maximum number of stocks that can be bought based on 10% of the total volume
+  max_allowed_stocks = np.floor(0.1 * buy_df['Volume'].to_numpy(dtype=np.float64))
 
-    # Log the transaction
-    transaction_log.append({
-        "Date": rowse['Date'],
-        "Transaction": f"sell-{price_type}",
-        "Stock": rowb['Stock_Name'],
-        "Volume": buy_df.at[ib, 'Stocks_Bought']
-    })
+  # Buy stocks while the remaining capital is greater or equal to the minimum capital
+  stocks_bought, n_passes = allocate_capital(buy_prices, buy_df['Inv_Weight'].to_numpy(), max_allowed_stocks,
+                                             st_cap, min_capital)
+  stocks_cost = np.where(stocks_bought > 0, stocks_bought * buy_prices, 0.0)
+  record(Rows=len(transactions), Stocks=len(buy_df), N_Passes=n_passes)
+
+  # Update the buying dataframe columns and reduce the remaining capital
+  buy_df['Stocks_Bought'] = stocks_bought
+  buy_df['Stocks_Cost'] = stocks_cost
+  remaining_capital -= stocks_cost.sum()
+
+  # Calculate the market price based on the selling condition at the highest possible price for a given date
+  # and sell all the stocks we bought
+  sell_prices, sell_types = market_prices(sell_df, trans_fee, 'sell')
+  sold = sell_types != ''
+  sell_df['Stocks_Sold'] = np.where(sold, stocks_bought, 0)
+  sell_df['Stocks_Profit'] = np.where(sold & (stocks_bought > 0), stocks_bought * sell_prices, 0.0)
+
+  # Log the transactions (stocks that weren't bought are logged only if the ledger keeps idle rows)
+  log_transactions(transaction_log, buy_df, stocks_bought, stocks_cost, buy_types, 'buy')
+  log_transactions(transaction_log, sell_df, sell_df['Stocks_Sold'].to_numpy(), sell_df['Stocks_Profit'].to_numpy(),
+                   sell_types, 'sell')
 
   # Increase the available capital based on the profit from selling the stocks
   remaining_capital = remaining_capital + sell_df['Stocks_Profit'].sum()
 
   # Create a dataframe for the transactions
-  transaction_df = pd.DataFrame(transaction_log)
-  transaction_df['Date'] = pd.to_datetime(transaction_df['Date'])
+  transaction_df = transaction_log.transactions(log_start)
   transaction_df = transaction_df.sort_values(by='Date')
 
   # Final grouping for merging transactions of the same day/stock
@@ -174,10 +303,67 @@ def Stock_Trader_1000(transactions, performances, st_cap=1, trans_fee=0.01):
     transaction_df.groupby(['Date', 'Transaction', 'Stock'], as_index=False)
     .agg({'Volume': 'sum'}))
 
-  # Filter out transactions with zero volume
-  transaction_df = transaction_df[transaction_df['Volume'] > 0]
+  # Filter out transactions with zero volume, the volumes are written as floats in the small sequence
+  transaction_df = transaction_df[transaction_df['Volume'] > 0].astype({'Volume': float})
+  record(Transactions=len(transaction_df))
 
   if remaining_capital > st_cap and len(transaction_df) < 1000:
     return transaction_df, remaining_capital, [buy_df, sell_df]
   else:
-    raise Exception("The investment for the given period was not profitable") # Raise an exception if the investment was not profitable
\ No newline at end of file
+    transaction_log.truncate(log_start)  # Remove the transactions of the period from the ledger
+    raise Exception("The investment for the given period was not profitable") # Raise an exception if the investment was not profitable
+
+@instrumented('Stock_Trader_1000_batch')
+def Stock_Trader_1000_batch(transactions, performances, st_caps, trans_fees):
+  """
+  Function that simulates the trading of Stock_Trader_1000 for a given period under many starting capitals and
+  transaction fees at once. The buying and selling rows and the price types don't depend on the scenario, so they
+  are computed once and the allocation of the capital is run for all the scenarios together with 2-D array
+  operations (see allocate_capital_batch). No sequence is logged, the periods can be chained by passing the final
+  capitals of a period as the starting capitals of the next one.
+
+  Args:
+    transactions: a dataframe with the filtered stock transactions
+    performances: a dataframe with the stock performances
+    st_caps: an array with the starting capitals
+    trans_fees: an array with the transaction fees (broadcast with st_caps, e.g. a column and a row give every
+    combination of them)
+
+  Returns:
+    scenarios_df: a dataframe with the St_Cap, Trans_Fee, Final_Capital, the number of Transactions and whether the
+    period is Profitable (as required by Stock_Trader_1000) of each scenario
+  """
+  st_caps, trans_fees = (values.ravel().astype(np.float64) for values in np.broadcast_arrays(st_caps, trans_fees))
+  buy_df, sell_df = buy_sell_frames(transactions, performances)
+
+  # Prices without the fee and price types of the rows (the fee only scales the prices)
+  buy_prices, buy_types = market_prices(buy_df, 0.0, 'buy')
+  sell_prices, sell_types = market_prices(sell_df, 0.0, 'sell')
+  max_allowed_stocks = np.floor(0.1 * buy_df['Volume'].to_numpy(dtype=np.float64))
+
+  buy_prices = buy_prices[None, :] * (1 + trans_fees[:, None])
+  sell_prices = sell_prices[None, :] * (1 - trans_fees[:, None])
+  stocks_bought = allocate_capital_batch(buy_prices, buy_df['Inv_Weight'].to_numpy(), max_allowed_stocks, st_caps,
+                                         st_caps * 0.1)
+  stocks_cost = np.where(stocks_bought > 0, stocks_bought * buy_prices, 0.0)
+  sold = (sell_types != '')[None, :] & (stocks_bought > 0)
+  stocks_profit = np.where(sold, stocks_bought * sell_prices, 0.0)
+  final_capitals = st_caps - stocks_cost.sum(axis=1) + stocks_profit.sum(axis=1)
+
+  # Count the transactions as the (date, transaction, stock) groups with a positive volume
+  n_transactions = np.zeros(len(st_caps), dtype=np.int64)
+  for df, types, traded in ((buy_df, buy_types, (stocks_bought > 0) & (buy_types != '')[None, :]), (sell_df, sell_types, sold)):
+    groups, _ = pd.factorize(pd.MultiIndex.from_arrays([df['Date'].to_numpy(), types, df['Stock_Name'].to_numpy()]))
+    order = np.argsort(groups, kind='stable')
+    if len(order):
+      starts = np.flatnonzero(np.diff(groups[order], prepend=-1))
+      n_transactions += np.logical_or.reduceat(traded[:, order], starts, axis=1).sum(axis=1)
+  record(Stocks=len(buy_df), Scenarios=len(st_caps))
+
+  return pd.DataFrame({
+    'St_Cap': st_caps,
+    'Trans_Fee': trans_fees,
+    'Final_Capital': final_capitals,
+    'Transactions': n_transactions,
+    'Profitable': (final_capitals > st_caps) & (n_transactions < 1000)
+  })
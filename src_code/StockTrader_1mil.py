@@ -1,87 +1,319 @@
-import pandas as pd
+import math
+import os
+import shutil
+from itertools import islice
 import numpy as np
+import pandas as pd
+from DataModel import sorted_symbol_codes
+from Instrumentation import instrumented, record
+from TradeLedger import ACTION_CODES
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+
+def intraday_loop(buy_prices, sell_prices, volumes, capital, max_volume_percentage, max_trades, stocks_traded):
+    """
+    Capital recurrence of the intra-day trading technique over contiguous price arrays. For each row the
+    maximum number of stocks allowed by the volume and by the available capital is bought at the buying price
+    and sold at the selling price of the same day.
+
+    Args:
+        buy_prices (np.ndarray): Lowest buying price of each row i.e. min(Open, Low)
+        sell_prices (np.ndarray): Highest selling price of each row i.e. max(High, Close)
+        volumes (np.ndarray): Volume of each row
+        capital (float): Initial starting capital
+        max_volume_percentage (float): Max percentage of the volume that can bought/sold for a given stock and date
+        max_trades (int): Max number of trades (each trade is a buy and a sell transaction)
+        stocks_traded (np.ndarray): Preallocated array where the number of stocks traded for each row is recorded
+
+    Returns:
+        n_rows (int): Number of rows visited before the max number of trades was reached
+        n_trades (int): Number of trades
+        capital (float): Final available capital
+    """
+    n_trades = 0
+    for i in range(len(buy_prices)):
+        if n_trades >= max_trades:
+            return i, n_trades, capital  # stop if the length of the sequence exceeds the number specified
+
+        # Calculation of max number of stocks that can be bought per day
+        max_stocks_by_volume = math.floor(max_volume_percentage * volumes[i])
+        if buy_prices[i] > 0:
+            max_stocks_by_capital = math.floor(capital / buy_prices[i])
+        else:
+            max_stocks_by_capital = max_stocks_by_volume
+        stocks_to_trade = min(max_stocks_by_volume, max_stocks_by_capital)
+
+        # Omit if stocks haven't been bought yet
+        if stocks_to_trade < 1:
+            continue
+
+        # Update the capital with the cost of the purchases and the profit of the sellings
+        stocks_traded[i] = stocks_to_trade
+        capital -= stocks_to_trade * buy_prices[i]
+        capital += stocks_to_trade * sell_prices[i]
+        n_trades += 1
+
+    return len(buy_prices), n_trades, capital
+
+
+# Compile the loop to machine code when numba is available, otherwise run it over plain Python lists
+intraday_loop_jit = njit(cache=True)(intraday_loop) if njit is not None else None
+
+
+def run_intraday_loop(buy_prices, sell_prices, volumes, capital, max_volume_percentage, max_trades):
+    """
+    Run the intra-day capital recurrence and record the number of stocks traded for each row in a preallocated array.
+
+    Returns:
+        stocks_traded (np.ndarray): Number of stocks traded for each visited row (0 if no trade took place)
+        capital (float): Final available capital
+    """
+    if intraday_loop_jit is not None:
+        stocks_traded = np.zeros(len(buy_prices), dtype=np.int64)
+        n_rows, _, capital = intraday_loop_jit(np.ascontiguousarray(buy_prices, dtype=np.float64),
+                                               np.ascontiguousarray(sell_prices, dtype=np.float64),
+                                               np.ascontiguousarray(volumes, dtype=np.int64),
+                                               float(capital), float(max_volume_percentage), int(max_trades),
+                                               stocks_traded)
+    else:
+        stocks_traded = [0] * len(buy_prices)
+        n_rows, _, capital = intraday_loop(buy_prices.tolist(), sell_prices.tolist(), volumes.tolist(),
+                                           capital, max_volume_percentage, max_trades, stocks_traded)
+        stocks_traded = np.array(stocks_traded, dtype=np.int64)
+
+    return stocks_traded[:n_rows], capital
+
+
+def rank_intraday_rows(dates, codes, buy_prices, sell_prices, volumes, max_volume_percentage, max_stocks_per_day=None):
+    """
+    Per-day allocation of the intra-day trades: the rows of each day are ranked by their return
+    (highest selling price - lowest buying price) / lowest buying price, so that the capital (and the transactions)
+    go to the best stocks of the day first, each one filled up to its volume limit before the next one is bought.
+    The rows without a profit or without a single stock allowed by the volume are dropped since trading them only
+    spends transactions. The ranking is a single exact sort over all the days by date, decreasing return and stock
+    (ties of the return are broken by the alphabetical order of the stocks), so the order doesn't depend on the order
+    of the rows e.g. the chunks of the data.
+
+    Args:
+        dates (np.ndarray): Date of each row
+        codes (np.ndarray): Symbol code of the stock of each row (in the alphabetical order of the stocks)
+        buy_prices (np.ndarray): Lowest buying price of each row i.e. min(Open, Low)
+        sell_prices (np.ndarray): Highest selling price of each row i.e. max(High, Close)
+        volumes (np.ndarray): Volume of each row
+        max_volume_percentage (float): Max percentage of the volume that can bought/sold for a given stock and date
+        max_stocks_per_day (int): Max number of stocks traded per day (if not specified all the profitable ones)
+
+    Returns:
+        rows (np.ndarray): The rows to visit in chronological order and in decreasing order of return within each day
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        returns = (sell_prices - buy_prices) / buy_prices
+    rows = np.flatnonzero((buy_prices > 0) & (returns > 0) & (np.floor(max_volume_percentage * volumes) >= 1))
+    rows = rows[np.lexsort((codes[rows], -returns[rows], dates[rows]))]
+
+    if max_stocks_per_day is not None and len(rows):
+        # Keep the first max_stocks_per_day rows of each day (the days are contiguous after the sort)
+        day_starts = np.flatnonzero(np.concatenate([[True], dates[rows][1:] != dates[rows][:-1]]))
+        ranks = np.arange(len(rows)) - np.repeat(day_starts, np.diff(np.append(day_starts, len(rows))))
+        rows = rows[ranks < max_stocks_per_day]
+
+    return rows
 
-def StockTrader_1mil(data, initial_capital=1, max_volume_percentage=0.1, n_seq=1_000_000):
+
+def iter_transactions(dates, stocks, volumes, chunksize=65_536):
+    """
+    Generator that yields the buy and sell transactions of a sequence of intra-day trades one line at a time.
+    The dates of the trades are formatted in chunks so that only one chunk of strings is kept in memory.
+
+    Args:
+        dates (np.ndarray): Date of each trade
+        stocks (np.ndarray): Stock id of each trade
+        volumes (np.ndarray): Number of stocks traded in each trade
+        chunksize (int): Number of trades formatted at once
+
+    Yields:
+        str: The 'YYYY-MM-DD buy-low STOCK VOLUME' and 'YYYY-MM-DD sell-high STOCK VOLUME' transactions of each trade
+    """
+    for start in range(0, len(dates), chunksize):
+        end = start + chunksize
+        # Format only the unique dates of the chunk (many trades take place on the same day)
+        unique_dates, date_index = np.unique(dates[start:end], return_inverse=True)
+        chunk_dates = np.datetime_as_string(unique_dates, unit='D')[date_index].tolist()
+        yield from [transaction for date, stock, volume in zip(chunk_dates, np.asarray(stocks[start:end]).tolist(),
+                                                               volumes[start:end].tolist())
+                    for transaction in (f"{date} buy-low {stock} {volume}", f"{date} sell-high {stock} {volume}")]
+
+
+def write_transactions(file_path, transactions, n_transactions=None, buffer_size=1 << 20, lines_per_write=65_536):
+    """
+    Write a sequence of transactions to a file through a buffered sink without holding the sequence in memory.
+    The first line of the file is the number of transactions, if it isn't known beforehand the transactions are
+    streamed to a temporary file first and then copied after the header.
+
+    Args:
+        file_path (str): Path of the output .txt file
+        transactions (iterable): Iterable (e.g. a generator) with the transactions
+        n_transactions (int): Number of transactions (if not specified it is counted while writing)
+        buffer_size (int): Size of the file buffer in bytes
+        lines_per_write (int): Number of transactions joined in each write call
+
+    Returns:
+        n_transactions (int): Number of transactions written
+    """
+    def write_lines(file):
+        n_lines, iterator = 0, iter(transactions)
+        while batch := list(islice(iterator, lines_per_write)):
+            file.write('\n'.join(batch) + '\n')
+            n_lines += len(batch)
+        return n_lines
+
+    if n_transactions is not None:
+        with open(file_path, 'w', buffering=buffer_size) as file:
+            file.write(f"{n_transactions}\n")
+            n_lines = write_lines(file)
+        if n_lines != n_transactions:
+            raise ValueError(f"Expected {n_transactions} transactions but {n_lines} were written to {file_path}")
+        return n_lines
+
+    # Stream the transactions to a temporary file, then write the header and copy the transactions after it
+    tmp_path = file_path + '.tmp'
+    try:
+        with open(tmp_path, 'w', buffering=buffer_size) as tmp_file:
+            n_lines = write_lines(tmp_file)
+        with open(file_path, 'w', buffering=buffer_size) as file, open(tmp_path, 'r', buffering=buffer_size) as tmp_file:
+            file.write(f"{n_lines}\n")
+            shutil.copyfileobj(tmp_file, file, buffer_size)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    return n_lines
+
+
+@instrumented('StockTrader_1mil')
+def StockTrader_1mil(data, initial_capital=1, max_volume_percentage=0.1, n_seq=1_000_000, output_file=None, ledger=None,
+                     allocation='alphabetical', max_stocks_per_day=None):
     """
     Function that generates a large stock trading sequence utilizing the intra-day trading
     technique
     
     Args:
         data (pd.DataFrame): Stock data with the following columns: 
-                             ['Date', 'Open', 'High', 'Low', 'Close', 'Volume', 'Stock_Name'].
+                             ['Date', 'Open', 'High', 'Low', 'Close', 'Volume', 'Stock_Name'],
+                             or an iterable of chronological chunks of it (e.g. from StockData.concat_stock_dfs with
+                             a chunksize) where the rows of a date aren't split between two chunks, so that only
+                             one chunk is kept in memory at a time.
         initial_capital (float): Initial starting capital (default=1).
         max_volume_percentage (float): max percentage of the volume that can bought/sold
         for a given stock and date set at 10%.
         n_seq (int): Max number of transactions.
+        output_file (str): Path of a .txt file where the transactions sequence is streamed (header included)
+        instead of being returned as a dataframe.
+        ledger (TradeLedger): Ledger where the purchases and sellings are logged instead of the buying/selling dataframes
+        (the rows without a trade are logged only if the ledger keeps idle rows).
+        allocation (str): 'alphabetical' to visit all the rows of each day in the alphabetical order of the stocks or
+        'ranked' to trade the stocks of each day in decreasing order of return (see rank_intraday_rows), in which case
+        the buying/selling dataframes only have the ranked rows.
+        max_stocks_per_day (int): Max number of stocks traded per day with the 'ranked' allocation (e.g. the max number
+        of trades divided by the number of trading days so that the trades are spread over all the days).
     
     Returns:
-        A dataframe with all the transactions.
-        pd.DataFrame: A dataframe with the stocks purchases.
-        pd.DataFrame: A Dataframe with stocks sells.
+        A dataframe with all the transactions (the number of transactions written if output_file is specified).
+        pd.DataFrame: A dataframe with the stocks purchases (None if a ledger is specified).
+        pd.DataFrame: A Dataframe with stocks sells (None if a ledger is specified).
         capital: Final available capital.
     """
     
-    # Sort dataframe values by date
-    data['Date'] = pd.to_datetime(data['Date'])
-    data = data.sort_values(by=['Date', 'Stock_Name']).reset_index(drop=True)
-    
-    # Initialize capital, transactions and the buying/selling sequence
-    capital = initial_capital
-    transactions = []
-    buy_logs = []
-    sell_logs = []
-    
-    # Loop for each day and stock
-    for _, row in data.iterrows():
-        if len(transactions) >= n_seq:
-            break  # break the loop if the length of the sequence exceeds the number specified
+    if allocation not in ('ranked', 'alphabetical'):
+        raise ValueError(f"Unknown allocation '{allocation}', expected 'ranked' or 'alphabetical'")
+
+    chunks = [data] if isinstance(data, pd.DataFrame) else data
+    capital, max_trades = initial_capital, -(-n_seq // 2)
+    n_chunks, n_data_rows, n_rows, n_trades = 0, 0, 0, 0
+    trades, buy_dfs, sell_dfs = [], [], []
+
+    for chunk in chunks:
+        # Integer symbol codes (codes follow the alphabetical order of the names)
+        dates = pd.to_datetime(chunk['Date']).to_numpy()
+        codes, symbols = sorted_symbol_codes(chunk['Stock_Name'])
+        opens = chunk['Open'].to_numpy(dtype=np.float64)
+        highs = chunk['High'].to_numpy(dtype=np.float64)
+        lows = chunk['Low'].to_numpy(dtype=np.float64)
+        closes = chunk['Close'].to_numpy(dtype=np.float64)
+        volumes = chunk['Volume'].to_numpy(dtype=np.int64)
 
         # Calculation of lowest buying price and highest selling price per day
-        buy_price = min(row['Open'], row['Low'])
-        sell_price = max(row['High'], row['Close'])
+        buy_prices = np.minimum(opens, lows)
+        sell_prices = np.maximum(highs, closes)
 
-        # Calculation of max number of stocks that can be bought per day
-        max_stocks_by_volume = np.floor(max_volume_percentage * row['Volume'])
-        max_stocks_by_capital = np.floor(capital / buy_price)
-        stocks_to_trade = int(min(max_stocks_by_volume, max_stocks_by_capital))
-        
-        # Omit if stocks haven't been bought yet
-        if stocks_to_trade < 1:
-            # Log the transactions
-            buy_logs.append({
-                'Date': row['Date'], 'Open': row['Open'], 'Low': row['Low'], 'Close': row['Close'],
-                'Volume': row['Volume'], 'Stock_Name': row['Stock_Name'], 
-                'Stocks_Bought': 0, 'Stocks_Cost': 0.0
-            })
-            sell_logs.append({
-                'Stock_Name': row['Stock_Name'], 'Date': row['Date'], 'Open': row['Open'], 
-                'High': row['High'], 'Close': row['Close'], 'Volume': row['Volume'], 
-                'Stocks_Sold': 0, 'Stocks_Profit': 0.0
-            })
-            continue
-        
-        # Update the capital with the cost and register the purchases
-        cost = stocks_to_trade * buy_price
-        capital -= cost
-        transactions.append(f"{row['Date'].date()} buy-low {row['Stock_Name']} {stocks_to_trade}")
-        buy_logs.append({
-            'Date': row['Date'], 'Open': row['Open'], 'Low': row['Low'], 'Close': row['Close'],
-            'Volume': row['Volume'], 'Stock_Name': row['Stock_Name'], 
-            'Stocks_Bought': stocks_to_trade, 'Stocks_Cost': cost
-        })
-
-        # Update the capital with the profit and register the sellings
-        profit = stocks_to_trade * sell_price
-        capital += profit
-        transactions.append(f"{row['Date'].date()} sell-high {row['Stock_Name']} {stocks_to_trade}")
-        sell_logs.append({
-            'Stock_Name': row['Stock_Name'], 'Date': row['Date'], 'Open': row['Open'], 
-            'High': row['High'], 'Close': row['Close'], 'Volume': row['Volume'], 
-            'Stocks_Sold': stocks_to_trade, 'Stocks_Profit': profit
-        })
-    
-    # Create the dataframes for the purchases and sellings
-    buy_df = pd.DataFrame(buy_logs)
-    sell_df = pd.DataFrame(sell_logs)
-    
-    return pd.DataFrame({'Transaction': transactions}), buy_df, sell_df, capital
\ No newline at end of file
+        # Order of the visited rows: by date and return or by date and stock
+        if allocation == 'ranked':
+            order = rank_intraday_rows(dates, codes, buy_prices, sell_prices, volumes, max_volume_percentage,
+                                       max_stocks_per_day)
+        else:
+            order = np.lexsort((codes, dates))
+
+        # Contiguous arrays of the sorted data
+        dates, codes, opens, highs, lows, closes, volumes, buy_prices, sell_prices = (
+            values[order] for values in (dates, codes, opens, highs, lows, closes, volumes, buy_prices, sell_prices))
+
+        # Run the capital recurrence from the capital and the trades left by the previous chunks,
+        # each trade adds a buy and a sell transaction to the sequence
+        stocks_traded, capital = run_intraday_loop(buy_prices, sell_prices, volumes, capital,
+                                                   max_volume_percentage, max_trades - n_trades)
+        chunk_rows = len(stocks_traded)
+        trade_rows = np.flatnonzero(stocks_traded)
+        trades.append((dates[trade_rows], symbols[codes[trade_rows]], stocks_traded[trade_rows]))
+        n_chunks, n_data_rows = n_chunks + 1, n_data_rows + len(chunk)
+        n_rows, n_trades = n_rows + chunk_rows, n_trades + len(trade_rows)
+
+        if ledger is not None:
+            # Log a purchase and a selling for each trade (or each visited row) directly from the arrays
+            rows = np.arange(chunk_rows) if ledger.log_idle else trade_rows
+            symbol_codes = ledger.symbol_codes(symbols)
+            ledger.extend(np.repeat(dates[rows], 2), np.repeat(symbol_codes[codes[rows]], 2),
+                          np.tile([ACTION_CODES['buy-low'], ACTION_CODES['sell-high']], len(rows)),
+                          np.repeat(stocks_traded[rows], 2),
+                          np.column_stack([stocks_traded[rows] * buy_prices[rows], stocks_traded[rows] * sell_prices[rows]]).ravel(),
+                          np.repeat(closes[rows], 2))
+        else:
+            # Create the dataframes for the purchases and sellings of all the visited rows
+            stock_names = symbols[codes[:chunk_rows]]
+            buy_dfs.append(pd.DataFrame({
+                'Date': dates[:chunk_rows], 'Open': opens[:chunk_rows], 'Low': lows[:chunk_rows], 'Close': closes[:chunk_rows],
+                'Volume': volumes[:chunk_rows], 'Stock_Name': stock_names,
+                'Stocks_Bought': stocks_traded, 'Stocks_Cost': stocks_traded * buy_prices[:chunk_rows]
+            }))
+            sell_dfs.append(pd.DataFrame({
+                'Stock_Name': stock_names, 'Date': dates[:chunk_rows], 'Open': opens[:chunk_rows],
+                'High': highs[:chunk_rows], 'Close': closes[:chunk_rows], 'Volume': volumes[:chunk_rows],
+                'Stocks_Sold': stocks_traded, 'Stocks_Profit': stocks_traded * sell_prices[:chunk_rows]
+            }))
+
+        # The next chunks aren't needed once the length of the sequence is reached
+        if n_trades >= max_trades:
+            break
+
+    record(Rows=n_data_rows, Chunks=n_chunks, Loop_Iterations=n_rows, Trades=n_trades, JIT=intraday_loop_jit is not None)
+
+    # Register the purchases and sellings of the trades
+    trade_dates = np.concatenate([np.empty(0, dtype='datetime64[ns]')] + [dates for dates, _, _ in trades])
+    trade_stocks = np.concatenate([np.empty(0, dtype=object)] + [stocks for _, stocks, _ in trades])
+    trade_volumes = np.concatenate([np.empty(0, dtype=np.int64)] + [volumes for _, _, volumes in trades])
+    transactions = iter_transactions(trade_dates, trade_stocks, trade_volumes)
+    if output_file is not None:
+        transactions = write_transactions(output_file, transactions, n_transactions=2 * n_trades)
+    else:
+        transactions = pd.DataFrame({'Transaction': list(transactions)})
+
+    if ledger is not None:
+        return transactions, None, None, capital
+
+    buy_df = pd.concat(buy_dfs, ignore_index=True) if buy_dfs else None
+    sell_df = pd.concat(sell_dfs, ignore_index=True) if sell_dfs else None
+
+    return transactions, buy_df, sell_df, capital
@@ -0,0 +1,87 @@
+import os
+import string
+import numpy as np
+import pandas as pd
+
+# Header of the Kaggle price files
+KAGGLE_COLUMNS = ['Date', 'Open', 'High', 'Low', 'Close', 'Volume', 'OpenInt']
+TRADING_DAYS_PER_YEAR = 252
+
+
+def synthetic_symbol(i):
+    """
+    Return a deterministic lower case ticker for the i-th synthetic stock (e.g. 0 -> 'aaaa', 1 -> 'aaab').
+    """
+    letters = []
+    for _ in range(4):
+        i, letter = divmod(i, 26)
+        letters.append(string.ascii_lowercase[letter])
+
+    return ''.join(reversed(letters))
+
+
+def synthetic_stock(days, seed, symbol_index, delisting_rate=0.2):
+    """
+    Create the price data of a single synthetic stock as a geometric random walk over a sub-range of the trading days.
+    The random generator is seeded by (seed, symbol_index) so each stock is the same whatever the number of stocks.
+
+    Args:
+        days (pd.DatetimeIndex): Trading days of the whole market
+        seed (int): Seed of the data set
+        symbol_index (int): Index of the stock in the data set
+        delisting_rate (float): Fraction of the stocks that leave the market before the last trading day
+
+    Returns:
+        stock_df (pd.DataFrame): Dataframe in the Kaggle format (Date, Open, High, Low, Close, Volume, OpenInt)
+    """
+    rng = np.random.default_rng([seed, symbol_index])
+
+    # The stock is listed during the first fifth of the market and some of the stocks are delisted afterwards
+    start = int(rng.integers(0, max(1, len(days) // 5)))
+    end = len(days)
+    if rng.random() < delisting_rate:
+        end = int(rng.integers(min(start + 2, len(days)), len(days) + 1))
+    n_days = end - start
+
+    close = np.exp(np.cumsum(rng.normal(0.0004, 0.02, n_days)) + rng.uniform(np.log(0.05), np.log(3)))
+    open_ = close * np.exp(rng.normal(0, 0.01, n_days))
+    high = np.maximum(open_, close) * np.exp(np.abs(rng.normal(0, 0.01, n_days)))
+    low = np.minimum(open_, close) * np.exp(-np.abs(rng.normal(0, 0.01, n_days)))
+
+    return pd.DataFrame({
+        'Date': days[start:end].strftime('%Y-%m-%d'),
+        'Open': open_.round(4),
+        'High': high.round(4),
+        'Low': low.round(4),
+        'Close': close.round(4),
+        'Volume': rng.integers(100, 100000, n_days),
+        'OpenInt': 0
+    }, columns=KAGGLE_COLUMNS)
+
+
+def generate_stock_files(output_path, n_symbols=100, n_years=10, seed=0, end_date='2017-11-10', delisting_rate=0.2):
+    """
+    Write a deterministic synthetic data set of Kaggle format price files (e.g. 'aaaa.us.txt') so that the pipeline
+    can be run and benchmarked without the Kaggle download. The same arguments always produce identical files.
+
+    Args:
+        output_path (str): Path to the directory where the files are written (created if it doesn't exist)
+        n_symbols (int): Number of stocks (e.g. 100 to 10000)
+        n_years (int): Number of years of the market (e.g. 1 to 60)
+        seed (int): Seed of the data set
+        end_date (str): Last trading day of the market in the YYYY-MM-DD format
+        delisting_rate (float): Fraction of the stocks that leave the market before the last trading day
+
+    Returns:
+        files (list): List with the paths of the written files
+    """
+    os.makedirs(output_path, exist_ok=True)
+    days = pd.bdate_range(end=end_date, periods=max(2, int(n_years * TRADING_DAYS_PER_YEAR)))
+
+    files = []
+    for i in range(n_symbols):
+        file = os.path.join(output_path, f"{synthetic_symbol(i)}.us.txt")
+        synthetic_stock(days, seed, i, delisting_rate).to_csv(file, index=False)
+        files.append(file)
+
+    return files
@@ -0,0 +1,131 @@
+import numpy as np
+import pandas as pd
+from DataModel import SYMBOLS
+
+# Fixed-dtype columns of each ledger entry (the stock and the transaction type are stored as integer codes)
+LEDGER_DTYPE = np.dtype([('Date', 'datetime64[D]'), ('Symbol', 'int32'), ('Action', 'int8'),
+                         ('Volume', 'int64'), ('Amount', 'float64'), ('Close', 'float64')])
+
+# Transaction types in the order of their action codes, buy actions come first
+ACTIONS = ('buy-open', 'buy-low', 'buy-close', 'sell-open', 'sell-high', 'sell-close')
+ACTION_CODES = {action: code for code, action in enumerate(ACTIONS)}
+N_BUY_ACTIONS = 3
+
+
+class TradeLedger:
+    """Class for a compact log of the buying and selling transactions shared by the stock traders. The entries are kept
+    in a growable structured NumPy array (Date, Symbol code, Action code, Volume, Amount, Close) where the Amount is the
+    cost of a purchase or the profit of a selling, while the stock ids are kept once in a symbol table (by default the
+    table shared by the stock data, so the codes of the 'Stock_Name' categoricals are logged as they are).
+    """
+    def __init__(self, capacity=1024, log_idle=True, symbol_table=None):
+        """
+        Args:
+                capacity (int): Initial number of entries allocated (the capacity doubles whenever it is exceeded)
+                log_idle (bool): Whether the traders should log the rows where no stocks are bought/sold (zero volume)
+                symbol_table (SymbolTable): Table of the stock ids of the entries (if not specified DataModel.SYMBOLS)
+        """
+        self.log_idle = log_idle
+        self.symbol_table = symbol_table if symbol_table is not None else SYMBOLS
+        self._entries = np.zeros(max(1, capacity), dtype=LEDGER_DTYPE)
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def symbols(self):
+        """List with the stock id of each symbol code."""
+        return self.symbol_table.symbols
+
+    @property
+    def entries(self):
+        """Structured array with the logged entries (a view, no copy is made)."""
+        return self._entries[:self._size]
+
+    def symbol_code(self, stock):
+        """
+        Return the integer code of a stock id, adding it to the symbol table if it isn't there yet.
+        """
+        return self.symbol_table.code(stock)
+
+    def symbol_codes(self, stocks):
+        """
+        Return the integer codes of an array of stock ids (e.g. a 'Stock_Name' column) as int32 (see SymbolTable.codes).
+        """
+        return self.symbol_table.codes(stocks)
+
+    def _reserve(self, n_entries):
+        # Grow the entries array geometrically so that appending is amortized O(1)
+        required = self._size + n_entries
+        if required > len(self._entries):
+            capacity = max(required, 2 * len(self._entries))
+            entries = np.zeros(capacity, dtype=LEDGER_DTYPE)
+            entries[:self._size] = self._entries[:self._size]
+            self._entries = entries
+
+    def append(self, date, stock, action, volume, amount, close):
+        """
+        Log a single transaction.
+
+        Args:
+            date: Date of the transaction
+            stock (str): Stock id
+            action (str): Transaction type (e.g. 'buy-low', 'sell-high')
+            volume (int): Number of stocks bought/sold
+            amount (float): Cost of the purchase or profit of the selling
+            close (float): Close price of the stock for the date of the transaction
+        """
+        self._reserve(1)
+        self._entries[self._size] = (np.datetime64(date, 'D'), self.symbol_code(stock), ACTION_CODES[action],
+                                     volume, amount, close)
+        self._size += 1
+
+    def extend(self, dates, symbols, actions, volumes, amounts, closes):
+        """
+        Log many transactions at once from arrays of equal length.
+
+        Args:
+            dates (np.ndarray): Date of each transaction
+            symbols (np.ndarray): Symbol code of each transaction (as returned by symbol_code)
+            actions (np.ndarray): Action code of each transaction (see ACTION_CODES)
+            volumes (np.ndarray): Number of stocks bought/sold in each transaction
+            amounts (np.ndarray): Cost or profit of each transaction
+            closes (np.ndarray): Close price of the stock of each transaction
+        """
+        n_entries = len(dates)
+        self._reserve(n_entries)
+        block = self._entries[self._size:self._size + n_entries]
+        block['Date'] = dates
+        block['Symbol'] = symbols
+        block['Action'] = actions
+        block['Volume'] = volumes
+        block['Amount'] = amounts
+        block['Close'] = closes
+        self._size += n_entries
+
+    def truncate(self, size):
+        """
+        Drop the entries logged after the first `size` entries (e.g. to roll back an unprofitable period).
+        """
+        self._size = min(self._size, size)
+
+    def is_buy(self, start=0):
+        """Boolean mask of the buying entries logged from the `start` entry onwards."""
+        return self.entries['Action'][start:] < N_BUY_ACTIONS
+
+    def transactions(self, start=0):
+        """
+        Create a dataframe with the transactions logged from the `start` entry onwards.
+
+        Returns:
+            transaction_df (pd.DataFrame): Dataframe with the Date, Transaction, Stock and Volume of each transaction
+        """
+        entries = self.entries[start:]
+
+        return pd.DataFrame({
+            'Date': pd.to_datetime(entries['Date']),
+            'Transaction': np.asarray(ACTIONS, dtype=object)[entries['Action']],
+            'Stock': np.asarray(self.symbols, dtype=object)[entries['Symbol']] if len(entries) else np.empty(0, dtype=object),
+            'Volume': entries['Volume']
+        })
@@ -1,19 +1,22 @@
 import pandas as pd
 import numpy as np
 import glob
-import matplotlib.pyplot as plt
 from matplotlib.dates import DateFormatter
+from matplotlib.figure import Figure
+from Instrumentation import instrumented, record
 
-def valuation(buy_df, sell_df, st_cap=1, n_seq=0):
+def dataframes_valuation(buy_df, sell_df, st_cap=1, n_seq=0):
     """
-    This function takes as input the dataframes with the associated cost and profit from the stock transactions
-    sequence and then plots the valuation diagrams.
+    This function computes the valuation of a stock transactions sequence from the dataframes with the associated
+    cost and profit of the stock buying and selling transactions.
     Args:
         buy_df: a dataframe with the stock buying transactions
         sell_df: a dataframe with the stock selling transactions
         st_cap: starting investment capital
         n_seq: the length of the transactions sequence
-    """    
+    Returns:
+        valuation_df: a dataframe with the Date, Balance and Portfolio for each transaction
+    """
 
     # For the dataframes with the buying and selling stock transactions create two columns with the respective
     # cost and profit with regard to the close price
@@ -49,31 +52,159 @@ def valuation(buy_df, sell_df, st_cap=1, n_seq=0):
     
     valuation_df.reset_index(drop=True, inplace=True)
 
+    return valuation_df
+
+def downsample_valuation(valuation_df, max_points):
+    """
+    This function reduces the number of points of a valuation while preserving its shape by keeping, for each bucket
+    of consecutive transactions, the first and last point and the points with the min/max Balance and Portfolio.
+    Args:
+        valuation_df: a dataframe with the Date, Balance and Portfolio for each transaction
+        max_points: the maximum number of points kept
+    Returns:
+        valuation_df: the downsampled dataframe (unchanged if it already has at most max_points points)
+    """
+    n_points = len(valuation_df)
+    if n_points <= max_points:
+        return valuation_df
+
+    # Split the points in contiguous buckets of (nearly) equal size, each bucket keeps at most 6 points
+    n_buckets = max(1, max_points // 6)
+    buckets = np.arange(n_points) * n_buckets // n_points
+    starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+    ends = np.r_[starts[1:], n_points] - 1
+    keep = [starts, ends]
+
+    # Sorting by (bucket, value) gives the position of the min and max value of each bucket
+    for column in ('Balance', 'Portfolio'):
+        order = np.lexsort((valuation_df[column].to_numpy(), buckets))
+        keep += [order[starts], order[ends]]
+
+    return valuation_df.iloc[np.unique(np.concatenate(keep))].reset_index(drop=True)
+
+def iter_ledger_valuation(ledger, st_cap=1, chunksize=1_000_000):
+    """
+    This function computes the valuation of a stock transactions sequence from the entries of a TradeLedger in chunks,
+    carrying the running Balance and Portfolio from one chunk to the next.
+    Args:
+        ledger: a TradeLedger with the stock buying and selling transactions
+        st_cap: starting investment capital
+        chunksize: the number of transactions of each chunk
+    Yields:
+        valuation_df: a dataframe with the Date, Balance and Portfolio for each transaction of the chunk
+    """
+    entries = ledger.entries
+    is_buy = ledger.is_buy()
+
+    # Sort the entries by date keeping the order in which they were logged for the same date
+    # (the traders log in chronological order so the sort is usually skipped)
+    order = None
+    if np.any(entries['Date'][1:] < entries['Date'][:-1]):
+        order = np.argsort(entries['Date'], kind='stable')
+
+    balance, portfolio = st_cap, st_cap
+    for start in range(0, len(entries), chunksize):
+        rows = order[start:start + chunksize] if order is not None else slice(start, start + chunksize)
+        chunk, chunk_is_buy = entries[rows], is_buy[rows]
+
+        # The balance decreases with the cost of the purchases and increases with the profit of the sellings, while the
+        # portfolio accumulates the price of the volume of stocks bought/sold with regard to the close price
+        balances = balance + np.cumsum(np.where(chunk_is_buy, -chunk['Amount'], chunk['Amount']))
+        portfolios = portfolio + np.cumsum(chunk['Volume'] * chunk['Close'])
+        balance, portfolio = balances[-1], portfolios[-1]
+
+        yield pd.DataFrame({'Date': pd.to_datetime(chunk['Date']), 'Balance': balances, 'Portfolio': portfolios})
+
+def ledger_valuation(ledger, st_cap=1, max_points=None, chunksize=1_000_000):
+    """
+    This function computes the valuation of a stock transactions sequence directly from the entries of a TradeLedger.
+    Args:
+        ledger: a TradeLedger with the stock buying and selling transactions
+        st_cap: starting investment capital
+        max_points: if specified each chunk is downsampled so that the whole valuation has about max_points points
+        chunksize: the number of transactions computed at once
+    Returns:
+        valuation_df: a dataframe with the Date, Balance and Portfolio for each (kept) transaction
+    """
+    valuation_dfs = []
+    for valuation_df in iter_ledger_valuation(ledger, st_cap, chunksize):
+        if max_points is not None:
+            valuation_df = downsample_valuation(valuation_df, max(6, max_points * len(valuation_df) // max(len(ledger), 1)))
+        valuation_dfs.append(valuation_df)
+
+    if not valuation_dfs:
+        return pd.DataFrame({'Date': pd.to_datetime([]), 'Balance': [], 'Portfolio': []})
+
+    return pd.concat(valuation_dfs, ignore_index=True)
+
+def draw_valuation(ax, valuation_df, n_seq=0):
+    """
+    This function draws the valuation area chart on a matplotlib Axes.
+    Args:
+        ax: the matplotlib Axes
+        valuation_df: a dataframe with the Date, Balance and Portfolio for each transaction
+        n_seq: the length of the transactions sequence
+    """
     # Plot the area chart
-    plt.figure(figsize=(12, 6))
-    plt.fill_between(valuation_df['Date'], valuation_df['Balance'], label='Balance', color='blue', alpha=0.8, zorder=2)
-    plt.fill_between(valuation_df['Date'], valuation_df['Portfolio'], label='Portfolio', color='orange', alpha=0.8, zorder=1)
+    ax.fill_between(valuation_df['Date'], valuation_df['Balance'], label='Balance', color='blue', alpha=0.8, zorder=2)
+    ax.fill_between(valuation_df['Date'], valuation_df['Portfolio'], label='Portfolio', color='orange', alpha=0.8, zorder=1)
 
     # Customize x-axis (date scale)
-    plt.gca().xaxis.set_major_formatter(DateFormatter('%Y'))
-    plt.gcf().autofmt_xdate()
+    ax.xaxis.set_major_formatter(DateFormatter('%Y'))
+    ax.figure.autofmt_xdate()
 
     # Set logarithmic scale for the y-axis
-    plt.yscale('log')
+    ax.set_yscale('log')
 
     # Customize y-axis ticks
-    plt.tick_params(axis='x', which='both', bottom=False, top=False)
-    plt.tick_params(axis='y', which='both', left=False, right=False)
+    ax.tick_params(axis='x', which='both', bottom=False, top=False)
+    ax.tick_params(axis='y', which='both', left=False, right=False)
     if n_seq <=1000:
-        plt.yticks([1e-2, 1e0, 1e2, 1e4, 1e6], labels=["$10^{-2}$", "$10^0$", "$10^2$", "$10^4$", "$10^6$"])
+        ax.set_yticks([1e-2, 1e0, 1e2, 1e4, 1e6], labels=["$10^{-2}$", "$10^0$", "$10^2$", "$10^4$", "$10^6$"])
     else:
-        plt.yticks([1e0, 1e3, 1e6, 1e9], labels=["$10^0$", "$10^3$", "$10^6$", "$10^9$"])
+        ax.set_yticks([1e0, 1e3, 1e6, 1e9], labels=["$10^0$", "$10^3$", "$10^6$", "$10^9$"])
 
     # Customize the plot
-    plt.legend()
-    plt.title("Valuation")
-    plt.xlabel("Date")
-    plt.ylabel("Value")
+    ax.legend()
+    ax.set_title("Valuation")
+    ax.set_xlabel("Date")
+    ax.set_ylabel("Value")
+
+@instrumented('valuation')
+def valuation(buy_df=None, sell_df=None, st_cap=1, n_seq=0, ledger=None, output_file=None, max_points=5000):
+    """
+    This function takes as input the dataframes with the associated cost and profit from the stock transactions
+    sequence and then plots the valuation diagrams.
+    Args:
+        buy_df: a dataframe with the stock buying transactions
+        sell_df: a dataframe with the stock selling transactions
+        st_cap: starting investment capital
+        n_seq: the length of the transactions sequence
+        ledger: a TradeLedger with the stock transactions (used instead of the buying and selling dataframes)
+        output_file: path of an image file where the plot is saved without a display (if not specified the plot is shown)
+        max_points: the maximum number of points drawn (None to draw every transaction)
+    Returns:
+        valuation_df: a dataframe with the Date, Balance and Portfolio of the points drawn
+    """    
+
+    if ledger is not None:
+        valuation_df = ledger_valuation(ledger, st_cap, max_points=max_points)
+    else:
+        valuation_df = dataframes_valuation(buy_df, sell_df, st_cap, n_seq)
+        if max_points is not None:
+            valuation_df = downsample_valuation(valuation_df, max_points)
+    record(Rows=len(ledger) if ledger is not None else len(buy_df) + len(sell_df), Points=len(valuation_df))
+
+    if output_file is not None:
+        # Render with a standalone figure which doesn't need a display
+        fig = Figure(figsize=(12, 6))
+        draw_valuation(fig.add_subplot(), valuation_df, n_seq)
+        fig.savefig(output_file)
+    else:
+        # Display the plot (pyplot selects a GUI backend, so it's imported only when the plot is shown)
+        import matplotlib.pyplot as plt
+        plt.figure(figsize=(12, 6))
+        draw_valuation(plt.gca(), valuation_df, n_seq)
+        plt.show()
 
-    # Display the plot
-    plt.show()
\ No newline at end of file
+    return valuation_df
@@ -0,0 +1,389 @@
+import numpy as np
+import pandas as pd
+from StockCache import StockCache
+from StockData import convert_dates
+
+
+class RangeArgmin:
+    """Class for O(1) range minimum queries over an array with a block sparse table. The array is split in blocks of
+    block_size values where the position of the minimum from the start of its block to each value (prefix) and from
+    each value to the end of its block (suffix) is kept, while a sparse table holds the minimum of every power of two
+    run of blocks. A query spanning several blocks is the minimum of a suffix, a prefix and two overlapping runs of
+    blocks, a query within a block is a scan of at most block_size values. The positions are kept as int32 so the
+    index takes about 16 bytes per value (with a copy of the values) instead of the 8 * log2(n) bytes of a plain
+    sparse table.
+    """
+    def __init__(self, values, block_size=32):
+        """
+        Args:
+                values (np.ndarray): Array of the values (NaN values are never selected unless the whole range is NaN)
+                block_size (int): Number of values of each block
+        """
+        values = np.asarray(values, dtype=np.float64)
+        self.block_size = block_size
+        n_values = len(values)
+        n_blocks = -(-n_values // block_size)
+
+        # Pad the last block with +inf so that all the blocks have the same size
+        padded = np.full(n_blocks * block_size, np.inf)
+        padded[:n_values] = np.nan_to_num(values, nan=np.inf)
+        blocks = padded.reshape(n_blocks, block_size)
+        block_starts = np.arange(n_blocks)[:, None] * block_size
+        columns = np.arange(block_size)[None, :]
+
+        # Prefix minimum position (the first one for ties): a value is a new minimum if it's below all the previous ones
+        previous_min = np.concatenate([np.full((n_blocks, 1), np.inf), np.minimum.accumulate(blocks, axis=1)[:, :-1]], axis=1)
+        is_new = (blocks < previous_min) | (columns == 0)
+        self.prefix = (block_starts + np.maximum.accumulate(np.where(is_new, columns, 0), axis=1)).ravel()[:n_values].astype(np.int32)
+
+        # Suffix minimum position (the first one for ties): scan each block backwards keeping the ties
+        reversed_blocks = blocks[:, ::-1]
+        previous_min = np.concatenate([np.full((n_blocks, 1), np.inf), np.minimum.accumulate(reversed_blocks, axis=1)[:, :-1]], axis=1)
+        is_new = (reversed_blocks <= previous_min) | (columns == 0)
+        suffix_columns = block_size - 1 - np.maximum.accumulate(np.where(is_new, columns, 0), axis=1)
+        self.suffix = (block_starts + suffix_columns[:, ::-1]).ravel()[:n_values].astype(np.int32)
+
+        # Sparse table over the blocks, level k holds the minimum position of the 2^k blocks starting at each block
+        self._padded = padded
+        self.table = [self.prefix[np.minimum(np.arange(n_blocks) * block_size + block_size - 1, n_values - 1)]] if n_values else []
+        length = 1
+        while 2 * length <= n_blocks:
+            level = self.table[-1]
+            self.table.append(self._select(level[:-length], level[length:]))
+            length *= 2
+
+    def _select(self, left, right):
+        # Position of the smaller value of each pair (the left one for ties)
+        return np.where(self._padded[right] < self._padded[left], right, left)
+
+    def query(self, starts, ends):
+        """
+        Return the position of the minimum of each range of values [start, end] (both inclusive, start <= end).
+
+        Args:
+            starts (np.ndarray): First position of each range
+            ends (np.ndarray): Last position of each range
+
+        Returns:
+            positions (np.ndarray): Position of the (first) minimum of each range
+        """
+        starts, ends = np.broadcast_arrays(np.asarray(starts, dtype=np.int64), np.asarray(ends, dtype=np.int64))
+        positions = np.empty(starts.shape, dtype=np.int64)
+        start_blocks, end_blocks = starts // self.block_size, ends // self.block_size
+
+        # Ranges within a block are scanned
+        same = start_blocks == end_blocks
+        if same.any():
+            best = starts[same].copy()
+            for offset in range(1, self.block_size):
+                candidates = np.minimum(starts[same] + offset, ends[same])
+                best = self._select(best, candidates)
+            positions[same] = best
+
+        # Ranges spanning several blocks: suffix of the first block, prefix of the last block and the blocks in between
+        spans = ~same
+        if spans.any():
+            suffix, prefix = self.suffix[starts[spans]].astype(np.int64), self.prefix[ends[spans]].astype(np.int64)
+            first_block, last_block = start_blocks[spans] + 1, end_blocks[spans] - 1
+
+            # Two overlapping power of two runs cover the blocks in between (the suffix if there are none)
+            inner = suffix.copy()
+            has_inner = last_block >= first_block
+            levels = np.floor(np.log2(np.maximum(last_block - first_block + 1, 1))).astype(np.int64)
+            for level in np.unique(levels[has_inner]):
+                rows = has_inner & (levels == level)
+                inner[rows] = self._select(self.table[level][first_block[rows]],
+                                           self.table[level][last_block[rows] - (1 << level) + 1])
+
+            # Combine in the order of the positions so that the first minimum wins the ties
+            positions[spans] = self._select(self._select(suffix, inner), prefix)
+
+        return positions
+
+
+def _prefix_argmin(blocks):
+    # Column of the (first) minimum of each prefix of the rows of a 2-D array
+    columns = np.arange(blocks.shape[1])[None, :]
+    previous_min = np.concatenate([np.full((blocks.shape[0], 1), np.inf), np.minimum.accumulate(blocks, axis=1)[:, :-1]], axis=1)
+    return np.maximum.accumulate(np.where((blocks < previous_min) | (columns == 0), columns, 0), axis=1)
+
+
+def _suffix_argmin(blocks):
+    # Column of the (last) minimum of each suffix of the rows of a 2-D array
+    return (blocks.shape[1] - 1 - _prefix_argmin(blocks[:, ::-1]))[:, ::-1]
+
+
+class RangeBestTrade:
+    """Class for O(log n) queries of the best trade of a range of rows, i.e. the rows i <= j with the largest
+    High[j] / Low[i] (buying at the Low of a row and selling at the High of the same or a later row). A run of rows is
+    summarized by the position of its lowest Low, its highest High and its best trade, and the best trade of two
+    consecutive runs is the best of their own trades and of buying at the lowest Low of the first and selling at the
+    highest High of the second. The summaries of the prefixes and suffixes within each block of block_size rows and of
+    every power of two run of blocks are kept, so a query combines a suffix, at most log2(n) disjoint runs of blocks
+    and a prefix in order (the runs can't overlap as in RangeArgmin, a trade could then sell before it buys).
+    """
+    def __init__(self, lows, highs, block_size=32):
+        """
+        Args:
+                lows (np.ndarray): Array of the Low prices (NaN or non positive Lows are never bought)
+                highs (np.ndarray): Array of the High prices (NaN Highs are never sold)
+                block_size (int): Number of rows of each block
+        """
+        lows = np.asarray(lows, dtype=np.float64)
+        highs = np.asarray(highs, dtype=np.float64)
+        self.block_size = block_size
+        n_values = len(lows)
+        n_blocks = -(-n_values // block_size)
+        positions = np.arange(n_blocks * block_size)
+
+        # Pad the last block with Lows that are never bought and Highs that are never sold
+        self._lows = np.full(n_blocks * block_size, np.inf)
+        self._lows[:n_values] = np.where(np.isfinite(lows) & (lows > 0), lows, np.inf)
+        self._highs = np.full(n_blocks * block_size, -np.inf)
+        self._highs[:n_values] = np.where(np.isfinite(highs), highs, -np.inf)
+        low_blocks = self._lows.reshape(n_blocks, block_size)
+        high_blocks = self._highs.reshape(n_blocks, block_size)
+        block_starts = np.arange(n_blocks)[:, None] * block_size
+
+        # Summary of the prefix of its block ending at each row (the best trade sells at the best row of the prefix)
+        self.prefix_min = (block_starts + _prefix_argmin(low_blocks)).ravel()
+        self.prefix_max = (block_starts + _prefix_argmin(-high_blocks)).ravel()
+        selling_returns = self._ratio(self.prefix_min, positions).reshape(n_blocks, block_size)
+        self.prefix_sell = (block_starts + _prefix_argmin(-selling_returns)).ravel()
+        self.prefix_buy = self.prefix_min[self.prefix_sell]
+
+        # Summary of the suffix of its block starting at each row (the best trade buys at the best row of the suffix)
+        self.suffix_min = (block_starts + _suffix_argmin(low_blocks)).ravel()
+        self.suffix_max = (block_starts + _suffix_argmin(-high_blocks)).ravel()
+        buying_returns = self._ratio(positions, self.suffix_max).reshape(n_blocks, block_size)
+        self.suffix_buy = (block_starts + _suffix_argmin(-buying_returns)).ravel()
+        self.suffix_sell = self.suffix_max[self.suffix_buy]
+
+        # Summaries of the runs of blocks, level k holds the 2^k blocks starting at each block
+        block_ends = np.arange(n_blocks) * block_size + block_size - 1
+        self.table = [self._prefix(block_ends)] if n_values else []
+        length = 1
+        while 2 * length <= n_blocks:
+            level = self.table[-1]
+            self.table.append(self._combine(tuple(values[:-length] for values in level),
+                                            tuple(values[length:] for values in level)))
+            length *= 2
+
+    def _ratio(self, buy, sell):
+        # High of the selling row over the Low of the buying row (-inf if either can't be traded)
+        with np.errstate(invalid='ignore'):
+            return np.nan_to_num(self._highs[sell] / self._lows[buy], nan=-np.inf)
+
+    def _prefix(self, rows):
+        return self.prefix_min[rows], self.prefix_max[rows], self.prefix_buy[rows], self.prefix_sell[rows]
+
+    def _suffix(self, rows):
+        return self.suffix_min[rows], self.suffix_max[rows], self.suffix_buy[rows], self.suffix_sell[rows]
+
+    def _combine(self, first, second):
+        # Summary of a run followed by the next one: (lowest Low, highest High, best buy, best sell) positions
+        first_min, first_max, first_buy, first_sell = first
+        second_min, second_max, second_buy, second_sell = second
+        lowest = np.where(self._lows[second_min] < self._lows[first_min], second_min, first_min)
+        highest = np.where(self._highs[second_max] > self._highs[first_max], second_max, first_max)
+
+        buy, sell = first_buy, first_sell
+        for candidate_buy, candidate_sell in ((second_buy, second_sell), (first_min, second_max)):
+            better = self._ratio(candidate_buy, candidate_sell) > self._ratio(buy, sell)
+            buy, sell = np.where(better, candidate_buy, buy), np.where(better, candidate_sell, sell)
+
+        return lowest, highest, buy, sell
+
+    def query(self, starts, ends):
+        """
+        Return the best trade of each range of rows [start, end] (both inclusive, start <= end).
+
+        Args:
+            starts (np.ndarray): First row of each range
+            ends (np.ndarray): Last row of each range
+
+        Returns:
+            buy_rows (np.ndarray): Row of the purchase of the best trade of each range
+            sell_rows (np.ndarray): Row of the selling of the best trade of each range (buy_row <= sell_row)
+        """
+        starts, ends = np.broadcast_arrays(np.asarray(starts, dtype=np.int64), np.asarray(ends, dtype=np.int64))
+        buy_rows, sell_rows = np.empty(starts.shape, dtype=np.int64), np.empty(starts.shape, dtype=np.int64)
+        start_blocks, end_blocks = starts // self.block_size, ends // self.block_size
+
+        # Ranges within a block are scanned keeping the lowest Low so far and the best trade selling so far
+        same = start_blocks == end_blocks
+        if same.any():
+            lowest, buy, sell = starts[same].copy(), starts[same].copy(), starts[same].copy()
+            for offset in range(1, self.block_size):
+                rows = np.minimum(starts[same] + offset, ends[same])
+                lowest = np.where(self._lows[rows] < self._lows[lowest], rows, lowest)
+                better = self._ratio(lowest, rows) > self._ratio(buy, sell)
+                buy, sell = np.where(better, lowest, buy), np.where(better, rows, sell)
+            buy_rows[same], sell_rows[same] = buy, sell
+
+        # Ranges spanning several blocks: suffix of the first block, disjoint runs of the blocks in between (the
+        # largest first, following the bits of their number) and prefix of the last block
+        spans = ~same
+        if spans.any():
+            summary = [values.astype(np.int64) for values in self._suffix(starts[spans])]
+            blocks = start_blocks[spans] + 1
+            n_inner = end_blocks[spans] - start_blocks[spans] - 1
+            for level in range(len(self.table) - 1, -1, -1):
+                rows = ((n_inner >> level) & 1) == 1
+                if rows.any():
+                    combined = self._combine(tuple(values[rows] for values in summary),
+                                             tuple(values[blocks[rows]] for values in self.table[level]))
+                    for values, combined_values in zip(summary, combined):
+                        values[rows] = combined_values
+                    blocks[rows] += 1 << level
+            _, _, buy_rows[spans], sell_rows[spans] = self._combine(tuple(summary), self._prefix(ends[spans]))
+
+        return buy_rows, sell_rows
+
+
+class WindowIndex:
+    """Class for the performance of the stocks over arbitrary date windows without rescanning the stock data. The rows
+    of all the stocks are kept back to back (as in the StockCache layout), the first and last row of a window are found
+    by a binary search over a (stock, day) key and the lowest Low and highest High of a window are range minimum/maximum
+    queries (see RangeArgmin), so every window question is answered in O(log n) and can be asked in batches.
+    """
+    def __init__(self, dates, lows, highs, offsets, symbols, block_size=32):
+        """
+        Args:
+                dates (np.ndarray): Date of each row (the rows of each stock sorted by date)
+                lows (np.ndarray): Low price of each row
+                highs (np.ndarray): High price of each row
+                offsets (np.ndarray): Row offsets of each stock
+                symbols (list): List with the stock id of each stock
+                block_size (int): Number of rows of each block of the range minimum/maximum queries
+        """
+        self.dates = np.asarray(dates).astype('datetime64[D]')
+        self.lows = np.asarray(lows, dtype=np.float64)
+        self.highs = np.asarray(highs, dtype=np.float64)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.symbols = pd.Index(symbols)
+
+        # Sorted (stock, day) key where each stock owns a block of `span` consecutive days
+        days = self.dates.astype(np.int64)
+        self.first_day = days.min() if len(days) else 0
+        self.span = (days.max() - self.first_day + 2) if len(days) else 2
+        codes = np.repeat(np.arange(len(symbols), dtype=np.int64), np.diff(self.offsets))
+        self.keys = codes * self.span + (days - self.first_day)
+        if np.any(self.keys[1:] < self.keys[:-1]):
+            raise ValueError("The rows of each stock must be sorted by date")
+
+        self.block_size = block_size
+        self.min_low = RangeArgmin(self.lows, block_size)
+        self.max_high = RangeArgmin(-self.highs, block_size)
+        self._best_trade = None
+
+    @property
+    def best_trade(self):
+        """Index of the best trade of any range of rows (see RangeBestTrade), built on the first use."""
+        if self._best_trade is None:
+            self._best_trade = RangeBestTrade(self.lows, self.highs, self.block_size)
+        return self._best_trade
+
+    @classmethod
+    def from_cache(cls, cache_path, files=None, block_size=32):
+        """
+        Build the index from the columnar cache of the stock data (see StockCache.load).
+        """
+        columns, symbols, offsets = StockCache(cache_path).load(files)
+        return cls(columns['Date'], columns['Low'], columns['High'], offsets, symbols, block_size)
+
+    @classmethod
+    def from_dataframes(cls, stock_datalist, block_size=32):
+        """
+        Build the index from a list of stock dataframes (e.g. StockData.stock_datalist).
+        """
+        dates = convert_dates(stock_datalist) if stock_datalist else np.empty(0, dtype='datetime64[D]')
+        lengths = [len(stock_df) for stock_df in stock_datalist]
+        symbols = [stock_df['Stock_Name'].iloc[0] if len(stock_df) else '' for stock_df in stock_datalist]
+        lows = np.concatenate([stock_df['Low'].to_numpy(dtype=np.float64) for stock_df in stock_datalist] or [[]])
+        highs = np.concatenate([stock_df['High'].to_numpy(dtype=np.float64) for stock_df in stock_datalist] or [[]])
+        return cls(dates, lows, highs, np.concatenate([[0], np.cumsum(lengths)]), symbols, block_size)
+
+    def window_rows(self, stocks, start_dates, end_dates):
+        """
+        Find the first and last row of each (stock, window) query.
+
+        Args:
+            stocks (array-like): Stock id of each query (or a single stock id for all the queries)
+            start_dates (array-like): First date of each window (inclusive)
+            end_dates (array-like): Last date of each window (inclusive)
+
+        Returns:
+            first (np.ndarray): First row of each window
+            last (np.ndarray): Last row of each window (first > last if the window has no rows or the stock is unknown)
+        """
+        codes = self.symbols.get_indexer(np.atleast_1d(np.asarray(stocks, dtype=object)))
+        start_days = np.atleast_1d(pd.to_datetime(start_dates).to_numpy().astype('datetime64[D]').astype(np.int64))
+        end_days = np.atleast_1d(pd.to_datetime(end_dates).to_numpy().astype('datetime64[D]').astype(np.int64))
+        codes, start_days, end_days = np.broadcast_arrays(codes, start_days, end_days)
+
+        # Clip the windows to the span of the keys, the last day of each stock block is never used by a row
+        start_offsets = np.clip(start_days - self.first_day, 0, self.span - 1)
+        end_offsets = np.clip(end_days - self.first_day, -1, self.span - 2)
+        first = np.searchsorted(self.keys, codes * self.span + start_offsets, side='left')
+        last = np.searchsorted(self.keys, codes * self.span + end_offsets, side='right') - 1
+        last = np.where(codes >= 0, last, first - 1)
+
+        return first, last
+
+    def window_returns(self, stocks, start_dates, end_dates):
+        """
+        Compute the performance of each (stock, window) query:
+        1) Total_Return: (High of the last row - Low of the first row) / Low of the first row as in read_analyze_stocks
+        2) Min_Low/Max_High: the lowest Low and highest High of the window and their dates (regardless of their order)
+        3) Best_Return: the return of the best trade of the window, buying at the Low of a row and selling at the High of
+        the same or a later row, and the dates of its purchase and its selling (see RangeBestTrade)
+
+        Args:
+            stocks (array-like): Stock id of each query (or a single stock id for all the queries)
+            start_dates (array-like): First date of each window (inclusive)
+            end_dates (array-like): Last date of each window (inclusive)
+
+        Returns:
+            returns_df (pd.DataFrame): Dataframe with the Stock, Start_Date, End_Date, Total_Return, Total_Years, Min_Low,
+            Min_Low_Date, Max_High, Max_High_Date, Best_Return, Best_Buy_Date and Best_Sell_Date of each query (NaN for
+            windows with less than 2 rows)
+        """
+        first, last = self.window_rows(stocks, start_dates, end_dates)
+        valid = last - first >= 1
+        first_rows, last_rows = np.where(valid, first, 0), np.where(valid, last, 0)
+
+        min_rows = np.zeros(len(first), dtype=np.int64)
+        max_rows = np.zeros(len(first), dtype=np.int64)
+        buy_rows = np.zeros(len(first), dtype=np.int64)
+        sell_rows = np.zeros(len(first), dtype=np.int64)
+        if valid.any():
+            min_rows[valid] = self.min_low.query(first_rows[valid], last_rows[valid])
+            max_rows[valid] = self.max_high.query(first_rows[valid], last_rows[valid])
+            buy_rows[valid], sell_rows[valid] = self.best_trade.query(first_rows[valid], last_rows[valid])
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            total_return = (self.highs[last_rows] - self.lows[first_rows]) / self.lows[first_rows]
+            best_return = (self.highs[sell_rows] - self.lows[buy_rows]) / self.lows[buy_rows]
+        total_years = (self.dates[last_rows] - self.dates[first_rows]).astype(np.int64) / 365.25
+
+        def masked(values):
+            return np.where(valid, values, np.nan)
+
+        def masked_dates(rows):
+            return np.where(valid, self.dates[rows], np.datetime64('NaT')).astype('datetime64[ns]')
+
+        return pd.DataFrame({
+            'Stock': np.broadcast_to(np.asarray(stocks, dtype=object), first.shape),
+            'Start_Date': masked_dates(first_rows),
+            'End_Date': masked_dates(last_rows),
+            'Total_Return': masked(total_return),
+            'Total_Years': masked(total_years),
+            'Min_Low': masked(self.lows[min_rows]),
+            'Min_Low_Date': masked_dates(min_rows),
+            'Max_High': masked(self.highs[max_rows]),
+            'Max_High_Date': masked_dates(max_rows),
+            'Best_Return': masked(best_return),
+            'Best_Buy_Date': masked_dates(buy_rows),
+            'Best_Sell_Date': masked_dates(sell_rows)
+        })